@@ -0,0 +1,68 @@
+from bisect import bisect_left
+
+# alignment policies
+FIRST_AT_OR_AFTER = 'first_ge'
+NEAREST = 'nearest'
+
+def build_onset_index(onsets):
+    """
+    Build an alignment index over the onsets of a spine (e.g. melody_onsets).
+    Onsets are expected to be (almost) sorted, but overlapping notes can make
+    them step back; both lookups still match a plain linear scan.
+    Args:
+        onsets: onset of each spine row, in row order;
+
+    Returns:
+        dict holding the running maximum of the onsets (for first >= t) and
+        the onsets sorted with their row numbers (for nearest)
+    """
+    running_max = []
+    current = float('-inf')
+    for t in onsets:
+        if t > current:
+            current = t
+        running_max.append(current)
+    by_onset = sorted(range(len(onsets)), key=lambda i: onsets[i])
+    return {
+        'onsets': onsets,
+        'running_max': running_max,
+        'sorted_onsets': [onsets[i] for i in by_onset],
+        'sorted_rows': by_onset,
+    }
+
+def first_onset_at_or_after(index, t):
+    '''
+    Row of the first onset >= t, or None
+    '''
+    row = bisect_left(index['running_max'], t)
+    return row if row < len(index['running_max']) else None
+
+def nearest_onset(index, t):
+    '''
+    Row of the onset closest to t (ties go to the earlier onset), or None
+    '''
+    sorted_onsets = index['sorted_onsets']
+    if not sorted_onsets:
+        return None
+    pos = bisect_left(sorted_onsets, t)
+    if pos == len(sorted_onsets) or (pos > 0 and t - sorted_onsets[pos - 1] <= sorted_onsets[pos] - t):
+        # step back to the first row holding the earlier onset
+        pos = bisect_left(sorted_onsets, sorted_onsets[pos - 1])
+    return index['sorted_rows'][pos]
+
+def align_onset(index, t, policy=FIRST_AT_OR_AFTER):
+    """
+    Find the spine row an event starting at t should be attached to.
+    Args:
+        index: result of build_onset_index;
+        t: event onset;
+        policy: FIRST_AT_OR_AFTER or NEAREST.
+
+    Returns:
+        row number, or None if nothing matches
+    """
+    if policy == FIRST_AT_OR_AFTER:
+        return first_onset_at_or_after(index, t)
+    if policy == NEAREST:
+        return nearest_onset(index, t)
+    raise ValueError(f"Unknown alignment policy: {policy}")
@@ -0,0 +1,345 @@
+import numpy as np
+from corpus_cache import NoteColumns
+from utils import (build_song_context, decompose_duration, emit_warning, untied,
+                   pitch_class_to_kern, PITCH_TABLE, PITCH_OCTAVES, TIE_START, TIE_MIDDLE, TIE_END)
+
+# kern pitch names laid out as (pitch_class * octaves + octave) * 2 + prefer_flats
+OCTAVE_COUNT = len(PITCH_OCTAVES)
+OCTAVE_MIN = PITCH_OCTAVES[0]
+PITCH_NAMES = [
+    PITCH_TABLE[(pc, octave, prefer_flats)]
+    for pc in range(12)
+    for octave in PITCH_OCTAVES
+    for prefer_flats in (False, True)
+]
+
+def _exclusive_cumsum(values):
+    total = np.cumsum(values)
+    return total - values
+
+def load_melody_arrays(songs, ctxs):
+    """
+    Load the melodies of many songs into flat arrays, each song sorted by onset.
+    Returns:
+        dict of per-note arrays (song, onset and offset in ticks, pitch_class,
+        octave, prefer_flats) and the note count of each song
+    """
+    melodies = [song.get('melody', [{}]) for song in songs]
+    song_idx = np.repeat(np.arange(len(songs), dtype=np.int64), [len(melody) for melody in melodies])
+    if melodies and all(isinstance(melody, NoteColumns) for melody in melodies):
+        # songs from the corpus cache: straight from the columns, no note dicts
+        columns = [melody.arrays() for melody in melodies]
+        onsets, offsets, pitch_classes, octaves = (
+            np.concatenate([column[k] for column in columns]).astype(dtype)
+            for k, dtype in enumerate((np.float64, np.float64, np.int64, np.int64)))
+    else:
+        notes = [note for melody in melodies for note in melody]
+        onsets = np.array([note['onset'] for note in notes], dtype=np.float64)
+        offsets = np.array([note['offset'] for note in notes], dtype=np.float64)
+        pitch_classes = np.array([note['pitch_class'] for note in notes])
+        octaves = np.array([note['octave'] for note in notes])
+        if pitch_classes.dtype.kind != 'i' or octaves.dtype.kind != 'i':
+            # keep the annotation values as they are, they are spelled one by one
+            pitch_classes = np.array([note['pitch_class'] for note in notes], dtype=object)
+            octaves = np.array([note['octave'] for note in notes], dtype=object)
+
+    # stable sort by onset within each song, as sorted() in melody_to_kern
+    order = np.lexsort((onsets, song_idx))
+    song_idx = song_idx[order]
+    beat_ticks = np.array([ctx['beat_ticks'] for ctx in ctxs], dtype=np.int64)[song_idx]
+    # np.rint rounds half to even like round()
+    return {
+        'song': song_idx,
+        'onset': np.rint(onsets[order] * beat_ticks).astype(np.int64),
+        'offset': np.rint(offsets[order] * beat_ticks).astype(np.int64),
+        'pitch_class': pitch_classes[order],
+        'octave': octaves[order],
+        'prefer_flats': np.array([ctx['prefer_flats'] for ctx in ctxs], dtype=bool)[song_idx],
+        'notes_per_song': np.bincount(song_idx, minlength=len(songs)),
+    }
+
+def pitch_ids(notes, pitch_names):
+    '''
+    Index of each note's kern pitch in pitch_names; names outside
+    PITCH_TABLE are spelled one by one and appended
+    '''
+    pitch_classes, octaves = notes['pitch_class'], notes['octave']
+    ids = np.zeros(len(pitch_classes), dtype=np.int64)
+    if pitch_classes.dtype == object:
+        in_table = np.zeros(len(pitch_classes), dtype=bool)
+    else:
+        in_table = ((pitch_classes >= 0) & (pitch_classes < 12)
+                    & (octaves >= OCTAVE_MIN) & (octaves < OCTAVE_MIN + OCTAVE_COUNT))
+    ids[in_table] = ((pitch_classes[in_table] * OCTAVE_COUNT + octaves[in_table] - OCTAVE_MIN) * 2
+                     + notes['prefer_flats'][in_table])
+    others = np.flatnonzero(~in_table)
+    if len(others):
+        pitch_classes, octaves = pitch_classes.tolist(), octaves.tolist()
+        for i in others.tolist():
+            pitch_names.append(pitch_class_to_kern(pitch_classes[i], octaves[i], bool(notes['prefer_flats'][i])))
+            ids[i] = len(pitch_names) - 1
+    return ids
+
+def melody_events(songs, ctxs, notes, rest_id):
+    """
+    Interleave notes with the rests before them and the final rest of each song.
+    Returns:
+        dict of per-event arrays (song, start, end in ticks, pitch id) in
+        output order, and the event count of each song
+    """
+    num_songs = len(songs)
+    song_idx = notes['song']
+    counts = notes['notes_per_song']
+    song_first = _exclusive_cumsum(counts)
+
+    # a note follows the offset of the previous note (0 for the first one)
+    prev_offset = np.zeros(len(song_idx), dtype=np.int64)
+    prev_offset[1:] = notes['offset'][:-1]
+    prev_offset[song_first[counts > 0]] = 0
+    has_rest = notes['onset'] > prev_offset
+
+    # final rest up to num_beats
+    last_offset = np.zeros(num_songs, dtype=np.int64)
+    last_offset[counts > 0] = notes['offset'][(song_first + counts - 1)[counts > 0]]
+    has_num_beats = np.array([song.get('num_beats') is not None for song in songs], dtype=bool)
+    num_beats_ticks = np.array([
+        0 if song.get('num_beats') is None else round(song['num_beats'] * ctx['beat_ticks'])
+        for song, ctx in zip(songs, ctxs)], dtype=np.int64)
+    has_final = has_num_beats & (last_offset < num_beats_ticks)
+
+    # slots: [rest] note ... [final rest], song after song
+    note_slots = 1 + has_rest
+    finals_before = _exclusive_cumsum(has_final.astype(np.int64))
+    note_pos = np.cumsum(note_slots) - 1 + finals_before[song_idx]
+    events_per_song = np.bincount(song_idx, weights=note_slots, minlength=num_songs).astype(np.int64) + has_final
+    final_pos = (np.cumsum(events_per_song) - 1)[has_final]
+    rest_pos = note_pos[has_rest] - 1
+
+    total = int(events_per_song.sum())
+    start = np.empty(total, dtype=np.int64)
+    end = np.empty(total, dtype=np.int64)
+    pitch = np.empty(total, dtype=np.int64)
+    start[note_pos], end[note_pos], pitch[note_pos] = notes['onset'], notes['offset'], notes['pitch_id']
+    start[rest_pos], end[rest_pos], pitch[rest_pos] = prev_offset[has_rest], notes['onset'][has_rest], rest_id
+    start[final_pos], end[final_pos], pitch[final_pos] = last_offset[has_final], num_beats_ticks[has_final], rest_id
+    return {'start': start, 'end': end, 'pitch': pitch, 'events_per_song': events_per_song}
+
+def duration_table(durations):
+    """
+    Decompose each distinct duration once.
+    Returns:
+        index of every duration in the table, and the table: flat part ticks
+        and rhythm tokens (tied, and tie-free for rests and pieces of notes
+        split at barlines), plus the first part, part count, total ticks
+        and warnings of each entry
+    """
+    unique, inverse = np.unique(durations, return_inverse=True)
+    table = {'part_ticks': [], 'rhythms': [], 'rest_rhythms': [],
+             'first': [], 'count': [], 'total': [], 'warnings': []}
+    for ticks in unique.tolist():
+        tokens, parts, warnings = decompose_duration(ticks)
+        table['first'].append(len(table['part_ticks']))
+        table['count'].append(len(parts))
+        table['total'].append(sum(parts))
+        table['warnings'].append(warnings)
+        table['part_ticks'].extend(parts)
+        table['rhythms'].extend(tokens)
+        table['rest_rhythms'].extend(untied(token) for token in tokens)
+    for key in ('part_ticks', 'first', 'count', 'total'):
+        table[key] = np.array(table[key], dtype=np.int64)
+    return inverse.reshape(-1), table
+
+def bar_lines_until(segments, song_start, last_pos):
+    """
+    Barline ticks of a song up to last_pos, as iter_bar_lines yields them.
+    Returns:
+        array of ticks and {barline number: (beats_per_bar, beat_unit)}
+        for the barlines starting a meter change
+    """
+    ticks, changes = [], {}
+    count = 0
+    for i, (start, beats_per_bar, beat_unit, bar_ticks) in enumerate(segments):
+        if start > last_pos:
+            break
+        end = segments[i + 1][0] if i + 1 < len(segments) else last_pos + 1
+        if i > 0:
+            changes[count] = (beats_per_bar, beat_unit)
+        if i > 0 or start > song_start:
+            ticks.append(np.array([start], dtype=np.int64))
+            count += 1
+        bars = np.arange(start + bar_ticks, min(end, last_pos + 1), bar_ticks, dtype=np.int64)
+        ticks.append(bars)
+        count += len(bars)
+    return np.concatenate(ticks) if ticks else np.zeros(0, dtype=np.int64), changes
+
+def encode_melodies(songs, ctxs=None):
+    """
+    Convert the melodies of many songs at once. Durations, rest gaps, token
+    indices and barline positions are computed on arrays over the whole
+    batch; strings are only built at the end. Rows are identical to
+    melody_to_kern.
+    Args:
+        songs: song dicts in the extract_key_fields shape;
+        ctxs: song contexts from build_song_context, built here if omitted
+
+    Returns:
+        list of (melody_lines, melody_onsets) per song
+    """
+    if not songs:
+        return []
+    if ctxs is None:
+        ctxs = [build_song_context(song) for song in songs]
+    num_songs = len(songs)
+    pitch_names = list(PITCH_NAMES)
+    pitch_names.append("r")
+    rest_id = len(pitch_names) - 1
+
+    notes = load_melody_arrays(songs, ctxs)
+    notes['pitch_id'] = pitch_ids(notes, pitch_names)
+    events = melody_events(songs, ctxs, notes, rest_id)
+    event_song = np.repeat(np.arange(num_songs), events['events_per_song'])
+
+    # per song: start (for the pickup bar), and every barline up to the last event
+    song_start = np.zeros(num_songs, dtype=np.int64)
+    has_notes = notes['notes_per_song'] > 0
+    song_start[has_notes] = np.minimum(0, notes['onset'][_exclusive_cumsum(notes['notes_per_song'])[has_notes]])
+    last_tick = song_start.copy()
+    np.maximum.at(last_tick, event_song, events['start'])
+    np.maximum.at(last_tick, event_song, events['end'])
+    first_bar = np.array([1 if ctx['meter_segments'][0][0] > start else 2
+                          for ctx, start in zip(ctxs, song_start.tolist())], dtype=np.int64)
+    bar_ticks, changes, bars_per_song = [], {}, []
+    base = 0
+    for i, ctx in enumerate(ctxs):
+        ticks, song_changes = bar_lines_until(ctx['meter_segments'], int(song_start[i]), int(last_tick[i]))
+        changes.update((base + number, meter) for number, meter in song_changes.items())
+        bar_ticks.append(ticks)
+        bars_per_song.append(len(ticks))
+        base += len(ticks)
+    bar_ticks = np.concatenate(bar_ticks)
+    bar_song = np.repeat(np.arange(num_songs), bars_per_song)
+    bar_base = _exclusive_cumsum(np.array(bars_per_song, dtype=np.int64))
+
+    # split every event at the barlines strictly inside it, searched on (song, tick) keys
+    low = min(song_start.min(), events['start'].min(initial=0), events['end'].min(initial=0))
+    span = max(last_tick.max(), bar_ticks.max(initial=0)) - low + 1
+    bar_keys = bar_song * span + bar_ticks - low
+    first_inside = np.searchsorted(bar_keys, event_song * span + events['start'] - low, side='right')
+    inside = np.maximum(np.searchsorted(bar_keys, event_song * span + events['end'] - low, side='left')
+                        - first_inside, 0)
+    piece_event = np.repeat(np.arange(len(inside)), inside + 1)
+    piece_k = np.arange(len(piece_event)) - _exclusive_cumsum(inside + 1)[piece_event]
+    bar_lookup = np.append(bar_ticks, 0)
+    piece_bar = first_inside[piece_event] + piece_k
+    piece_start = np.where(piece_k == 0, events['start'][piece_event],
+                           bar_lookup[np.clip(piece_bar - 1, 0, len(bar_ticks))])
+    piece_end = np.where(piece_k == inside[piece_event], events['end'][piece_event],
+                         bar_lookup[np.clip(piece_bar, 0, len(bar_ticks))])
+    piece_song = event_song[piece_event]
+    duration_idx, table = duration_table(piece_end - piece_start)
+
+    # warnings in piece order, as the per-song converter prints them
+    has_warnings = np.array([bool(w) for w in table['warnings']], dtype=bool)
+    warned = np.flatnonzero(has_warnings[duration_idx])
+    for entry, song in zip(duration_idx[warned].tolist(), piece_song[warned].tolist()):
+        for kind, message, value in table['warnings'][entry]:
+            emit_warning(kind, message, value, songs[song].get('id'))
+
+    # expand every piece into the parts of its duration
+    piece_parts = table['count'][duration_idx]
+    row_piece = np.repeat(np.arange(len(duration_idx)), piece_parts)
+    piece_first_row = _exclusive_cumsum(piece_parts)[row_piece]
+    row_part = table['first'][duration_idx][row_piece] + np.arange(len(row_piece)) - piece_first_row
+    # start of a row: piece start plus the parts before it in the piece
+    ticks_before = _exclusive_cumsum(table['part_ticks'][row_part])
+    row_start = piece_start[row_piece] + ticks_before - ticks_before[piece_first_row]
+
+    # rhythm variants: as decomposed, tie-free (rests), or re-tied across
+    # the pieces of a split note (start, continue, end)
+    row_event = piece_event[row_piece]
+    is_rest = events['pitch'][row_event] == rest_id
+    event_rows = np.bincount(row_event, minlength=len(inside))
+    row_index = np.arange(len(row_event)) - _exclusive_cumsum(event_rows)[row_event]
+    row_count = event_rows[row_event]
+    chained = np.where(row_count < 2, 1, np.where(row_index == 0, 2, np.where(row_index == row_count - 1, 4, 3)))
+    variant = np.where(is_rest, 1, np.where(inside[row_event] > 0, chained, 0))
+    bare = table['rest_rhythms']
+    rhythms = (table['rhythms'] + bare + [token + TIE_START for token in bare]
+               + [token + TIE_MIDDLE for token in bare] + [token + TIE_END for token in bare])
+    row_rhythm = row_part + len(bare) * variant
+    lines = [rhythms[r] + pitch_names[p] for r, p in zip(row_rhythm.tolist(), events['pitch'][row_event].tolist())]
+    onsets = row_start.tolist()
+
+    # per song: end of the last written piece
+    pieces_per_song = np.bincount(piece_song, minlength=num_songs)
+    piece_bounds = np.concatenate(([0], np.cumsum(pieces_per_song)))
+    row_bounds = np.concatenate(([0], np.cumsum(piece_parts)))[piece_bounds]
+    rows_per_song = np.diff(row_bounds)
+    song_end = np.zeros(num_songs, dtype=np.int64)
+    has_pieces = pieces_per_song > 0
+    last_piece = piece_bounds[1:][has_pieces] - 1
+    song_end[has_pieces] = piece_start[last_piece] + table['total'][duration_idx[last_piece]]
+
+    # one slot per row plus one after the last row of each song, for the final barline
+    slot_pos = np.insert(row_start, row_bounds[1:], song_end)
+    slot_song = np.repeat(np.arange(num_songs), rows_per_song + 1)
+    # barlines closed at each slot, searched on (song, tick) keys; a running
+    # maximum as overlapping notes can step back
+    low = min(slot_pos.min(), bar_ticks.min(initial=0))
+    span = max(slot_pos.max(), bar_ticks.max(initial=0)) - low + 1
+    closed = np.maximum.accumulate(np.searchsorted(bar_song * span + bar_ticks - low,
+                                                   slot_song * span + slot_pos - low, side='right'))
+    closed_before = np.concatenate(([0], closed[:-1]))
+    # barlines read past the end of a song are never closed
+    closed_before[row_bounds[:-1] + np.arange(num_songs)] = bar_base
+    bar_slots = np.flatnonzero(closed > closed_before)
+    # a barline carries the number of the bar it starts, a pickup is bar 0
+    bar_numbers = (closed - bar_base[slot_song])[bar_slots] + first_bar[slot_song[bar_slots]] - 1
+    # last meter change among the barlines closed at once
+    is_change = np.zeros(len(bar_ticks), dtype=bool)
+    is_change[list(changes)] = True
+    last_change = np.maximum.accumulate(np.where(is_change, np.arange(len(bar_ticks)), -1))
+    bar_changes = last_change[closed[bar_slots] - 1]
+    has_change = bar_changes >= closed_before[bar_slots]
+
+    # output position of every row once the barlines (and meter changes) are spliced in
+    inserted = np.zeros(len(slot_pos), dtype=np.int64)
+    inserted[bar_slots] = 1 + has_change
+    inserted_upto = np.cumsum(inserted)
+    slot_rows = np.arange(len(slot_pos)) - slot_song
+    is_row = np.ones(len(slot_pos), dtype=bool)
+    is_row[row_bounds[1:] + np.arange(num_songs)] = False
+    row_pos = (slot_rows + inserted_upto)[is_row]
+    bar_pos = (slot_rows + inserted_upto - inserted)[bar_slots]
+    meter_pos = bar_pos[has_change] + 1
+
+    bar_lines = [f"={n}" for n in bar_numbers.tolist()]
+    meter_lines = [f"*M{changes[c][0]}/{changes[c][1]}" for c in bar_changes[has_change].tolist()]
+    out_lines = np.empty(len(lines) + len(bar_lines) + len(meter_lines), dtype=object)
+    out_onsets = np.empty(len(out_lines), dtype=object)
+    for out, rows in ((out_lines, lines), (out_onsets, onsets)):
+        out[row_pos] = rows
+        out[bar_pos] = bar_lines
+        out[meter_pos] = meter_lines
+    out_lines, out_onsets = out_lines.tolist(), out_onsets.tolist()
+
+    # split per song
+    song_bounds = np.concatenate(([0], (row_bounds[1:] + inserted_upto[row_bounds[1:] + np.arange(num_songs)]))).tolist()
+    return [(out_lines[a:b], out_onsets[a:b]) for a, b in zip(song_bounds[:-1], song_bounds[1:])]
+
+def generate_kern_batch(songs, ctxs=None):
+    """
+    Batch version of generate_kern.
+    Returns:
+        list of (kern_lines, melody_onsets) per song, equal to generate_kern
+    """
+    if ctxs is None:
+        ctxs = [build_song_context(song) for song in songs]
+    results = []
+    for ctx, (melody_lines, melody_onsets) in zip(ctxs, encode_melodies(songs, ctxs)):
+        kern_lines = ["**kern", "*clefG2", f"*k[{ctx['signature']}]", f"*{ctx['tonic']}:",
+                      f"*M{ctx['beats_per_bar']}/{ctx['beat_unit']}"]
+        kern_lines.extend(melody_lines)
+        kern_lines.append("*-")
+        results.append((kern_lines, melody_onsets))
+    return results
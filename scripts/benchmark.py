@@ -0,0 +1,210 @@
+import os
+import gzip
+import json
+import time
+import random
+import argparse
+import tempfile
+from parse_json import iter_songs
+from utils import build_song_context, generate_kern, harmony_to_kern, silenced_warnings
+from convert_to_kern import write_kern_file
+
+# (beats_per_bar, beat_unit)
+METERS = [(4, 4), (3, 4), (2, 4), (6, 8), (12, 8), (2, 2)]
+
+# scale_degree_intervals per mode, as in the Hooktheory annotations
+MODE_INTERVALS = {
+    'major': [2, 2, 1, 2, 2, 2],
+    'minor': [2, 1, 2, 2, 1, 2],
+    'dorian': [2, 1, 2, 2, 2, 1],
+    'phrygian': [1, 2, 2, 2, 1, 2],
+    'lydian': [2, 2, 2, 1, 2, 2],
+    'mixolydian': [2, 2, 1, 2, 2, 1],
+    'locrian': [1, 2, 2, 1, 2, 2],
+}
+
+# note lengths in beats
+PLAIN_DURATIONS = [0.25, 0.5, 0.5, 0.75, 1.0, 1.0, 1.5, 2.0, 3.0, 4.0]
+TRIPLET_DURATIONS = [1 / 3, 2 / 3, 1 / 6, 4 / 3]
+
+CHORD_INTERVALS = [[4, 3], [3, 4], [3, 3], [4, 4], [4, 3, 3], [4, 3, 4], [3, 4, 3],
+                   [3, 3, 4], [2, 5], [5, 2], [7], [4, 3, 2], [4, 4, 2, 3]]
+
+# barlines are placed while the melody is generated
+STAGES = ('load', 'melody', 'harmony', 'write')
+
+def make_synthetic_song(rng, song_id, num_notes=200, harmony_density=1.0,
+                        meter=(4, 4), mode='major', triplet_ratio=0.1, rest_ratio=0.1):
+    """
+    Generate a random song in the extract_key_fields shape.
+    Args:
+        rng: random.Random instance;
+        num_notes: number of melody notes;
+        harmony_density: chords per bar;
+        meter: (beats_per_bar, beat_unit);
+        mode: key mode from MODE_INTERVALS, or 'unknown';
+        triplet_ratio: share of notes with triplet lengths;
+        rest_ratio: share of notes preceded by a rest.
+    """
+    beats_per_bar, beat_unit = meter
+    melody = []
+    t = 0.0
+    for _ in range(num_notes):
+        if rng.random() < rest_ratio:
+            t += rng.choice(PLAIN_DURATIONS)
+        pool = TRIPLET_DURATIONS if rng.random() < triplet_ratio else PLAIN_DURATIONS
+        duration = rng.choice(pool)
+        melody.append({
+            "onset": round(t, 7),
+            "offset": round(t + duration, 7),
+            "pitch_class": rng.randrange(12),
+            "octave": rng.randrange(-1, 3),
+        })
+        t += duration
+    num_beats = t + rng.choice([0, 0, beats_per_bar])
+
+    harmony = []
+    chord_length = beats_per_bar / harmony_density
+    h = 0.0
+    while h < t:
+        harmony.append({
+            "onset": round(h, 7),
+            "offset": round(h + chord_length, 7),
+            "root_pitch_class": rng.randrange(12),
+            "root_position_intervals": rng.choice(CHORD_INTERVALS),
+        })
+        h += chord_length
+
+    intervals = MODE_INTERVALS.get(mode, [3, 3, 3, 3])
+    return {
+        "id": song_id,
+        "title": f"Synthetic {song_id}",
+        "artist": "benchmark",
+        "urls": {"song": f"https://example.com/song/{song_id}", "clip": f"https://example.com/clip/{song_id}"},
+        "youtube": {"url": f"https://example.com/youtube/{song_id}"},
+        "meters": [{"beat": 0, "beats_per_bar": beats_per_bar, "beat_unit": beat_unit}],
+        "keys": [{"beat": 0, "tonic_pitch_class": rng.randrange(12), "scale_degree_intervals": intervals}],
+        "melody": melody,
+        "harmony": harmony,
+        "num_beats": num_beats,
+    }
+
+def make_synthetic_corpus(num_songs, num_notes, seed=0, **kwargs):
+    '''
+    Songs cycling through every meter and mode
+    '''
+    rng = random.Random(seed)
+    modes = list(MODE_INTERVALS) + ['unknown']
+    return [
+        make_synthetic_song(rng, f"synth{i:06d}", num_notes,
+                            meter=METERS[i % len(METERS)], mode=modes[i % len(modes)], **kwargs)
+        for i in range(num_songs)
+    ]
+
+def write_synthetic_dump(songs, path):
+    '''
+    Save songs in the raw Hooktheory.json.gz layout
+    '''
+    data = {}
+    for song in songs:
+        data[song['id']] = {
+            "split": "TRAIN",
+            "hooktheory": {"song": song['title'], "artist": song['artist'], "urls": song['urls']},
+            "youtube": song['youtube'],
+            "annotations": {key: song[key] for key in ("meters", "keys", "melody", "harmony", "num_beats")},
+        }
+    with gzip.open(path, 'wt', encoding='utf-8') as f:
+        json.dump(data, f)
+
+def time_stages(songs, output_dir):
+    """
+    Run every conversion stage over the songs and time each one separately.
+    Returns:
+        {stage: seconds}
+    """
+    timings = dict.fromkeys(STAGES[1:], 0.0)
+    clock = time.perf_counter
+    for song in songs:
+        ctx = build_song_context(song)
+        t0 = clock()
+        melody_spine, melody_onsets = generate_kern(song, ctx)
+        t1 = clock()
+        harmony_spine = harmony_to_kern(song, melody_onsets, ctx)
+        t2 = clock()
+        write_kern_file(melody_spine, harmony_spine, os.path.join(output_dir, f"{song['id']}.krn"), song)
+        t3 = clock()
+        timings['melody'] += t1 - t0
+        timings['harmony'] += t2 - t1
+        timings['write'] += t3 - t2
+    return timings
+
+def time_batch_melody(songs, batch_size=256):
+    '''
+    Melody stage with the NumPy batch encoder, batch_size songs at a time
+    '''
+    from batch_encode import generate_kern_batch
+    ctxs = [build_song_context(song) for song in songs]
+    t0 = time.perf_counter()
+    for start in range(0, len(songs), batch_size):
+        generate_kern_batch(songs[start:start + batch_size], ctxs[start:start + batch_size])
+    return time.perf_counter() - t0
+
+def time_loading(songs, tmp_dir):
+    path = os.path.join(tmp_dir, "synthetic.json.gz")
+    write_synthetic_dump(songs, path)
+    t0 = time.perf_counter()
+    count = sum(1 for _ in iter_songs(path))
+    return time.perf_counter() - t0, count
+
+def run_case(label, songs, repeat=1, batch=False):
+    '''
+    Best-of-repeat timings for one corpus, printed as songs/sec and notes/sec
+    '''
+    num_notes = sum(len(song['melody']) for song in songs)
+    best = dict.fromkeys(STAGES, float('inf'))
+    batch_melody = float('inf')
+    # conversion warnings (triplets, unmatched lengths) would time stderr writes, not the converter
+    with tempfile.TemporaryDirectory() as tmp_dir, silenced_warnings():
+        for _ in range(repeat):
+            load_time, _ = time_loading(songs, tmp_dir)
+            timings = time_stages(songs, tmp_dir)
+            timings['load'] = load_time
+            for stage in STAGES:
+                best[stage] = min(best[stage], timings[stage])
+            if batch:
+                batch_melody = min(batch_melody, time_batch_melody(songs))
+
+    print(f"\n== {label}: {len(songs)} songs, {num_notes} notes")
+    print(f"{'stage':<10}{'seconds':>10}{'songs/sec':>14}{'notes/sec':>14}")
+    for stage in STAGES + ('total',):
+        seconds = sum(best.values()) if stage == 'total' else best[stage]
+        songs_rate = len(songs) / seconds if seconds else float('inf')
+        notes_rate = num_notes / seconds if seconds else float('inf')
+        print(f"{stage:<10}{seconds:>10.4f}{songs_rate:>14.1f}{notes_rate:>14.0f}")
+    if batch:
+        print(f"{'melody*':<10}{batch_melody:>10.4f}{len(songs) / batch_melody:>14.1f}"
+              f"{num_notes / batch_melody:>14.0f}   (* batch encoder)")
+    return best
+
+def main(num_songs=200, sizes=(50, 500, 5000), seed=0, repeat=3, batch=False):
+    # typical songs
+    run_case("typical", make_synthetic_corpus(num_songs, 120, seed), repeat, batch)
+    # triplet-heavy songs with dense harmony
+    run_case("triplets + dense harmony",
+             make_synthetic_corpus(num_songs, 120, seed, triplet_ratio=0.6, harmony_density=4), repeat, batch)
+    # very long songs: per-note cost should stay flat as songs grow
+    for size in sizes:
+        count = max(1, num_songs * 120 // size)
+        run_case(f"long songs ({size} notes)", make_synthetic_corpus(count, size, seed), repeat, batch)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the kern converter on synthetic songs.")
+    parser.add_argument('--songs', type=int, default=200, help="songs per typical case")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[50, 500, 5000],
+                        help="note counts of the long-song cases")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=3, help="runs per case, best is reported")
+    parser.add_argument('--batch', action='store_true',
+                        help="also time the melody stage with the NumPy batch encoder")
+    args = parser.parse_args()
+    main(args.songs, args.sizes, args.seed, args.repeat, args.batch)
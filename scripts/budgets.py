@@ -0,0 +1,130 @@
+import signal
+import threading
+import time
+from contextlib import contextmanager
+
+# default per-song limits, far above any song of the corpus; 0 or None disables one
+MAX_NOTES = 10000
+MAX_BEATS = 20000
+MAX_LINES = 200000
+CPU_SECONDS = 10.0
+
+# songs over a budget, one JSON line each, written next to the outputs
+QUARANTINE_NAME = "quarantine.jsonl"
+
+class BudgetExceeded(Exception):
+    """
+    A song went over one of its budgets: kind is 'notes', 'beats', 'lines'
+    or 'cpu_seconds'.
+    """
+    def __init__(self, kind, value, limit):
+        super().__init__(f"{kind} {value} over the budget of {limit}")
+        self.kind = kind
+        self.value = value
+        self.limit = limit
+
+    def to_dict(self):
+        return {'kind': self.kind, 'value': self.value, 'limit': self.limit, 'reason': str(self)}
+
+def _span(events):
+    '''
+    (first onset, last offset) of a song's notes or chords, None without any
+    '''
+    if not events:
+        return None
+    if hasattr(events, 'arrays'):
+        # cached melody (corpus_cache.NoteColumns): read the columns, no dicts
+        onsets, offsets = events.arrays()[:2]
+        return float(onsets.min()), float(offsets.max())
+    return min(event.get('onset', 0) for event in events), max(event.get('offset', 0) for event in events)
+
+def song_beats(song):
+    '''
+    Beats spanned by a song: from its first onset (or 0, pickups start
+    before it) to the furthest of num_beats and the note and chord offsets
+    '''
+    start, end = 0, song.get('num_beats') or 0
+    for span in (_span(song.get('melody')), _span(song.get('harmony'))):
+        if span is not None:
+            start, end = min(start, span[0]), max(end, span[1])
+    return end - start
+
+class Budget:
+    """
+    Per-song limits of a run, so one malformed record cannot stall a batch
+    or blow up its output.
+    Args:
+        max_notes: melody notes plus chords;
+        max_beats: beats spanned by the song, bounding rest padding and
+            tied-note splitting;
+        max_lines: lines of the rendered .krn;
+        cpu_seconds: CPU time of one conversion.
+    """
+    def __init__(self, max_notes=MAX_NOTES, max_beats=MAX_BEATS, max_lines=MAX_LINES,
+                 cpu_seconds=CPU_SECONDS):
+        self.max_notes = max_notes
+        self.max_beats = max_beats
+        self.max_lines = max_lines
+        self.cpu_seconds = cpu_seconds
+
+    def check_input(self, song):
+        '''
+        Raise BudgetExceeded before converting a song that is too large
+        '''
+        if self.max_notes:
+            notes = len(song.get('melody') or []) + len(song.get('harmony') or [])
+            if notes > self.max_notes:
+                raise BudgetExceeded('notes', notes, self.max_notes)
+        if self.max_beats:
+            beats = song_beats(song)
+            if beats > self.max_beats:
+                raise BudgetExceeded('beats', beats, self.max_beats)
+
+    def check_output(self, text):
+        if self.max_lines:
+            lines = text.count('\n')
+            if lines > self.max_lines:
+                raise BudgetExceeded('lines', lines, self.max_lines)
+
+    @contextmanager
+    def cpu_limit(self):
+        """
+        Raise BudgetExceeded once the block's thread has used cpu_seconds of
+        CPU time. On the main thread of a Unix process (serial runs and pool
+        workers) a profiling timer interrupts the conversion; elsewhere the
+        time is only checked when the block ends.
+        The timer counts the whole process, so with --pipeline the reader
+        and writer threads advance it too: it is re-armed until the
+        converting thread itself (time.thread_time) is over the budget.
+        """
+        if not self.cpu_seconds:
+            yield
+            return
+        interrupt = hasattr(signal, 'setitimer') and threading.current_thread() is threading.main_thread()
+        start = time.thread_time()
+        if interrupt:
+            def on_timeout(signum, frame):
+                used = time.thread_time() - start
+                if used < self.cpu_seconds:
+                    signal.setitimer(signal.ITIMER_PROF, self.cpu_seconds - used)
+                    return
+                raise BudgetExceeded('cpu_seconds', round(used, 3), self.cpu_seconds)
+            previous = signal.signal(signal.SIGPROF, on_timeout)
+            signal.setitimer(signal.ITIMER_PROF, self.cpu_seconds)
+        try:
+            yield
+        finally:
+            if interrupt:
+                signal.setitimer(signal.ITIMER_PROF, 0)
+                signal.signal(signal.SIGPROF, previous)
+        seconds = time.thread_time() - start
+        if seconds > self.cpu_seconds:
+            raise BudgetExceeded('cpu_seconds', round(seconds, 3), self.cpu_seconds)
+
+DEFAULT_BUDGET = Budget()
+
+def quarantine_entry(input_hash, result):
+    '''
+    Quarantine line of a result with status 'quarantined'
+    '''
+    return dict(result['quarantine'], id=result['id'], input_hash=input_hash)
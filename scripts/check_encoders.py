@@ -0,0 +1,205 @@
+import re
+import random
+import argparse
+from parse_json import iter_songs
+from utils import (build_song_context, generate_kern, silenced_warnings, decompose_duration, iter_bar_lines,
+                   kern_value_to_ticks,
+                   _decompose_ticks, DECOMPOSITION_TABLE_TICKS, pitch_class_to_kern, _spell_pitch,
+                   chord_label, intervals_to_mask, root_to_name, quality_from_pcset, intervals_to_pcset)
+from batch_encode import generate_kern_batch
+
+DEFAULT_SOURCE = "data/Hooktheory.json.gz"
+# generated songs per run, and songs encoded together per batch
+DEFAULT_GENERATED = 2000
+BATCH_SIZE = 256
+
+# note lengths in beats drawn by random_song: plain, dotted, triplet and long ones,
+# and odd ones no kern values add up to (their remainder is dropped with a warning)
+DURATIONS = [0.25, 0.5, 0.75, 1, 1.5, 2, 3, 4, 1 / 3, 2 / 3, 4 / 3, 1 / 6, 8 / 3, 5, 7, 9.5]
+LOSSY_DURATIONS = [0.1, 0.02]
+METERS = [(4, 4), (3, 4), (2, 4), (6, 8), (12, 8), (5, 4), (7, 8), (6, 2), (2, 2)]
+
+# hand-written songs: meters as (beat, beats_per_bar, beat_unit), notes as (onset, offset) in beats
+FIXED_SONGS = {
+    # a quarter triplet across a 4/4 barline
+    'triplet-across-barline': ([(0, 4, 4)], [(0, 3.5), (3.5, 3.5 + 2 / 3)]),
+    # eighth triplets from a pickup, the last one tied over the barline
+    'triplets-after-pickup': ([(1, 3, 4)], [(0, 1 / 3), (1 / 3, 2 / 3), (2 / 3, 4 / 3), (4 / 3, 5)]),
+    # a half triplet over a meter change that is not on a barline
+    'triplet-over-meter-change': ([(0, 4, 4), (5.5, 6, 8)], [(0, 5), (5, 5 + 4 / 3), (5 + 4 / 3, 9)]),
+}
+
+def fixed_song(song_id):
+    meters, notes = FIXED_SONGS[song_id]
+    return {
+        'id': song_id,
+        'meters': [{'beat': beat, 'beats_per_bar': beats_per_bar, 'beat_unit': beat_unit}
+                   for beat, beats_per_bar, beat_unit in meters],
+        'keys': [{'beat': 0, 'tonic_pitch_class': 0, 'scale_degree_intervals': [2, 2, 1, 2, 2, 2]}],
+        'melody': [{'onset': onset, 'offset': offset, 'pitch_class': 2 * i % 12, 'octave': 0}
+                   for i, (onset, offset) in enumerate(notes)],
+        'harmony': None,
+        'num_beats': notes[-1][1] + 1,
+    }
+
+def random_song(rng, song_id, exact=False):
+    """
+    A song built to reach the corners of the melody encoders: pickups,
+    meter changes off the barlines, triplets, notes spanning several bars,
+    overlaps, pitches outside the spelled range and missing num_beats.
+    An exact song has neither overlaps nor odd lengths, so its .krn must
+    add up to its onsets and barlines (see written_mismatches).
+    """
+    durations = DURATIONS if exact else DURATIONS + LOSSY_DURATIONS
+    meters = []
+    beat = 0
+    for _ in range(rng.choice([1, 1, 2, 3])):
+        beats_per_bar, beat_unit = rng.choice(METERS)
+        meters.append({'beat': beat, 'beats_per_bar': beats_per_bar, 'beat_unit': beat_unit})
+        beat += rng.choice([2, 4, 6, 8, 12, 5.5])
+    if rng.random() < 0.2:
+        # first meter after the song start, a pickup bar before it
+        meters[0]['beat'] = rng.choice([1, 2])
+    melody = []
+    onset = -rng.choice([0, 0, 0.5, 1, 4 / 3]) if rng.random() < 0.3 else 0
+    for _ in range(rng.randint(0, 40)):
+        onset += rng.choice([0, 0, 0, 0.5, 1, 2 / 3, 3]) if rng.random() < 0.3 else 0
+        duration = rng.choice(durations)
+        melody.append({'onset': onset, 'offset': onset + duration,
+                       'pitch_class': rng.randrange(12) if rng.random() < 0.97 else -1,
+                       'octave': rng.randint(-2, 2) if rng.random() < 0.97 else rng.choice([-12, 11])})
+        # overlapping notes step back now and then
+        onset += duration if exact or rng.random() < 0.95 else -0.5
+    rng.shuffle(melody)
+    end = max([note['offset'] for note in melody], default=0)
+    return {
+        'id': song_id,
+        'meters': meters,
+        'keys': [{'beat': 0, 'tonic_pitch_class': rng.randrange(12),
+                  'scale_degree_intervals': rng.choice([[2, 2, 1, 2, 2, 2], [2, 1, 2, 2, 1, 2]])}],
+        'melody': melody,
+        'harmony': None,
+        'num_beats': None if rng.random() < 0.2 else end + rng.choice([-1, 0, 0.5, 3, 17]),
+    }
+
+def mismatches(songs):
+    '''
+    Ids of the songs whose generate_kern_batch output differs from generate_kern
+    '''
+    songs = [song for song in songs if song.get('melody')]
+    with silenced_warnings():
+        ctxs = [build_song_context(song) for song in songs]
+        batch = generate_kern_batch(songs, ctxs)
+        return [song['id'] for song, ctx, encoded in zip(songs, ctxs, batch)
+                if generate_kern(song, ctx) != encoded]
+
+def check(songs, batch_size=BATCH_SIZE):
+    failed = []
+    for start in range(0, len(songs), batch_size):
+        failed += mismatches(songs[start:start + batch_size])
+    return failed
+
+def written_mismatches(song):
+    """
+    Check that the rhythm values of generate_kern add up: walking the
+    rows, every row starts where the values before it end and every
+    barline falls on the next bar of the meter. Only holds for songs
+    without overlapping notes or odd lengths.
+    Returns:
+        list of descriptions of the rows that do not
+    """
+    with silenced_warnings():
+        ctx = build_song_context(song)
+        lines, onsets = generate_kern(song, ctx)
+    first_onset = min(note['onset'] for note in song['melody'])
+    pos = min(0, round(first_onset * ctx['beat_ticks']))
+    bar_lines = iter_bar_lines(ctx['meter_segments'], pos)
+    bar = next(bar_lines)[0]
+    failed = []
+    for line, onset in zip(lines[5:], onsets):
+        if line.startswith('='):
+            if pos != bar:
+                failed.append(f"{song['id']}: {line} at tick {pos}, bar at {bar}")
+            # meters starting on the same beat close several bars at once
+            while bar <= pos:
+                bar = next(bar_lines)[0]
+        elif not line.startswith('*'):
+            if 'L' in line or 'J' in line:
+                failed.append(f"{song['id']}: triplet group marker in {line}")
+            if pos != onset:
+                failed.append(f"{song['id']}: {line} at tick {pos}, onset {onset}")
+            pos += kern_value_to_ticks(re.match(r'[0-9]+\.?', line).group())
+    return failed
+
+def table_mismatches(rng, samples=20000):
+    """
+    Compare the precomputed tables with the functions they were built
+    from: duration decompositions (in and past the table), kern pitches
+    (in and outside PITCH_TABLE) and chord labels from interval masks.
+    Returns:
+        list of descriptions of the entries that differ
+    """
+    failed = []
+    for ticks in list(range(-2, 2 * DECOMPOSITION_TABLE_TICKS)) + [rng.randrange(10 ** 6) for _ in range(100)]:
+        if decompose_duration(ticks) != _decompose_ticks(max(ticks, 0)):
+            failed.append(f"duration {ticks}")
+    for pc in range(12):
+        for octave in range(-12, 13):
+            for prefer_flats in (False, True):
+                if pitch_class_to_kern(pc, octave, prefer_flats) != _spell_pitch(pc, octave, prefer_flats):
+                    failed.append(f"pitch {pc} {octave} {prefer_flats}")
+    for _ in range(samples):
+        root = rng.randrange(12)
+        intervals = [rng.randint(1, 7) for _ in range(rng.randint(0, 5))]
+        prefer_flats = rng.random() < 0.5
+        expected = root_to_name(root, prefer_flats) + quality_from_pcset(intervals_to_pcset(intervals))
+        if chord_label(root, intervals_to_mask(intervals), prefer_flats) != expected:
+            failed.append(f"chord {root} {intervals}")
+    return failed
+
+def main(source=DEFAULT_SOURCE, generated=DEFAULT_GENERATED, seed=0):
+    """
+    Check that the lookup tables match the functions they replace, and
+    that the batch encoder writes the same melody spines as generate_kern,
+    on the dump and on generated songs.
+    Returns:
+        True if everything matched
+    """
+    rng = random.Random(seed)
+    failed = table_mismatches(rng)
+    print(f"tables: {len(failed)} mismatches{': ' + ', '.join(failed[:10]) if failed else ''}")
+    ok = not failed
+    if source:
+        songs = list(iter_songs(source, splits=None))
+        failed = check(songs)
+        print(f"{source}: {len(songs) - len(failed)}/{len(songs)} songs identical")
+        ok &= not failed
+    songs = [random_song(rng, f"generated-{i}") for i in range(generated)]
+    # small batches too, so batch boundaries fall everywhere
+    failed = check(songs) + check(songs[:200], batch_size=3)
+    print(f"generated (seed {seed}): {generated + 200 - len(failed)}/{generated + 200} songs identical")
+    if failed:
+        print(f"Mismatches: {', '.join(sorted(set(failed))[:10])}")
+    ok &= not failed
+
+    songs = [fixed_song(song_id) for song_id in FIXED_SONGS]
+    songs += [random_song(rng, f"exact-{i}", exact=True) for i in range(generated // 4)]
+    songs = [song for song in songs if song['melody']]
+    failed = check(songs)
+    written = [message for song in songs for message in written_mismatches(song)]
+    print(f"exact songs: {len(songs) - len(failed)}/{len(songs)} identical, "
+          f"{len(written)} rows off their onset or barline")
+    for message in (failed + written)[:10]:
+        print(f"    {message}")
+    return ok and not failed and not written
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Check the lookup tables and the batch melody encoder "
+                                                 "against the per-song converter.")
+    parser.add_argument('--source', default=DEFAULT_SOURCE,
+                        help="dump path relative to the repo root, '' for generated songs only")
+    parser.add_argument('--generated', type=int, default=DEFAULT_GENERATED, help="number of generated songs")
+    parser.add_argument('--seed', type=int, default=0, help="seed of the generated songs")
+    args = parser.parse_args()
+    if not main(args.source, args.generated, args.seed):
+        raise SystemExit(1)
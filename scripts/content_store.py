@@ -0,0 +1,132 @@
+import os
+import json
+import gzip
+import hashlib
+import threading
+from manifest import CONVERTER_VERSION
+
+OBJECTS_DIR = "objects"
+INDEX_NAME = "index.jsonl"
+
+# reference record replacing the spines in a deduplicated .krn file
+BODY_REF = "!!!body: "
+
+def split_record(text):
+    '''
+    (header, body) of a rendered .krn record: the leading !!! lines, then the spines
+    '''
+    pos = 0
+    while text.startswith('!!!', pos):
+        end = text.find('\n', pos)
+        if end < 0:
+            return text, ''
+        pos = end + 1
+    return text[:pos], text[pos:]
+
+def _read(path):
+    if path.endswith('.gz'):
+        with gzip.open(path, 'rt', encoding='utf-8') as f:
+            return f.read()
+    with open(path, 'r', encoding='utf-8') as f:
+        return f.read()
+
+def read_record(path):
+    """
+    Text of a .krn file, with the body of a deduplicated file read back
+    from the object it references.
+    Args:
+        path: absolute path of a .krn or .krn.gz file.
+    """
+    text = _read(path)
+    header, rest = split_record(text)
+    lines = header.splitlines(keepends=True)
+    if lines and lines[-1].startswith(BODY_REF):
+        object_path = os.path.join(os.path.dirname(path), lines[-1][len(BODY_REF):].strip())
+        return "".join(lines[:-1]) + _read(object_path)
+    return text
+
+class ContentStore:
+    """
+    Rendered spines stored once per sha256 under <output_dir>/objects, with
+    an append-only index from payload hashes (manifest.payload_hash) to
+    the body they rendered to.
+    """
+    def __init__(self, output_dir, compress=False):
+        self.output_dir = output_dir
+        self.root = os.path.join(output_dir, OBJECTS_DIR)
+        os.makedirs(self.root, exist_ok=True)
+        self.suffix = ".krn.gz" if compress else ".krn"
+        self.lock = threading.Lock()
+        self.index_path = os.path.join(self.root, INDEX_NAME)
+        self.index = self._load_index()
+        self.index_log = open(self.index_path, 'a', encoding='utf-8')
+
+    def _load_index(self):
+        # later lines win, a line cut short by a crash is ignored
+        index = {}
+        if not os.path.exists(self.index_path):
+            return index
+        with open(self.index_path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                index[entry['payload_hash']] = entry
+        return index
+
+    def relative_path(self, sha):
+        '''
+        Object path relative to the output directory, fanned out by the first two hex digits
+        '''
+        return os.path.join(OBJECTS_DIR, sha[:2], sha + self.suffix)
+
+    def put(self, body):
+        """
+        Store a body unless an identical one is already stored.
+        Returns:
+            (sha256 of the body, bytes written, 0 if it was already stored)
+        """
+        data = body.encode('utf-8')
+        sha = hashlib.sha256(data).hexdigest()
+        path = os.path.join(self.output_dir, self.relative_path(sha))
+        if os.path.exists(path):
+            return sha, 0
+        if self.suffix.endswith('.gz'):
+            data = gzip.compress(data, mtime=0)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # writer threads may store the same body at once, each via its own temp file
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        return sha, len(data)
+
+    def lookup(self, payload_hash):
+        '''
+        sha256 of the body a payload rendered to with this converter, None if unknown
+        '''
+        entry = self.index.get(payload_hash)
+        if entry is None or entry['converter_version'] != CONVERTER_VERSION:
+            return None
+        if not os.path.exists(os.path.join(self.output_dir, self.relative_path(entry['body_sha256']))):
+            return None
+        return entry['body_sha256']
+
+    def remember(self, payload_hash, sha):
+        entry = {'payload_hash': payload_hash, 'body_sha256': sha, 'converter_version': CONVERTER_VERSION}
+        with self.lock:
+            if self.index.get(payload_hash) == entry:
+                return
+            self.index[payload_hash] = entry
+            self.index_log.write(json.dumps(entry, sort_keys=True) + "\n")
+            self.index_log.flush()
+
+    def reference(self, header, sha):
+        '''
+        Text of a deduplicated .krn file: its own header, then the body reference
+        '''
+        return f"{header}{BODY_REF}{self.relative_path(sha)}\n"
+
+    def close(self):
+        self.index_log.close()
@@ -1,4 +1,70 @@
 import os
+from utils import build_song_context, generate_kern, harmony_to_kern, silenced_warnings
+
+CONVERTER_CREDIT = '!!!hooktheory2kern converter by Hongbing Li (Nov 2025)'
+
+def render_header(song):
+    '''
+    Global comment lines with the song infos
+    '''
+    return (
+        f"{CONVERTER_CREDIT}\n"
+        f"!!!song name: {song['title']}\n"
+        f"!!!artist name: {song['artist']}\n"
+        f"!!!hooktheory url: {song['urls']['song']}\n"
+        f"!!!hookpad url: {song['urls']['clip']}\n"
+        f"!!!youtube url: {song['youtube']['url']}\n"
+    )
+
+def render_body(melody_spine, harmony_spine):
+    '''
+    Spine lines, melody and harmony joined by a tab
+    '''
+    if not harmony_spine:
+        # if harmony is None, only the melody spine
+        lines = melody_spine
+    else:
+        lines = map("\t".join, zip(melody_spine, harmony_spine))
+    body = "\n".join(lines)
+    return body + "\n" if body else body
+
+def render_kern(melody_spine, harmony_spine, song):
+    """
+    Render a whole .krn record into one string.
+    Args:
+        melody_spine: melody spine **kern;
+        harmony_spine: harmony spine **mxhm, or None;
+        song: song dict providing the header infos.
+    """
+    return render_header(song) + render_body(melody_spine, harmony_spine)
+
+def convert_song(song):
+    """
+    Convert one song into .krn text, without touching disk or printing
+    (warnings are only counted in utils.warning_counts).
+    Args:
+        song: song dict in the iter_songs shape.
+
+    Returns:
+        str: the .krn record
+
+    Raises:
+        ValueError: if the song has no melody.
+    """
+    if not song.get('melody'):
+        raise ValueError(f"Song {song.get('id')} has no melody")
+    with silenced_warnings():
+        ctx = build_song_context(song)
+        melody_spine, melody_onsets = generate_kern(song, ctx)
+        harmony_spine = harmony_to_kern(song, melody_onsets, ctx)
+    return render_kern(melody_spine, harmony_spine, song)
+
+def convert_many(songs):
+    '''
+    Yield the .krn text of each song in order, None for songs without melody
+    '''
+    for song in songs:
+        yield convert_song(song) if song.get('melody') else None
 
 def write_kern_file(melody_spine, harmony_spine, output_path, song):
     """
@@ -10,38 +76,23 @@ def write_kern_file(melody_spine, harmony_spine, output_path, song):
 
     """
     abs_path = os.path.join(os.path.dirname(__file__), '..', output_path)
+    text = render_kern(melody_spine, harmony_spine, song)
     with open(abs_path, 'w', encoding='utf-8') as f:
-        f.write('!!!hooktheory2kern converter by Hongbing Li (Nov 2025)\n')
-        # infos
-        song_name = song['title']
-        artist_name = song['artist']
-        hook_url = song['urls']['song']
-        hookpad_url = song['urls']['clip']
-        youtube_url = song['youtube']['url']
-        f.write(f"!!!song name: {song_name}\n")
-        f.write(f"!!!artist name: {artist_name}\n")
-        f.write(f"!!!hooktheory url: {hook_url}\n")
-        f.write(f"!!!hookpad url: {hookpad_url}\n")
-        f.write(f"!!!youtube url: {youtube_url}\n")
-        if not harmony_spine:
-            # if harmony is None, only write melody spine
-            print('harmony is None')
-            for m_line in melody_spine:
-                f.write(f"{m_line}\n")
-        else:
-            for m_line, h_line in zip(melody_spine, harmony_spine):
-                f.write(f"{m_line}\t{h_line}\n")
+        f.write(text)
             
 if __name__ == "__main__":
-    from parse_json import load_json, get_train_songs
-    from utils import generate_kern, harmony_to_kern
-    
-    # read data
-    data = load_json("data/Hooktheory.json.gz")
-    songs = get_train_songs(data)
-    # test 1 song
-    song = songs[0]
-    # print(song['melody'])
-    melody_spine = generate_kern(song)
-    harmony_spine = harmony_to_kern(song)
-    write_kern_file(melody_spine, harmony_spine, f"output/{song['title']}.krn")
\ No newline at end of file
+    import sys
+    from record_store import open_store, get_song
+
+    # convert the given song ids, looked up in the record store
+    conn = open_store("data/Hooktheory.json.gz")
+    for song_id in sys.argv[1:]:
+        song = get_song(conn, song_id)
+        if song is None:
+            print(f"Unknown song id: {song_id}")
+            continue
+        ctx = build_song_context(song)
+        melody_spine, melody_onsets = generate_kern(song, ctx)
+        harmony_spine = harmony_to_kern(song, melody_onsets, ctx)
+        write_kern_file(melody_spine, harmony_spine, f"outputs/{song_id}.krn", song)
+        print(f"outputs/{song_id}.krn")
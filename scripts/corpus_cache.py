@@ -0,0 +1,277 @@
+import os
+import json
+import shutil
+import numpy as np
+from parse_json import iter_songs, source_stamp
+from manifest import hash_song, payload_hash
+
+# bump whenever the cache layout changes
+CACHE_VERSION = 2
+
+DEFAULT_SOURCE = "data/Hooktheory.json.gz"
+DEFAULT_CACHE_DIR = "data/cache"
+META_NAME = "meta.json"
+SONGS_NAME = "songs.json"
+
+# column name -> dtype; each group also has a '<group>_offsets' table with
+# one entry per song plus one, and intervals lists have their own offsets
+COLUMNS = {
+    'note_onset': np.float64, 'note_offset': np.float64,
+    'note_pitch_class': np.int16, 'note_octave': np.int16,
+    'chord_onset': np.float64, 'chord_offset': np.float64,
+    'chord_root_pitch_class': np.int16, 'chord_intervals': np.int8,
+    'key_beat': np.float64, 'key_tonic_pitch_class': np.int16, 'key_intervals': np.int8,
+    'meter_beat': np.float64, 'meter_beats_per_bar': np.int16, 'meter_beat_unit': np.int16,
+}
+OFFSET_TABLES = ('note_offsets', 'chord_offsets', 'chord_interval_offsets',
+                 'key_offsets', 'key_interval_offsets', 'meter_offsets')
+
+# per-song fields kept in songs.json instead of columns
+SONG_FIELDS = ('id', 'split', 'title', 'artist', 'urls', 'youtube', 'num_beats')
+
+def _abs_path(path):
+    return os.path.join(os.path.dirname(__file__), '..', path)
+
+def is_fresh(source=DEFAULT_SOURCE, cache_dir=DEFAULT_CACHE_DIR):
+    '''
+    Whether the cache was compiled from the current source with this layout
+    '''
+    try:
+        with open(os.path.join(_abs_path(cache_dir), META_NAME), 'r', encoding='utf-8') as f:
+            meta = json.load(f)
+    except (OSError, json.JSONDecodeError):
+        return False
+    return (meta.get('cache_version') == CACHE_VERSION
+            and {key: meta.get(key) for key in ('source_size', 'source_mtime_ns')} == source_stamp(source))
+
+def compile_cache(source=DEFAULT_SOURCE, cache_dir=DEFAULT_CACHE_DIR):
+    """
+    Parse the whole dump (all splits) once into a columnar cache.
+    Args:
+        source: .json.gz path relative to the repo root;
+        cache_dir: output directory relative to the repo root.
+
+    Returns:
+        the meta dict written to meta.json
+    """
+    stamp = source_stamp(source)
+    abs_dir = _abs_path(cache_dir)
+    if os.path.isdir(abs_dir):
+        shutil.rmtree(abs_dir)
+    os.makedirs(abs_dir)
+
+    columns = {name: [] for name in COLUMNS}
+    offsets = {name: [0] for name in OFFSET_TABLES}
+    songs = []
+    for song in iter_songs(source, splits=None):
+        info = {field: song.get(field) for field in SONG_FIELDS}
+        # what the converter would hash for this record, so manifests stay valid
+        info['input_hash'] = hash_song(song)
+        info['payload_hash'] = payload_hash(song)
+        info['has_melody'] = song['melody'] is not None
+        info['has_harmony'] = song['harmony'] is not None
+        songs.append(info)
+
+        for note in song['melody'] or []:
+            columns['note_onset'].append(note['onset'])
+            columns['note_offset'].append(note['offset'])
+            columns['note_pitch_class'].append(note['pitch_class'])
+            columns['note_octave'].append(note['octave'])
+        offsets['note_offsets'].append(len(columns['note_onset']))
+
+        for chord in song['harmony'] or []:
+            columns['chord_onset'].append(chord['onset'])
+            columns['chord_offset'].append(chord.get('offset', chord['onset']))
+            columns['chord_root_pitch_class'].append(chord.get('root_pitch_class', 0))
+            columns['chord_intervals'].extend(chord.get('root_position_intervals', []))
+            offsets['chord_interval_offsets'].append(len(columns['chord_intervals']))
+        offsets['chord_offsets'].append(len(columns['chord_onset']))
+
+        for key in song['keys'] or []:
+            columns['key_beat'].append(key.get('beat', 0))
+            columns['key_tonic_pitch_class'].append(key.get('tonic_pitch_class', 0))
+            columns['key_intervals'].extend(key.get('scale_degree_intervals', []))
+            offsets['key_interval_offsets'].append(len(columns['key_intervals']))
+        offsets['key_offsets'].append(len(columns['key_beat']))
+
+        for meter in song['meters'] or []:
+            columns['meter_beat'].append(meter.get('beat', 0))
+            columns['meter_beats_per_bar'].append(meter.get('beats_per_bar', 4))
+            columns['meter_beat_unit'].append(meter.get('beat_unit', 4))
+        offsets['meter_offsets'].append(len(columns['meter_beat']))
+
+    for name, dtype in COLUMNS.items():
+        np.save(os.path.join(abs_dir, f"{name}.npy"), np.array(columns[name], dtype=dtype))
+    for name in OFFSET_TABLES:
+        np.save(os.path.join(abs_dir, f"{name}.npy"), np.array(offsets[name], dtype=np.int64))
+    with open(os.path.join(abs_dir, SONGS_NAME), 'w', encoding='utf-8') as f:
+        json.dump(songs, f)
+
+    # meta.json is written last: a cache without it is never used
+    meta = {'cache_version': CACHE_VERSION, 'source': source, **stamp,
+            'songs': len(songs), 'notes': len(columns['note_onset']), 'chords': len(columns['chord_onset'])}
+    with open(os.path.join(abs_dir, META_NAME), 'w', encoding='utf-8') as f:
+        json.dump(meta, f, indent=2)
+    return meta
+
+class NoteColumns:
+    '''
+    List-like view of the notes of one cached song; dicts are only built
+    when notes are indexed or iterated, array consumers use .arrays()
+    '''
+    def __init__(self, cache, start, stop):
+        self.cache = cache
+        self.start = start
+        self.stop = stop
+
+    def __len__(self):
+        return self.stop - self.start
+
+    def arrays(self):
+        '''
+        (onset, offset, pitch_class, octave) slices of the memory-mapped columns
+        '''
+        columns = self.cache.columns
+        return tuple(columns[name][self.start:self.stop]
+                     for name in ('note_onset', 'note_offset', 'note_pitch_class', 'note_octave'))
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError("note index out of range")
+        return self.to_list(i, i + 1)[0]
+
+    def __iter__(self):
+        return iter(self.to_list())
+
+    def to_list(self, start=0, stop=None):
+        stop = len(self) if stop is None else stop
+        onsets, offsets, pitch_classes, octaves = (
+            column[start:stop].tolist() for column in self.arrays())
+        return [{'onset': onset, 'offset': offset, 'pitch_class': pc, 'octave': octave}
+                for onset, offset, pc, octave in zip(onsets, offsets, pitch_classes, octaves)]
+
+    def __reduce__(self):
+        # workers reopen the memory map instead of receiving the notes
+        return (_cached_notes, (self.cache.cache_dir, self.start, self.stop))
+
+_open_caches = {}
+
+def _cached_notes(cache_dir, start, stop):
+    if cache_dir not in _open_caches:
+        _open_caches[cache_dir] = CorpusCache(cache_dir)
+    return NoteColumns(_open_caches[cache_dir], start, stop)
+
+class CorpusCache:
+    """
+    Memory-mapped columnar cache written by compile_cache.
+    """
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR):
+        self.cache_dir = cache_dir
+        abs_dir = _abs_path(cache_dir)
+        with open(os.path.join(abs_dir, META_NAME), 'r', encoding='utf-8') as f:
+            self.meta = json.load(f)
+        with open(os.path.join(abs_dir, SONGS_NAME), 'r', encoding='utf-8') as f:
+            self.songs = json.load(f)
+        self.columns = {
+            name: np.load(os.path.join(abs_dir, f"{name}.npy"), mmap_mode='r')
+            for name in tuple(COLUMNS) + OFFSET_TABLES
+        }
+        # offset tables are small and read for every song
+        for name in OFFSET_TABLES:
+            self.columns[name] = np.array(self.columns[name])
+
+    def __len__(self):
+        return len(self.songs)
+
+    def _rows(self, table, i):
+        offsets = self.columns[table]
+        return int(offsets[i]), int(offsets[i + 1])
+
+    def _column_slices(self, names, start, stop):
+        return [self.columns[name][start:stop].tolist() for name in names]
+
+    def _interval_lists(self, column, table, start, stop):
+        # intervals of rows start..stop, split from one slice of the column
+        bounds = self.columns[table][start:stop + 1]
+        values = self.columns[column][bounds[0]:bounds[-1]].tolist()
+        bounds = (bounds - bounds[0]).tolist()
+        return [values[a:b] for a, b in zip(bounds[:-1], bounds[1:])]
+
+    def harmony(self, i):
+        if not self.songs[i]['has_harmony']:
+            return None
+        start, stop = self._rows('chord_offsets', i)
+        onsets, offsets, roots = self._column_slices(
+            ('chord_onset', 'chord_offset', 'chord_root_pitch_class'), start, stop)
+        intervals = self._interval_lists('chord_intervals', 'chord_interval_offsets', start, stop)
+        return [{'onset': onset, 'offset': offset, 'root_pitch_class': root, 'root_position_intervals': ivs}
+                for onset, offset, root, ivs in zip(onsets, offsets, roots, intervals)]
+
+    def keys(self, i):
+        start, stop = self._rows('key_offsets', i)
+        beats, tonics = self._column_slices(('key_beat', 'key_tonic_pitch_class'), start, stop)
+        intervals = self._interval_lists('key_intervals', 'key_interval_offsets', start, stop)
+        return [{'beat': beat, 'tonic_pitch_class': tonic, 'scale_degree_intervals': ivs}
+                for beat, tonic, ivs in zip(beats, tonics, intervals)]
+
+    def meters(self, i):
+        start, stop = self._rows('meter_offsets', i)
+        beats, beats_per_bar, beat_units = self._column_slices(
+            ('meter_beat', 'meter_beats_per_bar', 'meter_beat_unit'), start, stop)
+        return [{'beat': beat, 'beats_per_bar': bpb, 'beat_unit': unit}
+                for beat, bpb, unit in zip(beats, beats_per_bar, beat_units)]
+
+    def song(self, i):
+        """
+        Song i in the iter_songs shape; the melody is a NoteColumns view and
+        'input_hash' and 'payload_hash' hold the manifest hashes of the
+        source record.
+        """
+        info = self.songs[i]
+        song = {field: info[field] for field in SONG_FIELDS}
+        song['input_hash'] = info['input_hash']
+        song['payload_hash'] = info['payload_hash']
+        song['meters'] = self.meters(i)
+        song['keys'] = self.keys(i)
+        song['harmony'] = self.harmony(i)
+        song['melody'] = NoteColumns(self, *self._rows('note_offsets', i)) if info['has_melody'] else None
+        return song
+
+    def iter_songs(self, splits=('TRAIN',), select=None):
+        '''
+        Songs of the given splits (None keeps all) accepted by select(song_id),
+        like parse_json.iter_songs; rejected songs are never loaded
+        '''
+        if isinstance(splits, str):
+            splits = (splits,)
+        for i, info in enumerate(self.songs):
+            if splits is not None and info['split'] not in splits:
+                continue
+            if select is None or select(info['id']):
+                yield self.song(i)
+
+def open_cache(source=DEFAULT_SOURCE, cache_dir=DEFAULT_CACHE_DIR):
+    '''
+    Open the cache, compiling it first if it is missing or the source changed
+    '''
+    if not is_fresh(source, cache_dir):
+        print(f"Compiling {source} into {cache_dir}...")
+        compile_cache(source, cache_dir)
+    return CorpusCache(cache_dir)
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Compile the Hooktheory dump into a columnar cache.")
+    parser.add_argument('--source', default=DEFAULT_SOURCE, help="dump path relative to the repo root")
+    parser.add_argument('--cache-dir', default=DEFAULT_CACHE_DIR, help="cache directory relative to the repo root")
+    parser.add_argument('--force', action='store_true', help="recompile even if the cache is fresh")
+    args = parser.parse_args()
+    if args.force or not is_fresh(args.source, args.cache_dir):
+        meta = compile_cache(args.source, args.cache_dir)
+        print(f"Cached {meta['songs']} songs, {meta['notes']} notes, {meta['chords']} chords.")
+    else:
+        print("Cache is up to date.")
@@ -0,0 +1,85 @@
+import json
+from collections import Counter, defaultdict
+
+# example songs kept per warning kind, and most frequent values listed per kind
+MAX_EXAMPLES = 10
+MAX_VALUES = 20
+
+class Diagnostics:
+    """
+    Data-quality report of a run: warnings counted by kind, by value and by
+    song, with a few example songs per kind.
+    Each song's (kind, value) list is added in the main process (map);
+    reports of separate runs or shards combine with merge (reduce).
+    """
+    def __init__(self, max_examples=MAX_EXAMPLES):
+        self.max_examples = max_examples
+        self.counts = Counter()           # kind -> warnings
+        self.songs = Counter()            # kind -> songs with the warning
+        self.values = defaultdict(Counter)  # kind -> value -> warnings
+        self.examples = defaultdict(list)   # kind -> [(song_id, value)]
+
+    def add_song(self, song_id, warnings):
+        '''
+        Add the (kind, value) warnings of one song
+        '''
+        seen = set()
+        for kind, value in warnings:
+            self.counts[kind] += 1
+            self.values[kind][value] += 1
+            if kind not in seen:
+                seen.add(kind)
+                self.songs[kind] += 1
+                if len(self.examples[kind]) < self.max_examples:
+                    self.examples[kind].append((song_id, value))
+
+    def merge(self, other):
+        self.counts.update(other.counts)
+        self.songs.update(other.songs)
+        for kind, values in other.values.items():
+            self.values[kind].update(values)
+        for kind, examples in other.examples.items():
+            room = self.max_examples - len(self.examples[kind])
+            self.examples[kind].extend(examples[:max(room, 0)])
+        return self
+
+    def to_dict(self):
+        return {
+            kind: {
+                'warnings': self.counts[kind],
+                'songs': self.songs[kind],
+                # values as strings, None stays null
+                'top_values': [[None if value is None else str(value), count]
+                               for value, count in self.values[kind].most_common(MAX_VALUES)],
+                'distinct_values': len(self.values[kind]),
+                'examples': [{'id': song_id, 'value': value} for song_id, value in self.examples[kind]],
+            }
+            for kind in sorted(self.counts)
+        }
+
+    @classmethod
+    def from_dict(cls, report, max_examples=MAX_EXAMPLES):
+        '''
+        Rebuild a report written by write(); only the top values survive
+        '''
+        diagnostics = cls(max_examples)
+        for kind, entry in report.items():
+            diagnostics.counts[kind] = entry['warnings']
+            diagnostics.songs[kind] = entry['songs']
+            diagnostics.values[kind] = Counter({value: count for value, count in entry['top_values']})
+            diagnostics.examples[kind] = [(e['id'], e['value']) for e in entry['examples']]
+        return diagnostics
+
+    def write(self, path):
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(self.to_dict(), f, indent=2)
+
+    def summary(self):
+        '''
+        One line per kind, e.g. "unknown_mode: 12 in 12 songs (top: '[2, 1]' x7)"
+        '''
+        lines = []
+        for kind in sorted(self.counts):
+            top = ", ".join(f"{value!r} x{count}" for value, count in self.values[kind].most_common(3))
+            lines.append(f"{kind}: {self.counts[kind]} in {self.songs[kind]} songs (top: {top})")
+        return lines
@@ -0,0 +1,249 @@
+import io
+import csv
+import struct
+from utils import (TICKS_PER_QUARTER, build_song_context, generate_kern, chord_anchors,
+                   anchored_spine, harmony_to_kern, pitch_class_to_kern, intervals_to_mask,
+                   CHORD_QUALITIES)
+from convert_to_kern import render_kern
+
+# analysis shared by all emitters of a song
+def analyze_song(song, ctx=None, melody=None):
+    """
+    Run the converter's analysis of one song once for every output format.
+    Args:
+        song: song dict in the iter_songs shape, with a melody;
+        ctx: song context from build_song_context, built here if omitted;
+        melody: (melody_spine, melody_onsets) from generate_kern (or the
+            batch encoder), generated here if omitted.
+
+    Returns:
+        dict with song, ctx, melody_spine, melody_onsets, anchors
+        (chord_anchors) and harmony_spine (None without harmony)
+    """
+    if ctx is None:
+        ctx = build_song_context(song)
+    melody_spine, melody_onsets = melody if melody is not None else generate_kern(song, ctx)
+    anchors = chord_anchors(song, melody_onsets, ctx)
+    return {
+        'song': song,
+        'ctx': ctx,
+        'melody_spine': melody_spine,
+        'melody_onsets': melody_onsets,
+        'anchors': anchors,
+        'harmony_spine': harmony_to_kern(song, melody_onsets, ctx, anchors),
+    }
+
+def note_events(analysis):
+    '''
+    (onset tick, offset tick, pitch_class, octave, kern pitch) of each note
+    in onset order, rounded to ticks like the melody spine; cached
+    '''
+    if 'notes' not in analysis:
+        beat_ticks = analysis['ctx']['beat_ticks']
+        prefer_flats = analysis['ctx']['prefer_flats']
+        analysis['notes'] = [
+            (round(note['onset'] * beat_ticks), round(note['offset'] * beat_ticks),
+             note['pitch_class'], note['octave'],
+             pitch_class_to_kern(note['pitch_class'], note['octave'], prefer_flats))
+            for note in sorted(analysis['song']['melody'], key=lambda x: x['onset'])
+        ]
+    return analysis['notes']
+
+# **kern + **mxhm, as written by run_all
+def emit_kern(analysis):
+    return render_kern(analysis['melody_spine'], analysis['harmony_spine'], analysis['song'])
+
+# **kern + **harm
+ROMAN_DEGREES = ('I', 'II', 'III', 'IV', 'V', 'VI', 'VII')
+MAJOR_SCALE = [2, 2, 1, 2, 2, 2]
+
+# chord quality -> (lower-case numeral, quality sign, figure)
+ROMAN_QUALITIES = {
+    '': (False, '', ''), 'm': (True, '', ''), 'dim': (True, 'o', ''), 'aug': (False, '+', ''),
+    '5': (False, '', '5'), 'sus2': (False, '', 'sus2'), 'sus4': (False, '', 'sus4'),
+    '7sus4': (False, '', '7sus4'), '7sus2': (False, '', '7sus2'),
+    'add9': (False, '', 'add9'), 'm(add9)': (True, '', 'add9'),
+    'add11': (False, '', 'add11'), 'm(add11)': (True, '', 'add11'),
+    '6': (False, '', 'add6'), 'm6': (True, '', 'add6'),
+    '6/9': (False, '', 'add69'), 'm6/9': (True, '', 'add69'),
+    '7': (False, '', '7'), 'maj7': (False, '', 'M7'), 'm7': (True, '', '7'),
+    'm7b5': (True, 'ø', '7'), 'dim7': (True, 'o', '7'), 'm(maj7)': (True, '', 'M7'),
+    '7(#5)': (False, '+', '7'), '7(#5,b9)': (False, '+', '7b9'), '7(b9)': (False, '', '7b9'),
+}
+
+def scale_degree_pcs(key):
+    '''
+    Pitch classes of the seven scale degrees above the tonic (major if unknown)
+    '''
+    intervals = key.get('scale_degree_intervals') or MAJOR_SCALE
+    pcs = [0]
+    for step in intervals[:6]:
+        pcs.append((pcs[-1] + step) % 12)
+    return pcs
+
+def roman_numeral(root_pc, mask, tonic_pc, degree_pcs):
+    """
+    Roman numeral of a chord in a key, e.g. 'V7', 'ii', '-VII', 'viio'.
+    Args:
+        root_pc: chord root pitch class;
+        mask: pitch-class mask from intervals_to_mask;
+        tonic_pc: tonic pitch class of the key;
+        degree_pcs: scale_degree_pcs() of the key.
+    """
+    interval = (int(root_pc) - tonic_pc) % 12
+    if interval in degree_pcs:
+        degree = ROMAN_DEGREES[degree_pcs.index(interval)]
+    elif (interval + 1) % 12 in degree_pcs:
+        degree = '-' + ROMAN_DEGREES[degree_pcs.index((interval + 1) % 12)]
+    elif (interval - 1) % 12 in degree_pcs:
+        degree = '#' + ROMAN_DEGREES[degree_pcs.index((interval - 1) % 12)]
+    else:
+        degree = '?'
+    lower, sign, figure = ROMAN_QUALITIES[CHORD_QUALITIES[mask]]
+    return (degree.lower() if lower else degree) + sign + figure
+
+def harm_spine(analysis):
+    '''
+    **harm spine aligned with the melody, chords as Roman numerals of the first key
+    '''
+    anchors = analysis['anchors']
+    key = (analysis['song'].get('keys') or [{}])[0]
+    tonic_pc = key.get('tonic_pitch_class', 0)
+    degree_pcs = scale_degree_pcs(key)
+    numerals = [roman_numeral(chord.get('root_pitch_class', 0),
+                              intervals_to_mask(chord.get('root_position_intervals', [])),
+                              tonic_pc, degree_pcs)
+                for chord, _, _, _ in anchors]
+    header = ["**harm", "*", "*", f"*{analysis['ctx']['tonic']}:", "*"]
+    return header + anchored_spine(analysis['melody_onsets'], anchors, numerals) + ["*-"]
+
+def emit_harm(analysis):
+    if analysis['harmony_spine'] is None:
+        return None
+    return render_kern(analysis['melody_spine'], harm_spine(analysis), analysis['song'])
+
+# flat note list
+CSV_COLUMNS = ('onset', 'offset', 'pitch_class', 'octave', 'midi', 'kern', 'chord')
+
+def emit_csv(analysis):
+    '''
+    One row per note: onset and offset in beats (on the tick grid), pitch,
+    and the chord label sounding at the onset
+    '''
+    beat_ticks = analysis['ctx']['beat_ticks']
+    chords = sorted(((onset, label) for _, onset, label, _ in analysis['anchors']), key=lambda c: c[0])
+    out = io.StringIO()
+    writer = csv.writer(out, lineterminator='\n')
+    writer.writerow(CSV_COLUMNS)
+    i, label = 0, ''
+    for onset, offset, pc, octave, kern_pitch in note_events(analysis):
+        while i < len(chords) and chords[i][0] <= onset:
+            label = chords[i][1]
+            i += 1
+        writer.writerow((onset / beat_ticks, offset / beat_ticks, pc, octave,
+                         midi_pitch(pc, octave), kern_pitch, label))
+    return out.getvalue()
+
+# standard MIDI file, format 1, one tick per converter tick
+MIDI_PPQ = TICKS_PER_QUARTER
+# octave 0 of the annotations is the middle C octave
+MIDDLE_C = 60
+CHORD_ROOT = 48
+MELODY_CHANNEL, CHORD_CHANNEL = 0, 1
+MELODY_VELOCITY, CHORD_VELOCITY = 90, 64
+# the annotations carry no tempo, MIDI's default of 120 bpm is written explicitly
+DEFAULT_TEMPO = 500000
+
+def midi_pitch(pitch_class, octave):
+    return MIDDLE_C + 12 * int(octave) + int(pitch_class)
+
+def _var_len(value):
+    data = [value & 0x7F]
+    value >>= 7
+    while value:
+        data.append(0x80 | (value & 0x7F))
+        value >>= 7
+    return bytes(reversed(data))
+
+def _meta(kind, data):
+    return b'\xff' + bytes([kind]) + _var_len(len(data)) + data
+
+def _track(events):
+    '''
+    MTrk chunk from (tick, order, message) events; at equal ticks meta
+    events come first, then note offs, then note ons
+    '''
+    data = bytearray()
+    tick = 0
+    for event_tick, _, message in sorted(events, key=lambda e: (e[0], e[1])):
+        data += _var_len(event_tick - tick) + message
+        tick = event_tick
+    data += b'\x00' + _meta(0x2F, b'')
+    return b'MTrk' + struct.pack('>I', len(data)) + bytes(data)
+
+def _notes(notes, channel, velocity, shift):
+    events = []
+    for onset, offset, pitch in notes:
+        if offset <= onset or not 0 <= pitch < 128:
+            continue
+        events.append((onset + shift, 2, bytes([0x90 | channel, pitch, velocity])))
+        events.append((offset + shift, 1, bytes([0x80 | channel, pitch, 0])))
+    return events
+
+def emit_midi(analysis):
+    '''
+    Conductor track (tempo, meters, key), melody track and, with harmony,
+    a chord track with the labels as markers; pickups start at tick 0
+    '''
+    ctx = analysis['ctx']
+    beat_ticks = ctx['beat_ticks']
+    notes = note_events(analysis)
+    chords = [(onset, round(chord.get('offset', chord['onset']) * beat_ticks), label, chord)
+              for chord, onset, label, _ in analysis['anchors']]
+    shift = -min([0] + [onset for onset, *_ in notes] + [onset for onset, *_ in chords])
+
+    conductor = [(0, 0, _meta(0x51, DEFAULT_TEMPO.to_bytes(3, 'big')))]
+    for start, beats_per_bar, beat_unit, _ in ctx['meter_segments']:
+        conductor.append((max(start + shift, 0), 0,
+                          _meta(0x58, bytes([beats_per_bar, beat_unit.bit_length() - 1, 24, 8]))))
+    signature = ctx['signature']
+    sharps = signature.count('#') - signature.count('-')
+    conductor.append((0, 0, _meta(0x59, struct.pack('>bB', sharps, ctx['mode'] == 'minor'))))
+    tracks = [_track(conductor)]
+
+    melody = [(0, 0, _meta(0x03, b'Melody'))]
+    melody += _notes([(onset, offset, midi_pitch(pc, octave)) for onset, offset, pc, octave, _ in notes],
+                     MELODY_CHANNEL, MELODY_VELOCITY, shift)
+    tracks.append(_track(melody))
+
+    if analysis['harmony_spine'] is not None:
+        harmony = [(0, 0, _meta(0x03, b'Chords'))]
+        for onset, offset, label, chord in chords:
+            harmony.append((onset + shift, 0, _meta(0x06, label.encode('utf-8'))))
+            pitch = CHORD_ROOT + int(chord.get('root_pitch_class', 0)) % 12
+            pitches = [pitch]
+            for step in chord.get('root_position_intervals', []):
+                pitch += int(step)
+                pitches.append(pitch)
+            harmony += _notes([(onset, offset, p) for p in pitches], CHORD_CHANNEL, CHORD_VELOCITY, shift)
+        tracks.append(_track(harmony))
+
+    header = b'MThd' + struct.pack('>IHHH', 6, 1, len(tracks), MIDI_PPQ)
+    return header + b''.join(tracks)
+
+# format -> (file suffix, emitter); an emitter returns str, bytes or None (nothing to write)
+EMITTERS = {
+    'kern': ('.krn', emit_kern),
+    'harm': ('.harm.krn', emit_harm),
+    'csv': ('.csv', emit_csv),
+    'midi': ('.mid', emit_midi),
+}
+
+# formats written next to the .krn with run_all --formats
+EXTRA_FORMATS = tuple(fmt for fmt in EMITTERS if fmt != 'kern')
+
+def emit(analysis, formats):
+    '''
+    {format: output} of every requested format from one analysis
+    '''
+    return {fmt: EMITTERS[fmt][1](analysis) for fmt in formats}
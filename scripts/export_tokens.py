@@ -0,0 +1,199 @@
+import os
+import sys
+import json
+import traceback
+from array import array
+from itertools import islice
+from multiprocessing import Pool
+import numpy as np
+from parse_json import iter_songs
+from utils import build_song_context, generate_kern, harmony_to_kern, silenced_warnings
+from manifest import CONVERTER_VERSION
+from budgets import DEFAULT_BUDGET, BudgetExceeded
+from pipeline import iter_pool_results
+
+DEFAULT_SOURCE = "data/Hooktheory.json.gz"
+DEFAULT_OUTPUT_DIR = "outputs/tokens"
+SPLITS = ('TRAIN', 'VALID', 'TEST')
+VOCAB_NAME = "vocab.json"
+# one column per spine, in .krn order
+COLUMNS = ('**kern', '**mxhm')
+# token 0 fills the harmony column of songs without harmony
+NO_SPINE = ""
+# songs sent to a worker per task with --workers
+CHUNK_SIZE = 64
+
+def song_spines(song, budget=DEFAULT_BUDGET):
+    """
+    Spine tokens of one song, exactly as the .krn body lines hold them.
+    Args:
+        song: song dict from iter_songs;
+        budget: budgets.Budget of the song.
+
+    Returns:
+        (id, split, melody_spine, harmony_spine or None, status, message)
+        with status 'ok', 'skipped' (no melody), 'quarantined' or 'error'
+        (spines are then None, message tells why)
+    """
+    if not song.get('melody'):
+        return song['id'], song['split'], None, None, 'skipped', None
+    try:
+        with budget.cpu_limit(), silenced_warnings():
+            budget.check_input(song)
+            ctx = build_song_context(song)
+            melody_spine, melody_onsets = generate_kern(song, ctx)
+            harmony_spine = harmony_to_kern(song, melody_onsets, ctx)
+    except BudgetExceeded as e:
+        return song['id'], song['split'], None, None, 'quarantined', str(e)
+    except Exception:
+        # one bad record must not abort the export, as in run_all.process_song
+        return song['id'], song['split'], None, None, 'error', traceback.format_exc()
+    return song['id'], song['split'], melody_spine, harmony_spine, 'ok', None
+
+def spines_chunk(songs):
+    return [song_spines(song) for song in songs]
+
+def iter_chunks(songs, size):
+    songs = iter(songs)
+    while True:
+        chunk = list(islice(songs, size))
+        if not chunk:
+            return
+        yield chunk
+
+class TokenVocab:
+    """
+    Spine token <-> id, ids given in order of first appearance.
+    """
+    def __init__(self, tokens=(NO_SPINE,)):
+        self.tokens = list(tokens)
+        self.ids = {token: i for i, token in enumerate(self.tokens)}
+
+    def __len__(self):
+        return len(self.tokens)
+
+    def encode(self, spine):
+        ids = self.ids
+        encoded = []
+        for token in spine:
+            token_id = ids.get(token)
+            if token_id is None:
+                token_id = ids[token] = len(self.tokens)
+                self.tokens.append(token)
+            encoded.append(token_id)
+        return encoded
+
+class SplitTokens:
+    """
+    Token rows of the songs of one split, one (kern, mxhm) row per .krn
+    body line, with per-song row offsets.
+    """
+    def __init__(self):
+        self.rows = array('I')
+        self.offsets = [0]
+        self.ids = []
+
+    def add(self, song_id, melody_ids, harmony_ids):
+        if harmony_ids is None:
+            harmony_ids = [0] * len(melody_ids)
+        for pair in zip(melody_ids, harmony_ids):
+            self.rows.extend(pair)
+        self.offsets.append(len(self.rows) // len(COLUMNS))
+        self.ids.append(song_id)
+
+    def save(self, output_dir, split, dtype):
+        rows = np.frombuffer(self.rows, dtype=np.uint32).reshape(-1, len(COLUMNS)).astype(dtype)
+        np.save(os.path.join(output_dir, f"{split}.npy"), rows)
+        np.save(os.path.join(output_dir, f"{split}.offsets.npy"), np.array(self.offsets, dtype=np.int64))
+        with open(os.path.join(output_dir, f"{split}.ids.json"), 'w', encoding='utf-8') as f:
+            json.dump(self.ids, f)
+
+def export_tokens(source=DEFAULT_SOURCE, output_dir=DEFAULT_OUTPUT_DIR, splits=SPLITS, workers=1):
+    """
+    Convert songs straight into token id arrays, without writing or
+    re-reading .krn text.
+    Per split, <split>.npy holds a (rows, 2) array with the ids of the
+    **kern and **mxhm tokens of every body line (the lines after the !!!
+    records) of every song, <split>.offsets.npy the first row of each song
+    plus the total, and <split>.ids.json the song ids; vocab.json maps ids
+    back to tokens. The arrays can be opened with np.load(mmap_mode='r').
+    Args:
+        source: dump path relative to the repo root;
+        output_dir: directory relative to the repo root;
+        splits: splits to export;
+        workers: processes computing the spines, 1 converts in-process.
+
+    Returns:
+        {split: {status: songs}}
+    """
+    abs_dir = os.path.join(os.path.dirname(__file__), '..', output_dir)
+    os.makedirs(abs_dir, exist_ok=True)
+    vocab = TokenVocab()
+    tokens = {split: SplitTokens() for split in splits}
+    counts = {split: {'ok': 0, 'skipped': 0, 'quarantined': 0, 'error': 0} for split in splits}
+
+    chunks = iter_chunks(iter_songs(source, splits=splits), CHUNK_SIZE)
+    pool = Pool(workers) if workers > 1 else None
+    try:
+        results = iter_pool_results(pool, spines_chunk, chunks, workers) if pool else map(spines_chunk, chunks)
+        for chunk in results:
+            for song_id, split, melody_spine, harmony_spine, status, message in chunk:
+                counts[split][status] += 1
+                if status == 'ok':
+                    tokens[split].add(song_id, vocab.encode(melody_spine),
+                                      None if harmony_spine is None else vocab.encode(harmony_spine))
+                elif status == 'error':
+                    print(f"Error in {song_id}:\n{message}", file=sys.stderr)
+    finally:
+        if pool:
+            # every result is read on success; on an exception this stops the workers mid-queue
+            pool.terminate()
+            pool.join()
+
+    # ids are known only once every split is read, all splits share one dtype
+    dtype = np.uint16 if len(vocab) <= np.iinfo(np.uint16).max + 1 else np.uint32
+    for split in splits:
+        tokens[split].save(abs_dir, split, dtype)
+    with open(os.path.join(abs_dir, VOCAB_NAME), 'w', encoding='utf-8') as f:
+        json.dump({'converter_version': CONVERTER_VERSION, 'columns': COLUMNS,
+                   'dtype': np.dtype(dtype).name, 'tokens': vocab.tokens}, f, indent=1)
+    return counts
+
+def load_tokens(split, output_dir=DEFAULT_OUTPUT_DIR):
+    '''
+    (rows, offsets, song ids, vocab tokens) of an exported split, rows memory-mapped
+    '''
+    abs_dir = os.path.join(os.path.dirname(__file__), '..', output_dir)
+    rows = np.load(os.path.join(abs_dir, f"{split}.npy"), mmap_mode='r')
+    offsets = np.load(os.path.join(abs_dir, f"{split}.offsets.npy"))
+    with open(os.path.join(abs_dir, f"{split}.ids.json"), 'r', encoding='utf-8') as f:
+        ids = json.load(f)
+    with open(os.path.join(abs_dir, VOCAB_NAME), 'r', encoding='utf-8') as f:
+        vocab = json.load(f)['tokens']
+    return rows, offsets, ids, vocab
+
+def song_lines(rows, offsets, i, vocab):
+    '''
+    .krn body lines of the i-th song of a split, back from its token rows
+    '''
+    lines = []
+    for melody_id, harmony_id in rows[offsets[i]:offsets[i + 1]]:
+        line = vocab[melody_id]
+        if harmony_id:
+            line += "\t" + vocab[harmony_id]
+        lines.append(line)
+    return lines
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Export songs as integer token arrays for model training.")
+    parser.add_argument('--source', default=DEFAULT_SOURCE, help="dump path relative to the repo root")
+    parser.add_argument('--output-dir', default=DEFAULT_OUTPUT_DIR, help="directory relative to the repo root")
+    parser.add_argument('--splits', nargs='+', default=SPLITS, help="splits to export")
+    parser.add_argument('--workers', type=int, default=1, help="number of worker processes")
+    args = parser.parse_args()
+    counts = export_tokens(args.source, args.output_dir, args.splits, args.workers)
+    for split, statuses in counts.items():
+        print(f"{split}: {statuses['ok']} songs, {statuses['skipped']} skipped, "
+              f"{statuses['quarantined']} quarantined, {statuses['error']} errors")
+    print(f"Tokens written to {args.output_dir}/")
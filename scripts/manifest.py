@@ -0,0 +1,115 @@
+import os
+import json
+import hashlib
+
+# bump whenever a change in utils/convert_to_kern alters the .krn output
+CONVERTER_VERSION = 5
+
+MANIFEST_NAME = "manifest.jsonl"
+
+# song fields that end up in the .krn file
+HASHED_FIELDS = ("title", "artist", "urls", "youtube", "meters", "keys",
+                 "melody", "harmony", "num_beats")
+# song fields that end up in the spines, i.e. everything but the header
+PAYLOAD_FIELDS = ("meters", "keys", "melody", "harmony", "num_beats")
+
+def _hash_fields(song, fields):
+    payload = {field: song.get(field) for field in fields}
+    text = json.dumps(payload, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+def hash_song(song):
+    '''
+    Stable hash of the song fields the converter reads (songs from the
+    corpus cache carry the hash of their source record)
+    '''
+    if 'input_hash' in song:
+        return song['input_hash']
+    return _hash_fields(song, HASHED_FIELDS)
+
+def payload_hash(song):
+    '''
+    Stable hash of the annotations only: songs with equal payload hashes
+    render to identical spines (cached songs carry it like input_hash)
+    '''
+    if 'payload_hash' in song:
+        return song['payload_hash']
+    return _hash_fields(song, PAYLOAD_FIELDS)
+
+def checksum_file(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 16), b''):
+            h.update(block)
+    return h.hexdigest()
+
+def manifest_path(output_dir, name=MANIFEST_NAME):
+    abs_dir = os.path.join(os.path.dirname(__file__), '..', output_dir)
+    return os.path.join(abs_dir, name)
+
+def load_manifest(path):
+    """
+    Read a manifest into {song_id: entry}.
+    The file is append-only, so later lines win; a line cut short by a
+    crash is ignored.
+    """
+    entries = {}
+    if not os.path.exists(path):
+        return entries
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            entries[entry['id']] = entry
+    return entries
+
+def save_manifest(path, entries):
+    '''
+    Rewrite the manifest with one line per song (atomic replace)
+    '''
+    tmp_path = path + ".tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        for song_id in sorted(entries):
+            f.write(json.dumps(entries[song_id], sort_keys=True) + "\n")
+    os.replace(tmp_path, path)
+
+def make_entry(song_id, input_hash, status, checksum=None, size=None, formats=()):
+    return {
+        "id": song_id,
+        "input_hash": input_hash,
+        "converter_version": CONVERTER_VERSION,
+        "status": status,
+        "output_sha256": checksum,
+        "output_size": size,
+        "formats": sorted(formats),
+    }
+
+def is_up_to_date(entry, input_hash, output_path, verify=False, formats=()):
+    """
+    Check whether a song can be skipped.
+    Args:
+        entry: manifest entry of the song, or None;
+        input_hash: hash_song() of the current record;
+        output_path: absolute path of the .krn file;
+        verify: compare the full checksum instead of only the file size;
+        formats: extra formats the song must have been written in.
+    """
+    if entry is None:
+        return False
+    if entry.get('input_hash') != input_hash or entry.get('converter_version') != CONVERTER_VERSION:
+        return False
+    if not set(formats) <= set(entry.get('formats', ())):
+        return False
+    if entry.get('status') == 'skipped':
+        return True
+    try:
+        size = os.path.getsize(output_path)
+    except OSError:
+        return False
+    if size != entry.get('output_size'):
+        return False
+    if verify:
+        return checksum_file(output_path) == entry.get('output_sha256')
+    return True
@@ -0,0 +1,134 @@
+import json
+import time
+import heapq
+
+# barlines are placed during the melody stage
+STAGES = ('load', 'melody', 'harmony', 'write')
+COUNTERS = ('notes', 'rests', 'chords', 'warnings')
+
+def timed_iter(iterable, metrics, stage='load'):
+    '''
+    Charge the time spent producing each item to a stage
+    '''
+    iterator = iter(iterable)
+    clock = time.perf_counter
+    while True:
+        t0 = clock()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            metrics.add_time(stage, clock() - t0)
+            return
+        metrics.add_time(stage, clock() - t0)
+        yield item
+
+class RunMetrics:
+    """
+    Wall time per stage, event counts and the slowest songs of a run.
+    """
+    def __init__(self, slowest=20):
+        self.start = time.perf_counter()
+        self.stage_seconds = dict.fromkeys(STAGES, 0.0)
+        self.counts = dict.fromkeys(COUNTERS, 0)
+        self.statuses = {}
+        self.slowest_n = slowest
+        self._slowest = []  # min-heap of (seconds, song_id)
+
+    def add_time(self, stage, seconds):
+        self.stage_seconds[stage] += seconds
+
+    def add_song(self, song_id, status, timings=None, counts=None):
+        """
+        Record a finished song.
+        Args:
+            timings: {stage: seconds} measured while converting it;
+            counts: {counter: value} for the song.
+        """
+        self.statuses[status] = self.statuses.get(status, 0) + 1
+        for stage, seconds in (timings or {}).items():
+            self.stage_seconds[stage] += seconds
+        for name, value in (counts or {}).items():
+            self.counts[name] += value
+        if timings:
+            item = (sum(timings.values()), song_id)
+            if len(self._slowest) < self.slowest_n:
+                heapq.heappush(self._slowest, item)
+            elif item > self._slowest[0]:
+                heapq.heapreplace(self._slowest, item)
+
+    @property
+    def songs(self):
+        return sum(self.statuses.values())
+
+    def to_dict(self):
+        elapsed = time.perf_counter() - self.start
+        return {
+            'elapsed_seconds': elapsed,
+            'songs': self.songs,
+            'statuses': self.statuses,
+            'songs_per_second': self.songs / elapsed if elapsed else None,
+            'notes_per_second': self.counts['notes'] / elapsed if elapsed else None,
+            'stage_seconds': self.stage_seconds,
+            'counts': self.counts,
+            'slowest_songs': [
+                {'id': song_id, 'seconds': seconds}
+                for seconds, song_id in sorted(self._slowest, reverse=True)
+            ],
+        }
+
+    def write(self, path):
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(self.to_dict(), f, indent=2)
+
+def merge_metrics(reports):
+    """
+    Combine metrics written by runs in parallel (e.g. one per shard).
+    Times and counts add up; the wall time is the longest run, so rates
+    are for the whole corpus.
+    Args:
+        reports: list of RunMetrics.to_dict() dicts.
+    """
+    elapsed = max((report['elapsed_seconds'] for report in reports), default=0.0)
+    statuses, stage_seconds, counts = {}, dict.fromkeys(STAGES, 0.0), dict.fromkeys(COUNTERS, 0)
+    slowest = []
+    for report in reports:
+        for status, value in report['statuses'].items():
+            statuses[status] = statuses.get(status, 0) + value
+        for stage, seconds in report['stage_seconds'].items():
+            stage_seconds[stage] = stage_seconds.get(stage, 0.0) + seconds
+        for name, value in report['counts'].items():
+            counts[name] = counts.get(name, 0) + value
+        slowest.extend(report['slowest_songs'])
+    songs = sum(statuses.values())
+    slowest_n = max((len(report['slowest_songs']) for report in reports), default=0)
+    return {
+        'elapsed_seconds': elapsed,
+        'runs': len(reports),
+        'songs': songs,
+        'statuses': statuses,
+        'songs_per_second': songs / elapsed if elapsed else None,
+        'notes_per_second': counts['notes'] / elapsed if elapsed else None,
+        'stage_seconds': stage_seconds,
+        'counts': counts,
+        'slowest_songs': sorted(slowest, key=lambda s: s['seconds'], reverse=True)[:slowest_n],
+    }
+
+class ProgressReporter:
+    '''
+    Print a progress line at most once every `interval` seconds
+    '''
+    def __init__(self, metrics, interval=5.0):
+        self.metrics = metrics
+        self.interval = interval
+        self.last = time.perf_counter()
+
+    def update(self, force=False):
+        now = time.perf_counter()
+        if not force and now - self.last < self.interval:
+            return
+        self.last = now
+        elapsed = now - self.metrics.start
+        songs = self.metrics.songs
+        rate = songs / elapsed if elapsed else 0.0
+        print(f"{songs} songs in {elapsed:.1f}s ({rate:.1f} songs/s), "
+              f"{self.metrics.statuses.get('error', 0)} errors")
@@ -2,12 +2,24 @@ import gzip
 import os
 import json
 
+# characters decompressed per read in iter_songs
+STREAM_CHUNK_SIZE = 1 << 16
+# characters that can continue a JSON number
+NUMBER_CHARS = frozenset("0123456789+-.eE")
+
 def load_json(filepath):
     abs_path = os.path.join(os.path.dirname(__file__), '..', filepath)
     with gzip.open(abs_path, 'rt', encoding='utf-8') as f:
         data = json.load(f)
     return data
 
+def source_stamp(filepath):
+    '''
+    Size and modification time identifying a version of a source dump
+    '''
+    stat = os.stat(os.path.join(os.path.dirname(__file__), '..', filepath))
+    return {'source_size': stat.st_size, 'source_mtime_ns': stat.st_mtime_ns}
+
 def extract_key_fields(song_data):
     return {
     "title": song_data["hooktheory"]["song"],
@@ -21,6 +33,15 @@ def extract_key_fields(song_data):
     "num_beats": song_data["annotations"].get("num_beats", None)
     }
     
+def to_song(record, default_id=None):
+    '''
+    Song dict from a raw dump record ({hooktheory, youtube, annotations})
+    or from a record already in the iter_songs shape
+    '''
+    if 'annotations' in record:
+        return {'id': record.get('id', default_id), 'split': record.get('split'), **extract_key_fields(record)}
+    return {'id': default_id, **record}
+
 def get_train_songs(data_dict):
     parsed = []
     for song_id, song in data_dict.items():
@@ -31,9 +52,102 @@ def get_train_songs(data_dict):
             }
             )
     return parsed
-            
+
+def _iter_json_object_items(f, chunk_size=STREAM_CHUNK_SIZE):
+    '''
+    Incrementally decode a top-level JSON object from a text stream,
+    yielding one (key, value) pair at a time.
+    '''
+    decoder = json.JSONDecoder()
+    buf = ''
+    pos = 0
+    eof = False
+
+    def skip_ws():
+        nonlocal buf, pos, eof
+        while True:
+            while pos < len(buf) and buf[pos] in ' \t\n\r':
+                pos += 1
+            if pos < len(buf) or eof:
+                return
+            buf, pos = f.read(chunk_size), 0
+            eof = not buf
+
+    def decode():
+        # retry with a growing buffer until the whole value is available
+        nonlocal buf, pos, eof
+        while True:
+            try:
+                value, end = decoder.raw_decode(buf, pos)
+                # a number may continue past the end of the buffer: "1." of
+                # "1.5" decodes as 1, so read on while only number characters follow
+                if eof or not (isinstance(value, (int, float)) and NUMBER_CHARS.issuperset(buf[end:])):
+                    pos = end
+                    return value
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+            more = f.read(max(chunk_size, len(buf) - pos))
+            eof = not more
+            buf = buf[pos:] + more
+            pos = 0
+
+    skip_ws()
+    if buf[pos:pos + 1] != '{':
+        raise ValueError("Expected a JSON object at the top level")
+    pos += 1
+    while True:
+        skip_ws()
+        if eof and pos >= len(buf):
+            raise ValueError("Unexpected end of JSON stream")
+        if buf[pos] == '}':
+            return
+        if buf[pos] == ',':
+            pos += 1
+            skip_ws()
+        key = decode()
+        skip_ws()
+        if buf[pos:pos + 1] != ':':
+            raise ValueError(f"Expected ':' after key {key!r}")
+        pos += 1
+        skip_ws()
+        value = decode()
+        # drop consumed text so the buffer stays bounded
+        buf, pos = buf[pos:], 0
+        yield key, value
+
+def iter_songs(filepath, splits=('TRAIN',), select=None):
+    """
+    Stream songs from the gzipped Hooktheory dump one at a time.
+    Args:
+        filepath: .json.gz path relative to the repo root;
+        splits: split names to keep (e.g. ('TRAIN', 'VALID')), None keeps all;
+        select: optional function(song_id) -> bool, songs it rejects are skipped.
+
+    Yields:
+        dict in the extract_key_fields shape, plus 'id' and 'split'
+    """
+    if isinstance(splits, str):
+        splits = (splits,)
+    abs_path = os.path.join(os.path.dirname(__file__), '..', filepath)
+    with gzip.open(abs_path, 'rt', encoding='utf-8') as f:
+        for song_id, song in _iter_json_object_items(f):
+            if splits is not None and song['split'] not in splits:
+                continue
+            if select is not None and not select(song_id):
+                continue
+            yield {
+                'id': song_id,
+                'split': song['split'],
+                **extract_key_fields(song)
+            }
+
 if  __name__ == "__main__":
-    data = load_json('data/Hooktheory.json.gz')
-    songs = get_train_songs(data)
-    print(f"Loaded {len(songs)} TRAIN songs.")
-    print("Example:", songs[0]["title"], "-", songs[0]["artist"])
+    count = 0
+    first = None
+    for song in iter_songs('data/Hooktheory.json.gz'):
+        if first is None:
+            first = song
+        count += 1
+    print(f"Loaded {count} TRAIN songs.")
+    print("Example:", first["title"], "-", first["artist"])
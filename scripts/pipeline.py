@@ -0,0 +1,92 @@
+import queue
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+# songs decoded ahead of the conversion stage
+READ_AHEAD = 64
+# converted songs waiting for their write before conversion blocks
+WRITE_BEHIND = 64
+DEFAULT_WRITER_THREADS = 4
+# tasks per worker process submitted ahead of the consumer
+TASKS_PER_WORKER = 2
+
+_DONE = object()
+
+def iter_prefetched(iterable, maxsize=READ_AHEAD):
+    '''
+    Run an iterator on a background thread, at most maxsize items ahead
+    of the consumer; errors are raised in the consumer
+    '''
+    items = queue.Queue(maxsize)
+    stop = threading.Event()
+
+    def put(item):
+        # give up once the consumer is gone, instead of blocking forever
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put((item, None)):
+                    return
+            put((_DONE, None))
+        except BaseException as e:
+            put((_DONE, e))
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item, error = items.get()
+            if item is _DONE:
+                if error is not None:
+                    raise error
+                return
+            yield item
+    finally:
+        stop.set()
+
+def iter_written(results, write, threads=DEFAULT_WRITER_THREADS, max_pending=WRITE_BEHIND):
+    """
+    Write results on a thread pool while later ones are still converted.
+    Args:
+        results: iterable of results to write;
+        write: function(result) run on the pool;
+        threads: writer threads, 1 keeps the writes in order;
+        max_pending: results waiting for their write before the
+            producer is blocked (backpressure).
+
+    Yields:
+        (result, write(result)) in input order, as soon as each is written
+    """
+    with ThreadPoolExecutor(threads) as pool:
+        pending = deque()
+        for result in results:
+            pending.append((result, pool.submit(write, result)))
+            while pending and (len(pending) > max_pending or pending[0][1].done()):
+                result, future = pending.popleft()
+                yield result, future.result()
+        while pending:
+            result, future = pending.popleft()
+            yield result, future.result()
+
+def iter_pool_results(pool, func, tasks, workers, per_worker=TASKS_PER_WORKER):
+    '''
+    Results of func over tasks on a process pool, in order, with at most
+    per_worker tasks per worker in flight: unlike pool.imap, a streamed
+    input is never fully buffered when the consumer is the slower side
+    '''
+    pending = deque()
+    for task in tasks:
+        pending.append(pool.apply_async(func, (task,)))
+        while len(pending) >= workers * per_worker:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
@@ -0,0 +1,138 @@
+import os
+import json
+import sqlite3
+from parse_json import iter_songs, source_stamp
+
+# bump whenever the table layout or the stored record changes
+STORE_VERSION = 1
+
+DEFAULT_SOURCE = "data/Hooktheory.json.gz"
+DEFAULT_STORE = "data/hooktheory.sqlite"
+
+SCHEMA = """
+CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE songs (
+    id TEXT PRIMARY KEY,
+    split TEXT,
+    artist TEXT COLLATE NOCASE,
+    title TEXT COLLATE NOCASE,
+    record TEXT
+);
+CREATE INDEX songs_split ON songs (split);
+CREATE INDEX songs_artist ON songs (artist);
+CREATE INDEX songs_title ON songs (title);
+"""
+
+def _abs_path(path):
+    return os.path.join(os.path.dirname(__file__), '..', path)
+
+def _stamp(source):
+    return {'store_version': STORE_VERSION, **source_stamp(source)}
+
+def build_store(source=DEFAULT_SOURCE, store_path=DEFAULT_STORE):
+    """
+    Write every song of the dump (all splits) into an SQLite store.
+    Args:
+        source: .json.gz path relative to the repo root;
+        store_path: database path relative to the repo root.
+
+    Returns:
+        number of songs stored
+    """
+    abs_path = _abs_path(store_path)
+    os.makedirs(os.path.dirname(abs_path), exist_ok=True)
+    tmp_path = abs_path + ".tmp"
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+
+    conn = sqlite3.connect(tmp_path)
+    try:
+        conn.executescript(SCHEMA)
+        rows = ((song['id'], song['split'], song['artist'], song['title'],
+                 json.dumps(song, separators=(',', ':')))
+                for song in iter_songs(source, splits=None))
+        conn.executemany("INSERT OR REPLACE INTO songs VALUES (?, ?, ?, ?, ?)", rows)
+        conn.executemany("INSERT INTO meta VALUES (?, ?)",
+                         [(key, json.dumps(value)) for key, value in _stamp(source).items()])
+        conn.commit()
+        count = conn.execute("SELECT COUNT(*) FROM songs").fetchone()[0]
+    finally:
+        conn.close()
+    # swapped in complete, so readers never see a half-built store
+    os.replace(tmp_path, abs_path)
+    return count
+
+def is_fresh(source=DEFAULT_SOURCE, store_path=DEFAULT_STORE):
+    '''
+    Whether the store was built from the current source with this layout
+    '''
+    abs_path = _abs_path(store_path)
+    if not os.path.exists(abs_path):
+        return False
+    try:
+        conn = sqlite3.connect(abs_path)
+        try:
+            meta = {key: json.loads(value) for key, value in conn.execute("SELECT key, value FROM meta")}
+        finally:
+            conn.close()
+    except sqlite3.Error:
+        return False
+    return meta == _stamp(source)
+
+def open_store(source=DEFAULT_SOURCE, store_path=DEFAULT_STORE):
+    '''
+    Connection to the store, (re)built first if it is missing or the source changed
+    '''
+    if not is_fresh(source, store_path):
+        print(f"Building {store_path} from {source}...")
+        build_store(source, store_path)
+    return sqlite3.connect(_abs_path(store_path))
+
+def get_song(conn, song_id):
+    '''
+    Song dict in the iter_songs shape, or None if the id is unknown
+    '''
+    row = conn.execute("SELECT record FROM songs WHERE id = ?", (song_id,)).fetchone()
+    return json.loads(row[0]) if row else None
+
+def find_songs(conn, split=None, artist=None, title=None):
+    """
+    Ids of the songs matching every given filter.
+    Args:
+        split: split name, e.g. 'TRAIN';
+        artist, title: case-insensitive match, SQL LIKE wildcards allowed
+            (e.g. 'the beatles', 'yesterday%').
+
+    Returns:
+        list of (id, split, artist, title), sorted by id
+    """
+    clauses, params = [], []
+    for column, value, op in (('split', split, '='), ('artist', artist, 'LIKE'), ('title', title, 'LIKE')):
+        if value is not None:
+            clauses.append(f"{column} {op} ?")
+            params.append(value)
+    where = f" WHERE {' AND '.join(clauses)}" if clauses else ""
+    return conn.execute(f"SELECT id, split, artist, title FROM songs{where} ORDER BY id", params).fetchall()
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Build or query the song record store.")
+    parser.add_argument('ids', nargs='*', help="print the records of these song ids")
+    parser.add_argument('--source', default=DEFAULT_SOURCE, help="dump path relative to the repo root")
+    parser.add_argument('--store', default=DEFAULT_STORE, help="database path relative to the repo root")
+    parser.add_argument('--rebuild', action='store_true', help="rebuild even if the store is fresh")
+    parser.add_argument('--split')
+    parser.add_argument('--artist', help="case-insensitive, SQL LIKE wildcards allowed")
+    parser.add_argument('--title', help="case-insensitive, SQL LIKE wildcards allowed")
+    args = parser.parse_args()
+
+    if args.rebuild:
+        print(f"Stored {build_store(args.source, args.store)} songs.")
+    conn = open_store(args.source, args.store)
+    for song_id in args.ids:
+        song = get_song(conn, song_id)
+        print(json.dumps(song, indent=2) if song else f"Unknown song id: {song_id}")
+    if args.split or args.artist or args.title:
+        for song_id, split, artist, title in find_songs(conn, args.split, args.artist, args.title):
+            print(f"{song_id}\t{split}\t{artist}\t{title}")
+    conn.close()
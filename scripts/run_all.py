@@ -1,34 +1,452 @@
 import os
-from parse_json import load_json, get_train_songs
-from utils import generate_kern, harmony_to_kern, insert_barlines
-from convert_to_kern import write_kern_file
- 
-def ensure_output_folder(path="outputs"):
-    if not os.path.exists(path):
-        os.makedirs(path)
-
-def main():
-    data = load_json('data/Hooktheory.json.gz')
-    train_songs = get_train_songs(data)
-    
-    ensure_output_folder("outputs")
-
-    print(f"Processing {len(train_songs)} songs...")
-
-    for idx, song in enumerate(train_songs):
-        print(f"[{idx+1}/{len(train_songs)}] {song['id']}")
-        melody = song.get('melody')
-        # if melody is None, pass
-        if not melody:
-            print(f"Skipped: melody is None.")
+import json
+import time
+import hashlib
+import argparse
+import traceback
+from collections import deque, defaultdict
+from functools import partial
+from itertools import islice, chain
+from multiprocessing import Pool
+from parse_json import iter_songs
+from utils import build_song_context, generate_kern, collected_warnings
+from convert_to_kern import render_header
+from emitters import EMITTERS, EXTRA_FORMATS, analyze_song, emit, emit_kern
+from sinks import SINK_MODES, DEFAULT_SHARD_SIZE, open_sink
+from manifest import (hash_song, payload_hash, manifest_path, load_manifest,
+                      save_manifest, make_entry, is_up_to_date)
+from metrics import RunMetrics, ProgressReporter, timed_iter
+from diagnostics import Diagnostics
+from shards import parse_shard, shard_selector, shard_name, shard_files
+from budgets import (MAX_NOTES, MAX_BEATS, MAX_LINES, CPU_SECONDS, DEFAULT_BUDGET, QUARANTINE_NAME,
+                     Budget, BudgetExceeded, quarantine_entry)
+from record_store import open_store, get_song
+from pipeline import DEFAULT_WRITER_THREADS, iter_prefetched, iter_written, iter_pool_results
+
+# songs sent to a worker per task in --workers mode
+CHUNK_SIZE = 32
+# songs whose melodies are encoded together with --batch
+BATCH_SIZE = 256
+
+def process_song(song, encoded=None, formats=(), budget=DEFAULT_BUDGET):
+    """
+    Convert a single song into its .krn text.
+    Args:
+        song: song dict from iter_songs;
+        encoded: (ctx, melody_spine, melody_onsets, seconds, warnings) from
+            the batch encoder, the melody is converted here if omitted; the
+            warnings are the (kind, value) pairs raised for the song
+        formats: extra formats (see emitters.EMITTERS) rendered from the
+            same analysis
+        budget: budgets.Budget of the song; a song over it is quarantined
+
+    Returns:
+        dict with 'id', 'status' ('ok', 'skipped', 'quarantined' or 'error'),
+        'message' (skip, quarantine reason or traceback), the rendered
+        'text', the 'outputs' {format: data} of the extra formats, the
+        per-stage 'timings' and event 'counts' of the song, its (kind, value)
+        'warnings', and for quarantined songs the exceeded budget as
+        'quarantine' (see BudgetExceeded.to_dict).
+    """
+    result = {'id': song['id'], 'status': 'ok', 'message': None, 'text': None,
+              'outputs': {}, 'timings': None, 'counts': None, 'warnings': []}
+    # warnings are collected for the diagnostics report, never printed per note
+    with collected_warnings() as collected:
+        try:
+            with budget.cpu_limit():
+                _convert(song, encoded, formats, budget, result)
+        except BudgetExceeded as e:
+            result.update(status='quarantined', message=str(e), text=None, outputs={},
+                          timings=None, counts=None, quarantine=e.to_dict())
+            result['warnings'].append(('quarantined', e.kind))
+        except Exception as e:
+            result.update(status='error', message=traceback.format_exc())
+            result['warnings'].append(('conversion_error', type(e).__name__))
+    result['warnings'].extend((kind, value) for kind, value, _ in collected)
+    if result['counts'] is not None:
+        result['counts']['warnings'] = len(result['warnings'])
+    return result
+
+def _convert(song, encoded, formats, budget, result):
+    '''
+    Body of process_song, filling in result
+    '''
+    melody = song.get('melody')
+    # if melody is None, pass
+    if not melody:
+        result.update(status='skipped', message='melody is None.')
+        result['warnings'].append(('skipped_song', 'melody is None'))
+        return
+    budget.check_input(song)
+
+    clock = time.perf_counter
+    if encoded is None:
+        t0 = clock()
+        ctx = build_song_context(song)
+        melody_spine, melody_onsets = generate_kern(song, ctx)
+        t1 = clock()
+    else:
+        ctx, melody_spine, melody_onsets, seconds, warnings = encoded
+        t1 = clock()
+        t0 = t1 - seconds
+        result['warnings'].extend(warnings)
+    analysis = analyze_song(song, ctx, (melody_spine, melody_onsets))
+    t2 = clock()
+    result['text'] = emit_kern(analysis)
+    budget.check_output(result['text'])
+    result['outputs'] = emit(analysis, formats)
+    t3 = clock()
+    result['timings'] = {'melody': t1 - t0, 'harmony': t2 - t1, 'write': t3 - t2}
+    result['counts'] = {
+        'notes': len(melody),
+        'rests': sum(1 for line in melody_spine if line.endswith('r')),
+        'chords': len(song.get('harmony') or []),
+    }
+
+def reused_result(song, sha):
+    '''
+    Result of a song whose spines are already in the content store: only
+    its header is rendered, the sink writes a reference to body sha (its
+    warnings were reported by the run that rendered the body)
+    '''
+    return {'id': song['id'], 'status': 'ok', 'message': None, 'text': render_header(song),
+            'reused': sha, 'timings': {'write': 0.0}, 'counts': None, 'warnings': []}
+
+def within_input_budget(song, budget):
+    try:
+        budget.check_input(song)
+        return True
+    except BudgetExceeded:
+        return False
+
+def process_chunk(songs, batch=False, formats=(), budget=DEFAULT_BUDGET):
+    if not batch:
+        return [process_song(song, formats=formats, budget=budget) for song in songs]
+    # numpy is only needed for --batch
+    from batch_encode import generate_kern_batch
+
+    # songs over their input budget are left to process_song, which quarantines them
+    convertible = [song for song in songs if song.get('melody') and within_input_budget(song, budget)]
+    t0 = time.perf_counter()
+    try:
+        with collected_warnings() as collected:
+            ctxs = [build_song_context(song) for song in convertible]
+            melodies = generate_kern_batch(convertible, ctxs)
+    except Exception:
+        # one malformed song fails the whole batch, convert one by one to find it
+        return [process_song(song, formats=formats, budget=budget) for song in songs]
+    seconds = (time.perf_counter() - t0) / max(len(convertible), 1)
+    # batch warnings carry the id of their song
+    warnings = defaultdict(list)
+    for kind, value, song_id in collected:
+        warnings[song_id].append((kind, value))
+    encoded = {id(song): (ctx, spine, onsets, seconds, warnings.pop(song['id'], []))
+               for song, ctx, (spine, onsets) in zip(convertible, ctxs, melodies)}
+    return [process_song(song, encoded.get(id(song)), formats, budget) for song in songs]
+
+def iter_chunks(songs, size):
+    songs = iter(songs)
+    while True:
+        chunk = list(islice(songs, size))
+        if not chunk:
+            return
+        yield chunk
+
+def iter_results_parallel(songs, workers, chunk_size=CHUNK_SIZE, batch=False, formats=(),
+                          budget=DEFAULT_BUDGET):
+    '''
+    Convert songs on a process pool, keeping at most two chunks per worker
+    in flight so the streamed corpus is never fully buffered.
+    '''
+    convert = partial(process_chunk, batch=batch, formats=formats, budget=budget)
+    with Pool(workers) as pool:
+        for results in iter_pool_results(pool, convert, iter_chunks(songs, chunk_size), workers):
+            yield from results
+
+def write_result(sink, result):
+    '''
+    Write a converted song, and its extra formats, to the sink.
+    Returns:
+        (sha256, size) of the written bytes, (None, None) if nothing is written
+    '''
+    if result['status'] != 'ok':
+        return None, None
+    t0 = time.perf_counter()
+    if result.get('reused'):
+        data = sink.write_reference(result['id'], result['text'], result['reused'])
+    else:
+        data = sink.write(result['id'], result['text'])
+    for fmt, output in result.get('outputs', {}).items():
+        # e.g. harm of a song without harmony
+        if output is not None:
+            sink.write_file(result['id'] + EMITTERS[fmt][0], output)
+    result['timings']['write'] += time.perf_counter() - t0
+    return hashlib.sha256(data).hexdigest(), len(data)
+
+def iter_store_songs(conn, ids):
+    for song_id in ids:
+        song = get_song(conn, song_id)
+        if song is None:
+            print(f"Unknown song id: {song_id}")
             continue
-        
-        melody_spine, melody_onsets = generate_kern(song)
-        harmony_spine = harmony_to_kern(song, melody_onsets)
-        melody_spine, harmony_spine = insert_barlines(melody_spine, harmony_spine, song['meters'][0])
-        write_kern_file(melody_spine, harmony_spine, f"outputs/{song['id']}.krn", song)
+        yield song
+
+def iter_changed_songs(songs, entries, input_hashes, counts, sink, force=False, verify=False, formats=()):
+    '''
+    Drop songs whose manifest entry matches the current input hash,
+    converter version and output file
+    '''
+    for song in songs:
+        input_hash = hash_song(song)
+        if not force and is_up_to_date(entries.get(song['id']), input_hash,
+                                       sink.path(song['id']), verify, formats):
+            counts['unchanged'] += 1
+            continue
+        input_hashes[song['id']] = input_hash
+        yield song
+
+def iter_reusing(songs, sink, convert, counts):
+    """
+    Skip the conversion of songs whose annotations were already rendered
+    into the content store of a dedup sink.
+    Args:
+        songs: iterable of songs to convert;
+        sink: ContentSink;
+        convert: function(songs) yielding their results;
+        counts: run counters, 'reused' is incremented.
+
+    Yields:
+        the results of convert, with the reused songs in between
+    """
+    reused = deque()
+
+    def to_convert():
+        for song in songs:
+            if song.get('melody'):
+                payload = payload_hash(song)
+                sha = sink.store.lookup(payload)
+                if sha is not None:
+                    counts['reused'] += 1
+                    reused.append(reused_result(song, sha))
+                    continue
+                sink.expect(song['id'], payload)
+            yield song
+
+    for result in convert(to_convert()):
+        while reused:
+            yield reused.popleft()
+        yield result
+    while reused:
+        yield reused.popleft()
+
+def main(workers=1, force=False, verify=False, sink_mode='files', compress=False,
+         shard_size=DEFAULT_SHARD_SIZE, metrics_path=None, slowest=20, progress_interval=5.0,
+         batch=False, cache=False, ids=None, pipeline=False, writer_threads=DEFAULT_WRITER_THREADS,
+         formats=(), diagnostics_path=None, shard=None, budget=DEFAULT_BUDGET):
+    if formats and sink_mode == 'stream':
+        raise ValueError("Extra formats need a files, dedup, tar or zip sink")
+    print("Processing selected songs..." if ids else "Processing TRAIN songs...")
+
+    name = "hooktheory"
+    select = None
+    manifest_file = manifest_path("outputs")
+    quarantine_file = manifest_path("outputs", QUARANTINE_NAME)
+    if shard:
+        # a shard keeps the songs whose id hashes to it, with its own manifest,
+        # metrics and diagnostics for shards.merge_shards
+        index, count = shard
+        print(f"Shard {index}/{count}")
+        name = f"hooktheory-{shard_name(index, count)}"
+        select = shard_selector(index, count)
+        files = shard_files(index, count)
+        manifest_file = manifest_path("outputs", files['manifest'])
+        metrics_path = metrics_path or manifest_path("outputs", files['metrics'])
+        diagnostics_path = diagnostics_path or manifest_path("outputs", files['diagnostics'])
+        quarantine_file = manifest_path("outputs", files['quarantine'])
+
+    sink = open_sink(sink_mode, "outputs", compress, shard_size, name)
+    entries = load_manifest(manifest_file)
+    # the quarantine list is kept across runs (e.g. an --ids rerun), minus the
+    # songs converted since; songs converted again below leave it too
+    quarantine = {song_id: entry for song_id, entry in load_manifest(quarantine_file).items()
+                  if song_id not in entries}
+    input_hashes = {}
+    counts = {'unchanged': 0, 'reused': 0}
+
+    # with --metrics, rate-limited progress lines replace the per-song print
+    metrics = RunMetrics(slowest) if metrics_path else None
+    reporter = ProgressReporter(metrics, progress_interval) if metrics else None
+
+    source = 'data/Hooktheory.json.gz'
+    if ids:
+        # single songs are looked up in the record store, whatever their split
+        songs = iter_store_songs(open_store(source), [i for i in ids if select is None or select(i)])
+    elif cache:
+        # numpy is only needed for --cache
+        from corpus_cache import open_cache
+        songs = open_cache(source).iter_songs(splits=('TRAIN',), select=select)
+    else:
+        # songs are streamed from the dump, so conversion starts right away
+        songs = iter_songs(source, splits=('TRAIN',), select=select)
+    if metrics:
+        songs = timed_iter(songs, metrics, 'load')
+    # bundles are rewritten on every run, so only per-file output is incremental
+    incremental = sink_mode in ('files', 'dedup')
+    songs = iter_changed_songs(songs, entries, input_hashes, counts, sink,
+                               force or not incremental, verify, formats)
+    if pipeline:
+        # decode (and hash) songs on a reader thread, a bounded queue ahead
+        songs = iter_prefetched(songs)
+    if workers > 1:
+        convert = partial(iter_results_parallel, workers=workers,
+                          chunk_size=BATCH_SIZE if batch else CHUNK_SIZE, batch=batch, formats=formats,
+                          budget=budget)
+    elif batch:
+        def convert(songs):
+            return chain.from_iterable(map(partial(process_chunk, batch=True, formats=formats, budget=budget),
+                                           iter_chunks(songs, BATCH_SIZE)))
+    else:
+        convert = partial(map, partial(process_song, formats=formats, budget=budget))
+    # reused songs are never analysed, so extra formats need a conversion
+    if sink_mode == 'dedup' and not formats:
+        # identical annotations are rendered once, later copies reference the stored spines
+        results = iter_reusing(songs, sink, convert, counts)
+    else:
+        results = convert(songs)
+    if pipeline:
+        # bundles append to one file, so they keep a single ordered writer
+        threads = writer_threads if sink_mode in ('files', 'dedup') else 1
+        written = iter_written(results, partial(write_result, sink), threads)
+    else:
+        written = ((result, write_result(sink, result)) for result in results)
+
+    errors = []
+    quarantined = []
+    diagnostics = Diagnostics()
+    # entries are appended as songs are written, so a crashed run resumes here;
+    # quarantined songs get no entry and are retried (and listed again) next run
+    with open(manifest_file, 'a', encoding='utf-8') as manifest_log, \
+            open(quarantine_file, 'a', encoding='utf-8') as quarantine_log:
+        for idx, (result, (checksum, size)) in enumerate(written):
+            song_id, status, message = result['id'], result['status'], result['message']
+            diagnostics.add_song(song_id, result['warnings'])
+            quarantine.pop(song_id, None)
+            if metrics:
+                reporter.update()
+            else:
+                print(f"[{idx+1}] {song_id}")
+                if status == 'skipped':
+                    print(f"Skipped: {message}")
+            if status == 'error':
+                print(f"Error: {song_id}: {message.strip().splitlines()[-1]}")
+                errors.append((song_id, message))
+                input_hashes.pop(song_id, None)
+                if metrics:
+                    metrics.add_song(song_id, status)
+                continue
+            if status == 'quarantined':
+                print(f"Quarantined: {song_id}: {message}")
+                quarantined.append(song_id)
+                entries.pop(song_id, None)
+                quarantine[song_id] = quarantine_entry(input_hashes.pop(song_id), result)
+                quarantine_log.write(json.dumps(quarantine[song_id], sort_keys=True) + "\n")
+                quarantine_log.flush()
+                if metrics:
+                    metrics.add_song(song_id, status)
+                continue
+            if metrics:
+                metrics.add_song(song_id, status, result['timings'], result['counts'])
+            entry = make_entry(song_id, input_hashes.pop(song_id), status, checksum, size, formats)
+            entries[song_id] = entry
+            manifest_log.write(json.dumps(entry, sort_keys=True) + "\n")
+            manifest_log.flush()
+    sink.close()
+    save_manifest(manifest_file, entries)
+    save_manifest(quarantine_file, quarantine)
+
+    if metrics:
+        reporter.update(force=True)
+        metrics.statuses['unchanged'] = counts['unchanged']
+        metrics.write(metrics_path)
+        print(f"Metrics written to {metrics_path}")
+
+    if diagnostics.counts:
+        print("Data warnings:")
+        for line in diagnostics.summary():
+            print(f"  {line}")
+    if diagnostics_path:
+        diagnostics.write(diagnostics_path)
+        print(f"Diagnostics written to {diagnostics_path}")
 
+    if counts['unchanged']:
+        print(f"{counts['unchanged']} unchanged songs skipped.")
+    if counts['reused']:
+        print(f"{counts['reused']} songs reused already rendered spines.")
+    if quarantined:
+        print(f"{len(quarantined)} songs over budget, listed in {os.path.normpath(quarantine_file)}")
+    if errors:
+        print(f"{len(errors)} songs failed: {', '.join(song_id for song_id, _ in errors)}")
     print("All songs processed.")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Convert Hooktheory TRAIN songs to kern.")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="number of worker processes (default: 1, serial)")
+    parser.add_argument('--force', action='store_true',
+                        help="reconvert every song, ignoring the manifest")
+    parser.add_argument('--verify', action='store_true',
+                        help="compare output checksums, not just sizes, before skipping")
+    parser.add_argument('--sink', choices=SINK_MODES, default='files',
+                        help="output layout: one file per song (default), one file per song "
+                             "referencing spines stored once per distinct body (dedup), one "
+                             "multi-record stream, or tar/zip bundles")
+    parser.add_argument('--compress', action='store_true',
+                        help="gzip the output (deflate for zip bundles)")
+    parser.add_argument('--shard-size', type=int, default=DEFAULT_SHARD_SIZE,
+                        help="songs per tar/zip bundle")
+    parser.add_argument('--metrics', metavar='PATH',
+                        help="collect per-stage timings and counts into a JSON file; "
+                             "progress is then reported every --progress-interval seconds")
+    parser.add_argument('--slowest', type=int, default=20,
+                        help="number of slowest songs listed in the metrics")
+    parser.add_argument('--progress-interval', type=float, default=5.0,
+                        help="seconds between progress lines with --metrics")
+    parser.add_argument('--batch', action='store_true',
+                        help=f"encode melodies {BATCH_SIZE} songs at a time with NumPy "
+                             "(same output, needs numpy)")
+    parser.add_argument('--cache', action='store_true',
+                        help="read songs from the memory-mapped cache in data/cache, compiled "
+                             "on first use and whenever the dump changes (needs numpy)")
+    parser.add_argument('--ids', nargs='+', metavar='ID',
+                        help="convert only these song ids (any split), looked up in the "
+                             "record store data/hooktheory.sqlite")
+    parser.add_argument('--pipeline', action='store_true',
+                        help="overlap reading, conversion and writing with bounded queues")
+    parser.add_argument('--writer-threads', type=int, default=DEFAULT_WRITER_THREADS,
+                        help="threads writing files in --pipeline mode (bundles use one)")
+    parser.add_argument('--formats', nargs='+', choices=EXTRA_FORMATS, default=(),
+                        help="also write these formats from the same analysis: a **harm "
+                             "Roman-numeral .harm.krn, a .csv note list, a .mid file")
+    parser.add_argument('--diagnostics', metavar='PATH',
+                        help="write the data-quality report (warnings by kind, value and "
+                             "example songs) to a JSON file")
+    parser.add_argument('--shard', metavar='i/N', type=parse_shard,
+                        help="convert only shard i (0..N-1) of the songs, split by a stable hash "
+                             "of the song id; per-shard manifest, metrics and diagnostics are "
+                             "written to outputs/ for shards.py to merge")
+    parser.add_argument('--max-notes', type=int, default=MAX_NOTES,
+                        help="quarantine songs with more melody notes plus chords (0: no limit)")
+    parser.add_argument('--max-beats', type=float, default=MAX_BEATS,
+                        help="quarantine songs spanning more beats (0: no limit)")
+    parser.add_argument('--max-lines', type=int, default=MAX_LINES,
+                        help="quarantine songs whose .krn has more lines (0: no limit)")
+    parser.add_argument('--cpu-seconds', type=float, default=CPU_SECONDS,
+                        help="quarantine songs taking more CPU time to convert (0: no limit); "
+                             f"quarantined songs are listed in outputs/{QUARANTINE_NAME}")
+    args = parser.parse_args()
+    main(workers=args.workers, force=args.force, verify=args.verify, sink_mode=args.sink,
+         compress=args.compress, shard_size=args.shard_size, metrics_path=args.metrics,
+         slowest=args.slowest, progress_interval=args.progress_interval, batch=args.batch,
+         cache=args.cache, ids=args.ids, pipeline=args.pipeline, writer_threads=args.writer_threads,
+         formats=args.formats, diagnostics_path=args.diagnostics, shard=args.shard,
+         budget=Budget(args.max_notes, args.max_beats, args.max_lines, args.cpu_seconds))
@@ -0,0 +1,269 @@
+import os
+import json
+import time
+import queue
+import argparse
+import threading
+import traceback
+import socketserver
+from collections import deque
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from multiprocessing import Pool
+from parse_json import to_song
+from convert_to_kern import convert_song
+from budgets import DEFAULT_BUDGET, BudgetExceeded
+
+# songs handed to a worker at once, and how long the batcher waits to fill a batch
+MAX_BATCH = 64
+MAX_WAIT = 0.005
+# request latencies kept for the percentiles in /stats
+LATENCY_WINDOW = 1000
+
+def convert_batch(songs):
+    '''
+    Convert songs in a worker; failures and songs over the default budgets
+    are returned, never raised
+    '''
+    results = []
+    for song in songs:
+        try:
+            with DEFAULT_BUDGET.cpu_limit():
+                DEFAULT_BUDGET.check_input(song)
+                krn = convert_song(song)
+                DEFAULT_BUDGET.check_output(krn)
+            results.append({'id': song.get('id'), 'status': 'ok', 'krn': krn})
+        except BudgetExceeded as e:
+            results.append({'id': song.get('id'), 'status': 'quarantined', 'error': str(e)})
+        except Exception as e:
+            results.append({'id': song.get('id'), 'status': 'error', 'error': f"{type(e).__name__}: {e}"})
+    return results
+
+WARM_UP_SONG = {
+    'id': 'warm-up', 'title': '', 'artist': '', 'urls': {'song': '', 'clip': ''}, 'youtube': {'url': ''},
+    'meters': [{'beat': 0, 'beats_per_bar': 4, 'beat_unit': 4}],
+    'keys': [{'beat': 0, 'tonic_pitch_class': 0, 'scale_degree_intervals': [2, 2, 1, 2, 2, 2]}],
+    'melody': [{'onset': 0, 'offset': 1, 'pitch_class': 0, 'octave': 0}],
+    'harmony': [{'onset': 0, 'offset': 1, 'root_pitch_class': 0, 'root_position_intervals': [4, 3]}],
+    'num_beats': 4,
+}
+
+def warm_up():
+    '''
+    Pool initializer: go through the whole converter once, so the first
+    request does not pay for lazy imports and caches
+    '''
+    convert_batch([WARM_UP_SONG])
+
+class ServiceStats:
+    """
+    Request, song and batch counters with recent latencies, shared by the
+    handler threads.
+    """
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.songs = 0
+        self.errors = 0
+        self.batches = 0
+        self.batched_songs = 0
+        self.latencies = deque(maxlen=LATENCY_WINDOW)
+
+    def add_request(self, seconds, songs, errors):
+        with self.lock:
+            self.requests += 1
+            self.songs += songs
+            self.errors += errors
+            self.latencies.append(seconds)
+
+    def add_batch(self, size):
+        with self.lock:
+            self.batches += 1
+            self.batched_songs += size
+
+    def to_dict(self):
+        with self.lock:
+            elapsed = time.perf_counter() - self.start
+            latencies = sorted(self.latencies)
+
+            def percentile(p):
+                return latencies[min(len(latencies) - 1, int(p * len(latencies)))] if latencies else None
+
+            return {
+                'uptime_seconds': elapsed,
+                'requests': self.requests,
+                'songs': self.songs,
+                'errors': self.errors,
+                'requests_per_second': self.requests / elapsed,
+                'songs_per_second': self.songs / elapsed,
+                'batches': self.batches,
+                'mean_batch_size': self.batched_songs / self.batches if self.batches else None,
+                'latency_seconds': {
+                    'mean': sum(latencies) / len(latencies) if latencies else None,
+                    'p50': percentile(0.5),
+                    'p95': percentile(0.95),
+                    'p99': percentile(0.99),
+                    'max': latencies[-1] if latencies else None,
+                },
+            }
+
+class Batcher:
+    """
+    Collect the songs of concurrent requests into batches for the worker
+    pool; each song gets a Future holding its result.
+    """
+    def __init__(self, workers, stats, max_batch=MAX_BATCH, max_wait=MAX_WAIT):
+        self.pool = Pool(workers, initializer=warm_up)
+        self.stats = stats
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.pending = queue.Queue()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def submit(self, songs):
+        futures = []
+        for song in songs:
+            future = Future()
+            self.pending.put((song, future))
+            futures.append(future)
+        return futures
+
+    def _run(self):
+        while True:
+            batch = [self.pending.get()]
+            deadline = time.perf_counter() + self.max_wait
+            while len(batch) < self.max_batch:
+                timeout = deadline - time.perf_counter()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self.pending.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            self._dispatch(batch)
+
+    def _dispatch(self, batch):
+        songs = [song for song, _ in batch]
+        futures = [future for _, future in batch]
+        self.stats.add_batch(len(batch))
+
+        def done(results):
+            for future, result in zip(futures, results):
+                future.set_result(result)
+
+        def failed(error):
+            for future in futures:
+                future.set_exception(error)
+
+        self.pool.apply_async(convert_batch, (songs,), callback=done, error_callback=failed)
+
+    def close(self):
+        self.pool.terminate()
+
+class ConvertHandler(BaseHTTPRequestHandler):
+    '''
+    POST /convert with one record or a list of records; GET /stats, /health
+    '''
+    batcher = None
+    stats = None
+
+    def _send_json(self, status, payload):
+        body = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == '/stats':
+            self._send_json(200, self.stats.to_dict())
+        elif self.path == '/health':
+            self._send_json(200, {'status': 'ok'})
+        else:
+            self._send_json(404, {'error': f"Unknown path: {self.path}"})
+
+    def do_POST(self):
+        if self.path != '/convert':
+            self._send_json(404, {'error': f"Unknown path: {self.path}"})
+            return
+        t0 = time.perf_counter()
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            payload = json.loads(self.rfile.read(length))
+            records = payload if isinstance(payload, list) else [payload]
+            songs = [to_song(record, str(i)) for i, record in enumerate(records)]
+        except (ValueError, KeyError, TypeError) as e:
+            self._send_json(400, {'error': f"Bad request: {e}"})
+            return
+        try:
+            results = [future.result() for future in self.batcher.submit(songs)]
+        except Exception:
+            self._send_json(500, {'error': traceback.format_exc()})
+            return
+        errors = sum(1 for result in results if result['status'] != 'ok')
+        self.stats.add_request(time.perf_counter() - t0, len(results), errors)
+        self._send_json(200, {'results': results})
+
+    def address_string(self):
+        # Unix socket clients have no address
+        return self.client_address[0] if self.client_address else 'unix'
+
+    def log_message(self, format, *args):
+        # per-request access logs would dominate the output; see /stats
+        pass
+
+# pending connections; the socketserver default of 5 resets bursts of clients
+LISTEN_BACKLOG = 128
+
+class ConvertHTTPServer(ThreadingHTTPServer):
+    request_queue_size = LISTEN_BACKLOG
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+    request_queue_size = LISTEN_BACKLOG
+
+    def server_bind(self):
+        socketserver.UnixStreamServer.server_bind(self)
+        # attributes BaseHTTPRequestHandler expects from an HTTPServer
+        self.server_name = 'localhost'
+        self.server_port = 0
+
+def make_server(host='127.0.0.1', port=8765, unix_socket=None):
+    if unix_socket:
+        if os.path.exists(unix_socket):
+            os.remove(unix_socket)
+        return ThreadingUnixHTTPServer(unix_socket, ConvertHandler)
+    return ConvertHTTPServer((host, port), ConvertHandler)
+
+def main(host='127.0.0.1', port=8765, unix_socket=None, workers=None,
+         max_batch=MAX_BATCH, max_wait=MAX_WAIT):
+    stats = ServiceStats()
+    ConvertHandler.stats = stats
+    ConvertHandler.batcher = Batcher(workers or os.cpu_count(), stats, max_batch, max_wait)
+    server = make_server(host, port, unix_socket)
+    print(f"Serving on {unix_socket or f'http://{host}:{port}'} "
+          f"(POST /convert, GET /stats, GET /health)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        ConvertHandler.batcher.close()
+        if unix_socket and os.path.exists(unix_socket):
+            os.remove(unix_socket)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Resident kern conversion service.")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--unix', metavar='PATH', help="listen on a Unix socket instead of TCP")
+    parser.add_argument('--workers', type=int, default=None, help="worker processes (default: CPU count)")
+    parser.add_argument('--max-batch', type=int, default=MAX_BATCH, help="songs per worker batch")
+    parser.add_argument('--max-wait-ms', type=float, default=MAX_WAIT * 1000,
+                        help="time to wait for more songs before dispatching a batch")
+    args = parser.parse_args()
+    main(args.host, args.port, args.unix, args.workers, args.max_batch, args.max_wait_ms / 1000)
@@ -0,0 +1,133 @@
+import os
+import json
+import hashlib
+from manifest import manifest_path, load_manifest, save_manifest
+from metrics import merge_metrics
+from diagnostics import Diagnostics
+from budgets import QUARANTINE_NAME
+
+def parse_shard(text):
+    '''
+    "i/N" to (i, N); shards are numbered from 0 to N-1
+    '''
+    try:
+        index, count = (int(part) for part in text.split('/'))
+    except ValueError:
+        raise ValueError(f"Expected a shard as i/N, got {text!r}")
+    if count < 1 or not 0 <= index < count:
+        raise ValueError(f"Shard index must be in 0..{count - 1}, got {text!r}")
+    return index, count
+
+def shard_of(song_id, count):
+    '''
+    Shard of a song: a stable hash of its id (the same on every machine and
+    Python version, unlike hash())
+    '''
+    digest = hashlib.sha1(song_id.encode('utf-8')).digest()
+    return int.from_bytes(digest[:8], 'big') % count
+
+def shard_selector(index, count):
+    '''
+    select function for iter_songs keeping the songs of one shard
+    '''
+    return lambda song_id: shard_of(song_id, count) == index
+
+def shard_name(index, count):
+    return f"shard-{index:03d}-of-{count:03d}"
+
+# per-shard files written by run_all --shard next to the outputs
+def shard_files(index, count):
+    name = shard_name(index, count)
+    return {
+        'manifest': f"manifest-{name}.jsonl",
+        'metrics': f"metrics-{name}.json",
+        'diagnostics': f"diagnostics-{name}.json",
+        'quarantine': f"quarantine-{name}.jsonl",
+    }
+
+def _load_json(path):
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+def _load_lines(path):
+    if not os.path.exists(path):
+        return []
+    with open(path, 'r', encoding='utf-8') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+def merge_shards(count, output_dir="outputs", expected_ids=None):
+    """
+    Combine the manifests, metrics, diagnostics and quarantine lists of the
+    count shards of a run, checking that every song was converted (or
+    quarantined) by exactly one shard.
+    Args:
+        count: number of shards of the run;
+        output_dir: directory holding the per-shard files, relative to the repo root;
+        expected_ids: ids the run had to cover (e.g. every TRAIN song), or
+            None to only check the shards against each other.
+
+    Returns:
+        dict of problems (missing_shards, duplicates, misplaced, missing);
+        the merged files are written only when there is none
+    """
+    entries = {}
+    owners = {}
+    problems = {'missing_shards': [], 'duplicates': [], 'misplaced': [], 'missing': []}
+    metrics, diagnostics, quarantined = [], Diagnostics(), []
+    for index in range(count):
+        files = shard_files(index, count)
+        path = manifest_path(output_dir, files['manifest'])
+        if not os.path.exists(path):
+            problems['missing_shards'].append(index)
+            continue
+        for song_id, entry in load_manifest(path).items():
+            if song_id in owners:
+                problems['duplicates'].append(song_id)
+            elif shard_of(song_id, count) != index:
+                problems['misplaced'].append(song_id)
+            owners[song_id] = index
+            entries[song_id] = entry
+        report = _load_json(manifest_path(output_dir, files['metrics']))
+        if report is not None:
+            metrics.append(report)
+        report = _load_json(manifest_path(output_dir, files['diagnostics']))
+        if report is not None:
+            diagnostics.merge(Diagnostics.from_dict(report))
+        quarantined += _load_lines(manifest_path(output_dir, files['quarantine']))
+    if expected_ids is not None:
+        problems['missing'] = sorted(set(expected_ids) - set(entries) - {entry['id'] for entry in quarantined})
+    problems = {kind: ids for kind, ids in problems.items() if ids}
+
+    if not problems:
+        save_manifest(manifest_path(output_dir), entries)
+        if metrics:
+            with open(manifest_path(output_dir, "metrics.json"), 'w', encoding='utf-8') as f:
+                json.dump(merge_metrics(metrics), f, indent=2)
+        if diagnostics.counts:
+            diagnostics.write(manifest_path(output_dir, "diagnostics.json"))
+        with open(manifest_path(output_dir, QUARANTINE_NAME), 'w', encoding='utf-8') as f:
+            for entry in sorted(quarantined, key=lambda e: e['id']):
+                f.write(json.dumps(entry, sort_keys=True) + "\n")
+    return problems
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Merge the per-shard files of a run_all --shard i/N run.")
+    parser.add_argument('count', type=int, help="number of shards N")
+    parser.add_argument('--output-dir', default="outputs", help="directory relative to the repo root")
+    parser.add_argument('--source', default=None,
+                        help="dump whose TRAIN songs must all be covered, e.g. data/Hooktheory.json.gz")
+    args = parser.parse_args()
+
+    expected_ids = None
+    if args.source:
+        from parse_json import iter_songs
+        expected_ids = [song['id'] for song in iter_songs(args.source, splits=('TRAIN',))]
+    problems = merge_shards(args.count, args.output_dir, expected_ids)
+    for kind, ids in problems.items():
+        print(f"{kind}: {len(ids)} ({', '.join(map(str, ids[:10]))}{', ...' if len(ids) > 10 else ''})")
+    if problems:
+        raise SystemExit(1)
+    print(f"Merged {args.count} shards into {args.output_dir}/{os.path.basename(manifest_path(args.output_dir))}.")
@@ -0,0 +1,229 @@
+import io
+import os
+import gzip
+import tarfile
+import zipfile
+from content_store import ContentStore, split_record
+
+SINK_MODES = ('files', 'dedup', 'stream', 'tar', 'zip')
+
+# records per tar/zip bundle
+DEFAULT_SHARD_SIZE = 5000
+# timestamp of every bundle member, so reruns give byte-identical bundles
+# (1980-01-01 is the earliest date a zip entry can hold)
+MEMBER_DATE = (1980, 1, 1, 0, 0, 0)
+
+def _abs_dir(output_dir):
+    abs_dir = os.path.join(os.path.dirname(__file__), '..', output_dir)
+    os.makedirs(abs_dir, exist_ok=True)
+    return abs_dir
+
+def _gzip(data):
+    # mtime=0 keeps compressed output reproducible
+    return gzip.compress(data, mtime=0)
+
+class FileSink:
+    '''
+    One .krn (or .krn.gz) file per song, as before
+    '''
+    def __init__(self, output_dir="outputs", compress=False):
+        self.output_dir = _abs_dir(output_dir)
+        self.compress = compress
+
+    def path(self, song_id):
+        suffix = ".krn.gz" if self.compress else ".krn"
+        return os.path.join(self.output_dir, f"{song_id}{suffix}")
+
+    def write(self, song_id, text):
+        """
+        Write one rendered record with a single call.
+        Returns:
+            bytes written (after compression)
+        """
+        data = text.encode('utf-8')
+        if self.compress:
+            data = _gzip(data)
+        with open(self.path(song_id), 'wb') as f:
+            f.write(data)
+        return data
+
+    def write_file(self, name, data):
+        '''
+        Write another output of a song (str or bytes) as output_dir/name
+        '''
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        if self.compress:
+            data = _gzip(data)
+            name += ".gz"
+        with open(os.path.join(self.output_dir, name), 'wb') as f:
+            f.write(data)
+        return data
+
+    def close(self):
+        pass
+
+class ContentSink(FileSink):
+    '''
+    One small .krn file per song holding its header and a reference to
+    its spines, stored once per distinct body in a ContentStore
+    '''
+    def __init__(self, output_dir="outputs", compress=False):
+        super().__init__(output_dir, compress)
+        self.store = ContentStore(self.output_dir, compress)
+        # payload hash of each song being converted, remembered once it is written
+        self.payloads = {}
+
+    def expect(self, song_id, payload_hash):
+        self.payloads[song_id] = payload_hash
+
+    def write(self, song_id, text):
+        header, body = split_record(text)
+        sha, _ = self.store.put(body)
+        payload_hash = self.payloads.pop(song_id, None)
+        if payload_hash is not None:
+            self.store.remember(payload_hash, sha)
+        return self.write_reference(song_id, header, sha)
+
+    def write_reference(self, song_id, header, sha):
+        '''
+        Write the file of a song whose body is already stored
+        '''
+        return super().write(song_id, self.store.reference(header, sha))
+
+    def close(self):
+        self.store.close()
+
+class StreamSink:
+    '''
+    All songs in one multi-record Humdrum stream; each record starts with
+    a !!!!SEGMENT line naming its file, as humextra tools expect
+    '''
+    def __init__(self, output_dir="outputs", compress=False, name="hooktheory"):
+        suffix = ".krns.gz" if compress else ".krns"
+        self.path = os.path.join(_abs_dir(output_dir), name + suffix)
+        if compress:
+            self.f = gzip.GzipFile(self.path, 'wb', mtime=0)
+        else:
+            self.f = open(self.path, 'wb')
+
+    def write(self, song_id, text):
+        data = f"!!!!SEGMENT: {song_id}.krn\n{text}".encode('utf-8')
+        self.f.write(data)
+        return data
+
+    def close(self):
+        self.f.close()
+
+class _ShardedSink:
+    '''
+    Base for bundle sinks: records go to numbered shards of shard_size songs
+    '''
+    suffix = ''
+
+    def __init__(self, output_dir="outputs", compress=False, shard_size=DEFAULT_SHARD_SIZE,
+                 name="hooktheory"):
+        self.output_dir = _abs_dir(output_dir)
+        self.compress = compress
+        self.shard_size = shard_size
+        self.name = name
+        self.shard_index = -1
+        self.count = 0
+        self.bundle = None
+
+    def shard_path(self, index):
+        return os.path.join(self.output_dir, f"{self.name}-{index:05d}{self.suffix}")
+
+    def write(self, song_id, text):
+        if self.bundle is None or self.count >= self.shard_size:
+            self._next_shard()
+        data = text.encode('utf-8')
+        self._add(f"{song_id}.krn", data)
+        self.count += 1
+        return data
+
+    def write_file(self, name, data):
+        '''
+        Add another output of the song just written to the current bundle
+        '''
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        self._add(name, data)
+        return data
+
+    def _next_shard(self):
+        self.close()
+        self.shard_index += 1
+        self.count = 0
+        self.bundle = self._open(self.shard_path(self.shard_index))
+
+    def close(self):
+        if self.bundle is not None:
+            self.bundle.close()
+            self.bundle = None
+
+class TarSink(_ShardedSink):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.suffix = ".tar.gz" if self.compress else ".tar"
+        # gzip stream under a compressed tar, which tarfile leaves open
+        self.gzip_file = None
+
+    def _open(self, path):
+        if not self.compress:
+            return tarfile.open(path, 'w')
+        # tarfile's 'w:gz' stamps the gzip header with the current time
+        self.gzip_file = gzip.GzipFile(path, 'wb', mtime=0)
+        return tarfile.open(fileobj=self.gzip_file, mode='w')
+
+    def _add(self, member, data):
+        info = tarfile.TarInfo(member)
+        info.size = len(data)
+        info.mtime = 0
+        info.mode = 0o644
+        self.bundle.addfile(info, io.BytesIO(data))
+
+    def close(self):
+        super().close()
+        if self.gzip_file is not None:
+            self.gzip_file.close()
+            self.gzip_file = None
+
+class ZipSink(_ShardedSink):
+    suffix = ".zip"
+
+    def _open(self, path):
+        compression = zipfile.ZIP_DEFLATED if self.compress else zipfile.ZIP_STORED
+        return zipfile.ZipFile(path, 'w', compression=compression)
+
+    def _add(self, member, data):
+        # an explicit ZipInfo, writestr(name) would stamp the current time
+        info = zipfile.ZipInfo(member, date_time=MEMBER_DATE)
+        info.compress_type = self.bundle.compression
+        info.external_attr = 0o644 << 16
+        self.bundle.writestr(info, data)
+
+def open_sink(mode="files", output_dir="outputs", compress=False, shard_size=DEFAULT_SHARD_SIZE,
+              name="hooktheory"):
+    """
+    Create an output sink.
+    Args:
+        mode: 'files' (one .krn per song), 'dedup' (one .krn per song
+              referencing its spines, each distinct body stored once),
+              'stream' (one multi-record file),
+              'tar' or 'zip' (bundles of shard_size songs);
+        output_dir: directory relative to the repo root;
+        compress: gzip the files/stream/tar output, deflate zip members;
+        name: file name prefix of the stream and bundles.
+    """
+    if mode == 'files':
+        return FileSink(output_dir, compress)
+    if mode == 'dedup':
+        return ContentSink(output_dir, compress)
+    if mode == 'stream':
+        return StreamSink(output_dir, compress, name)
+    if mode == 'tar':
+        return TarSink(output_dir, compress, shard_size, name)
+    if mode == 'zip':
+        return ZipSink(output_dir, compress, shard_size, name)
+    raise ValueError(f"Unknown sink mode: {mode}")
@@ -1,4 +1,9 @@
-import re
+from bisect import bisect_left, bisect_right
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import lru_cache
+from alignment import build_onset_index, align_onset, FIRST_AT_OR_AFTER
 # dicts
 major_key_signatures = {
     0: "", 7: "f#", 2: "f#c#", 9: "f#c#g#", 4: "f#c#g#d#", 11: "f#c#g#d#a#",
@@ -93,47 +98,54 @@ pc_to_name_minor = {
         6: "f#", 7: "g", 8: "g#", 9: "a", 10: "bb", 11: "b"
     }
 
-# chord identification funcs
-def tonic_and_signature_identification(key):
-    # mapping common modal tonic
-    pc_to_name_sharp = {
+pc_to_name_sharp = {
     0: "C", 1: "C#", 2: "D", 3: "D#", 4: "E", 5: "F",
     6: "F#", 7: "G", 8: "G#", 9: "A", 10: "A#", 11: "B"
     }
 
-    pc_to_name_flat = {
-        0: "C", 1: "Db", 2: "D", 3: "Eb", 4: "E", 5: "F",
-        6: "Gb", 7: "G", 8: "Ab", 9: "A", 10: "Bb", 11: "B"
+pc_to_name_flat = {
+    0: "C", 1: "Db", 2: "D", 3: "Eb", 4: "E", 5: "F",
+    6: "Gb", 7: "G", 8: "Ab", 9: "A", 10: "Bb", 11: "B"
     }
-    
-    intervals = key.get('scale_degree_intervals', [])
-    tonic_pc = key.get('tonic_pitch_class', 0)
+
+# chord identification funcs
+def mode_from_intervals(intervals):
+    '''
+    Identify the mode from the key's scale degree intervals
+    '''
     if intervals[:6] == [2, 2, 1, 2, 2, 2]:
-        mode = 'major'
+        return 'major'
     elif intervals[:6] == [2, 1, 2, 2, 1, 2]:
-        mode = 'minor'
+        return 'minor'
     elif intervals[:7] == [2, 1, 2, 2, 2, 1]:
-        mode = 'dorian'
+        return 'dorian'
     elif intervals[:7] == [1, 2, 2, 2, 1, 2]:
-        mode = 'phrygian'
+        return 'phrygian'
     elif intervals[:7] == [2, 2, 2, 1, 2, 2]:
-        mode = 'lydian'
+        return 'lydian'
     elif intervals[:7] == [2, 2, 1, 2, 2, 1]:
-        mode = 'mixolydian'
+        return 'mixolydian'
     elif intervals[:7] == [1, 2, 2, 1, 2, 2]:
-        mode = 'locrian'
-    else:
-        mode = 'unknown'
+        return 'locrian'
+    return 'unknown'
+
+def key_analysis(key):
+    '''
+    Mode, kern tonic name and key signature of a key annotation
+    '''
+    intervals = key.get('scale_degree_intervals', [])
+    tonic_pc = key.get('tonic_pitch_class', 0)
+    mode = mode_from_intervals(intervals)
 
     if mode == 'major':
         tonic_name = pc_to_name_major.get(tonic_pc, f"{tonic_pc}")
         signature = major_key_signatures.get(tonic_pc, "")
-        return tonic_name, signature
+        return mode, tonic_name, signature
     
     elif mode == 'minor':
         tonic_name = pc_to_name_minor.get(tonic_pc, f"{tonic_pc}")
         signature = minor_key_signatures.get(tonic_pc, "")
-        return tonic_name, signature
+        return mode, tonic_name, signature
     
     elif mode in modal_key_signatures:
         signature = modal_key_signatures[mode].get(tonic_pc, "")
@@ -146,13 +158,17 @@ def tonic_and_signature_identification(key):
         else:
             # major as fallback
             tonic_name = pc_to_name_major.get(tonic_pc, f"{tonic_pc}") + f"@{mode}"
-        return tonic_name, signature
+        return mode, tonic_name, signature
     
     else:
         # major as fallback
         signature = major_key_signatures.get(tonic_pc, "")
         tonic_name = pc_to_name_major.get(tonic_pc, f"{tonic_pc}")
-        return tonic_name+"?", signature
+        return mode, tonic_name+"?", signature
+
+def tonic_and_signature_identification(key):
+    _, tonic_name, signature = key_analysis(key)
+    return tonic_name, signature
 
 def prefer_flats_from_tonic(signature):
     '''
@@ -183,22 +199,6 @@ def intervals_to_pcset(intervals):
     # drop 0
     return frozenset(p for p in pcs if p != 0)
 
-def quality_from_intervals(intervals):
-    '''
-    Detect standard triads and seventh chords
-    '''
-    iv = list(map(int, intervals))
-    if iv == [4, 3]:      return ''      
-    if iv == [3, 4]:      return 'm'       
-    if iv == [3, 3]:      return 'dim'   
-    if iv == [4, 4]:      return 'aug'     
-    if iv == [4, 3, 3]:   return '7'     
-    if iv == [4, 3, 4]:   return 'maj7'   
-    if iv == [3, 4, 3]:   return 'm7'    
-    if iv == [3, 3, 4]:   return 'm7b5'    
-    if iv == [3, 3, 3]:   return 'dim7'
-    return None 
-
 def quality_from_pcset(pcset: frozenset):
     """
     Identify chord from a pitch-class set relative to the root
@@ -254,19 +254,53 @@ def quality_from_pcset(pcset: frozenset):
     # fallback
     return ''
 
+# chord labels are precomputed for every root, pitch-class mask and spelling;
+# the mask holds the pitch classes above the root (bit 0 is never set)
+CHORD_MASKS = 1 << 12
+
+_mask_cache = {}
+
+def intervals_to_mask(intervals):
+    '''
+    Root-position intervals to a 12-bit pitch-class mask
+    '''
+    key = tuple(intervals)
+    mask = _mask_cache.get(key)
+    if mask is None:
+        mask = 0
+        for pc in intervals_to_pcset(intervals):
+            mask |= 1 << pc
+        _mask_cache[key] = mask
+    return mask
+
+def _quality_from_mask(mask):
+    pcset = frozenset(pc for pc in range(12) if mask >> pc & 1)
+    return quality_from_pcset(pcset)
+
+CHORD_QUALITIES = [_quality_from_mask(mask) for mask in range(CHORD_MASKS)]
+# masks quality_from_pcset does not recognise, labelled as major triads
+MAJOR_TRIAD_MASK = 1 << 4 | 1 << 7
+CHORD_IS_FALLBACK = [CHORD_QUALITIES[mask] == '' and mask != MAJOR_TRIAD_MASK for mask in range(CHORD_MASKS)]
+
+# index: (prefer_flats * 12 + root_pc) * CHORD_MASKS + mask
+CHORD_LABELS = [
+    root_to_name(root_pc, prefer_flats) + quality
+    for prefer_flats in (False, True)
+    for root_pc in range(12)
+    for quality in CHORD_QUALITIES
+]
+
+def chord_label(root_pc, mask, prefer_flats):
+    return CHORD_LABELS[(prefer_flats * 12 + int(root_pc) % 12) * CHORD_MASKS + mask]
+
 def label_chord_from_harmony(harmony, signature):
     prefer_flats = prefer_flats_from_tonic(signature)
     root_pc = harmony.get('root_pitch_class', 0)
-    root_name = root_to_name(root_pc, prefer_flats)
-
-    intervals = harmony.get('root_position_intervals', [])
-    q = quality_from_intervals(intervals)
-    if q is None:
-        q = quality_from_pcset(intervals_to_pcset(intervals))
-    return f"{root_name}{q}"
+    mask = intervals_to_mask(harmony.get('root_position_intervals', []))
+    return chord_label(root_pc, mask, prefer_flats)
 
 # note name identification funcs
-def pitch_class_to_kern(pitch_class, octave, prefer_flats=False):
+def _spell_pitch(pitch_class, octave, prefer_flats=False):
     """
     Convert pitch class and octave to kern notation.
     Assumes:
@@ -291,93 +325,220 @@ def pitch_class_to_kern(pitch_class, octave, prefer_flats=False):
         base = letter.lower() + accidental
     return base
 
-# duration split
-def split_duration(duration, duration_map_keys):
-    result = []
-    remaining = duration
-    # detect triplet
-    triplet_bases = [1.0, 2.0, 4.0, 0.25, 0.5, 0.125, 0.0625]
-    for base in triplet_bases:
-        triplet_val = base * 2 / 3  # e.g. 0.6666, 1.333, 2.666
-        if abs(duration - triplet_val) < 0.01:
-            return [base / 3] * 3
-    
-    while remaining > 0.01:
-        for val in sorted(duration_map_keys, reverse=True):
-            if val <= remaining + 1e-6:
-                result.append(val)
+# kern pitch names keyed by (pitch_class, octave, prefer_flats)
+PITCH_OCTAVES = range(-8, 9)
+PITCH_TABLE = {
+    (pc, octave, prefer_flats): _spell_pitch(pc, octave, prefer_flats)
+    for pc in range(12)
+    for octave in PITCH_OCTAVES
+    for prefer_flats in (False, True)
+}
+
+def pitch_class_to_kern(pitch_class, octave, prefer_flats=False):
+    '''
+    Kern pitch name from the precomputed table (e.g. 'c', 'B', 'cc', 'AA')
+    '''
+    name = PITCH_TABLE.get((pitch_class, octave, prefer_flats))
+    if name is None:
+        name = _spell_pitch(pitch_class, octave, prefer_flats)
+    return name
+
+# warnings raised by this process, by kind
+warning_counts = Counter()
+# per thread / task, so a silenced library call does not mute the others
+_print_warnings = ContextVar('print_warnings', default=True)
+_collected_warnings = ContextVar('collected_warnings', default=None)
+
+def emit_warning(kind, message, value=None, song_id=None):
+    """
+    Report a data problem.
+    Args:
+        kind: warning type, e.g. 'unmatched_duration';
+        message: text printed when nothing collects the warning;
+        value: offending value, counted per kind in diagnostics reports;
+        song_id: song the warning belongs to, if the caller knows it.
+    """
+    warning_counts[kind] += 1
+    collected = _collected_warnings.get()
+    if collected is not None:
+        collected.append((kind, value, song_id))
+    elif _print_warnings.get():
+        print(f"[Warning] {message}")
+
+@contextmanager
+def silenced_warnings():
+    '''
+    Count warnings without printing them inside the block
+    '''
+    token = _print_warnings.set(False)
+    try:
+        yield
+    finally:
+        _print_warnings.reset(token)
+
+@contextmanager
+def collected_warnings():
+    '''
+    Collect the warnings of the block as (kind, value, song_id) into the
+    yielded list instead of printing them
+    '''
+    collected = []
+    token = _collected_warnings.set(collected)
+    try:
+        yield collected
+    finally:
+        _collected_warnings.reset(token)
+
+# duration engine
+# all durations are integer ticks; 96 ticks per quarter note covers
+# 64th notes and 64th triplets exactly, also in x/8 meters
+TICKS_PER_QUARTER = 96
+
+# kern values available to the greedy split, largest first
+DURATION_TICKS = [
+    (384, "1"),   # whole note
+    (288, "2."),  # dotted half note
+    (192, "2"),   # half note
+    (144, "4."),  # dotted quarter note
+    (96, "4"),    # quarter note
+    (72, "8."),   # dotted eighth note
+    (48, "8"),    # eighth note
+    (36, "16."),  # dotted sixteenth note
+    (24, "16"),   # sixteenth note
+    (12, "32"),   # 32nd note
+    (6, "64"),    # 64th note
+]
+# triplet values, written as their own kern reciprocals (3 per half, 6 per
+# whole...) so every token is exactly as long as its ticks; used for the
+# durations the plain values cannot write exactly
+TRIPLET_DURATION_TICKS = sorted(DURATION_TICKS + [
+    (128, "3"),   # half triplet
+    (64, "6"),    # quarter triplet
+    (32, "12"),   # eighth triplet
+    (16, "24"),   # sixteenth triplet
+    (8, "48"),    # 32nd triplet
+    (4, "96"),    # 64th triplet
+], reverse=True)
+_kern_by_ticks = dict(TRIPLET_DURATION_TICKS)
+
+# kern rhythm value -> ticks, used to read tokens back
+KERN_VALUE_TICKS = {kern_val: ticks for ticks, kern_val in TRIPLET_DURATION_TICKS}
+
+# tie marks of the first, middle and last token of a tied note
+TIE_START, TIE_MIDDLE, TIE_END = "[", "_", "]"
+
+# decompositions are precomputed up to four whole notes
+DECOMPOSITION_TABLE_TICKS = 4 * 384
+
+def duration_to_ticks(duration, beat_unit=4):
+    '''
+    Duration in beats to the nearest tick
+    '''
+    return round(duration * (4 / beat_unit) * TICKS_PER_QUARTER)
+
+def _greedy_parts(ticks, values):
+    '''
+    Largest-first split of a duration over values, skipping a value that
+    would leave 2 ticks (shorter than any value) of an even duration.
+    Returns:
+        (parts, remainder in ticks)
+    '''
+    parts = []
+    remaining = ticks
+    while remaining > 0:
+        for val, _ in values:
+            if val <= remaining and (remaining - val != 2 or remaining % 2):
+                parts.append(val)
                 remaining -= val
                 break
         else:
-            # avoid infinite loop
-            print(f"[Warning] Cannot match remaining duration: {remaining}")
             break
-    return result
+    return parts, remaining
+
+def _split_ticks(ticks):
+    '''
+    Split a duration into kern-representable parts: plain values when they
+    add up exactly, else triplet values too.
+    Returns:
+        (parts, warnings): list of ticks and list of (kind, message, value)
+    '''
+    parts, remaining = _greedy_parts(ticks, DURATION_TICKS)
+    if remaining:
+        triplet_parts, triplet_remaining = _greedy_parts(ticks, TRIPLET_DURATION_TICKS)
+        if triplet_remaining < remaining:
+            parts, remaining = triplet_parts, triplet_remaining
+    if remaining:
+        # remainder shorter than a 64th triplet
+        value = remaining / TICKS_PER_QUARTER
+        return parts, [('unmatched_duration', f"Cannot match remaining duration: {value}", value)]
+    return parts, []
+
+def _decompose_ticks(ticks):
+    '''
+    Kern rhythm tokens (tied if more than one) for a duration.
+    Returns:
+        (tokens, parts, warnings) as tuples
+    '''
+    parts, warnings = _split_ticks(ticks)
+    tokens = []
+    for i, part in enumerate(parts):
+        kern_val = _kern_by_ticks[part]
+        if len(parts) > 1:
+            # tie the parts: start, continue, end
+            kern_val += TIE_START if i == 0 else TIE_END if i == len(parts) - 1 else TIE_MIDDLE
+        tokens.append(kern_val)
+    return tuple(tokens), tuple(parts), tuple(warnings)
+
+DECOMPOSITION_TABLE = [_decompose_ticks(t) for t in range(DECOMPOSITION_TABLE_TICKS + 1)]
+
+def untied(token):
+    return token.rstrip(TIE_START + TIE_MIDDLE + TIE_END)
+
+def tie_chain(tokens):
+    '''
+    Rhythm tokens of one note split into pieces (e.g. at barlines), tied
+    into a single chain
+    '''
+    tokens = [untied(token) for token in tokens]
+    if len(tokens) < 2:
+        return tokens
+    return [tokens[0] + TIE_START] + [token + TIE_MIDDLE for token in tokens[1:-1]] + [tokens[-1] + TIE_END]
+
+@lru_cache(maxsize=None)
+def _decompose_long_ticks(ticks):
+    return _decompose_ticks(ticks)
+
+def decompose_duration(ticks):
+    '''
+    Cached (tokens, parts, warnings) for a duration in ticks
+    '''
+    if 0 <= ticks <= DECOMPOSITION_TABLE_TICKS:
+        return DECOMPOSITION_TABLE[ticks]
+    if ticks < 0:
+        return DECOMPOSITION_TABLE[0]
+    return _decompose_long_ticks(ticks)
 
 def duration_to_kern(duration, beat_unit=4):
     """
     Convert duration(offset-onset) in beats to kern rhythmic value
     """
-    duration_in_quarter = duration * (4 / beat_unit)
-    
-    duration_map = {
-        4.0: "1",     # whole note
-        3.0: "2.",    # dotted half note
-        2.0: "2",     # half note
-        1.5: "4.",    # dotted quarter note
-        1.0: "4",     # quarter note
-        0.75: "8.",   # dotted eighth note
-        0.6666667: "4", # quarter triplet
-        0.5: "8",     # eighth note
-        0.375: "16.", # dotted sixteenth note
-        0.3333333: "8", # eighth triplet
-        0.25: "16",   # sixteenth note
-        0.166667: "16", 
-        0.125: "32",  # 32nd note
-        0.0833333: "32", # sixteenth triplet
-        0.0625: "64", # 64nd note
-        0.04166: "64" # 64nd triplet
-    }
-    keys = duration_map.keys()
-    split = split_duration(duration_in_quarter, keys)
-    # detect triplet
-    is_triplet = False
-    if len(split) == 3 and all(abs(split[0] - s) < 0.01 for s in split):
-        total = sum(split)
-        if (
-            abs(total - 2.0) < 0.01 or
-            abs(total - 1.0) < 0.01 or
-            abs(total - 0.5) < 0.01 or
-            abs(total - 0.25) < 0.01 or
-            abs(total - 0.125) < 0.01
-        ):
-            is_triplet = True
-    
-    kern_parts = []
-    for i, dur in enumerate(split):
-        # kern_val = duration_map.get(dur)
-        def lookup_kern_value(duration, duration_map, tolerance=0.0001):
-            for dur_val, kern in duration_map.items():
-                if abs(duration - dur_val) < tolerance:
-                    return kern
-        kern_val = lookup_kern_value(dur, duration_map)
-        
-        if not kern_val:
-            print(f"[Warning] Unexpected sub-duration: {dur}")
-            kern_val = "4"  # fallback
-        if is_triplet:
-            if i == 0:
-                kern_val += "L"
-            elif i == 2:
-                kern_val += "J"
-        else:
-            # add tie if more than one element
-            if i < len(split) - 1:
-                kern_val += "["  
-            elif (i > 0) and (i == len(split) - 1):
-                kern_val += "]"
-        kern_parts.append(kern_val)
-    return kern_parts
+    tokens, _, warnings = decompose_duration(duration_to_ticks(duration, beat_unit))
+    for kind, message, value in warnings:
+        emit_warning(kind, message, value)
+    return list(tokens)
+
+@lru_cache(maxsize=None)
+def kern_value_to_ticks(val, default=TICKS_PER_QUARTER):
+    '''
+    Ticks of a kern rhythm value; L/J mark a triplet (2/3 of the value)
+    in records written before triplets had their own values
+    '''
+    is_triplet = "L" in val or "J" in val
+    val = val.replace("L", "").replace("J", "")
+    ticks = KERN_VALUE_TICKS.get(val, default)
+    if is_triplet:
+        ticks = ticks * 2 // 3
+    return ticks
 
 def r_to_duration(r):
     """
@@ -385,132 +546,214 @@ def r_to_duration(r):
     Supports triplet markers: L (start), J (end).
     """
     r = r.replace("r", "").replace("[", "")
-    is_triplet = "L" in r or "J" in r
-    r = r.replace("L", "").replace("J", "")
-
-    duration_map = {
-        "1": 4.0, "2.": 3.0, "2": 2.0, "4.": 1.5, "4": 1.0,
-        "8.": 0.75, "8": 0.5, "16.": 0.375, "16": 0.25, "32": 0.125
-    }
-
-    dur = duration_map.get(r, 1.0)
-    if is_triplet:
-        dur *= 2 / 3
-    return dur
+    return kern_value_to_ticks(r) / TICKS_PER_QUARTER
 
 def d_to_duration(kern_val):
     """
     Convert kern note symbol (e.g. "8L", "8J", "4[") to duration in quarter notes.
     Removes tie symbols and interprets triplet markers.
     """
-    val = kern_val.replace("[", "").replace("_", "")
-    is_triplet = "L" in val or "J" in val
-    val = val.replace("L", "").replace("J", "")
+    val = untied(kern_val)
+    return kern_value_to_ticks(val) / TICKS_PER_QUARTER
+
+# per-song context
+def build_song_context(score_metadata):
+    """
+    Analyse the key and meter of a song once for all conversion stages.
+    Args:
+        score_metadata: song dict with annotations["keys"] and annotations["meters"]
 
-    duration_map = {
-        "1": 4.0, "2.": 3.0, "2": 2.0, "4.": 1.5, "4": 1.0,
-        "8.": 0.75, "8": 0.5, "16.": 0.375, "16": 0.25, "32": 0.125
+    Returns:
+        dict with mode, tonic, signature, prefer_flats, meter,
+        beats_per_bar, beat_unit, bar_length (in beats), beat_ticks
+        (ticks per annotation beat) and meter_segments
+    """
+    key = score_metadata.get('keys', [{}])[0]
+    mode, tonic_name, signature = key_analysis(key)
+    if mode == 'unknown':
+        intervals = key.get('scale_degree_intervals', [])
+        emit_warning('unknown_mode', f"Unknown mode for intervals {intervals}, using major",
+                     str(intervals), score_metadata.get('id'))
+    meters = score_metadata.get('meters', [{}])
+    meter = meters[0]
+    beats_per_bar = meter.get('beats_per_bar', 4)
+    beat_unit = meter.get('beat_unit', 4)
+    beat_ticks = TICKS_PER_QUARTER * 4 // beat_unit
+    return {
+        'mode': mode,
+        'tonic': tonic_name,
+        'signature': signature,
+        'prefer_flats': prefer_flats_from_tonic(signature),
+        'meter': meter,
+        'beats_per_bar': beats_per_bar,
+        'beat_unit': beat_unit,
+        'bar_length': beats_per_bar,
+        'beat_ticks': beat_ticks,
+        'meter_segments': meter_segments(meters, beat_ticks),
     }
 
-    dur = duration_map.get(val, 1.0)
-    if is_triplet:
-        dur *= 2 / 3
-    return dur
+def meter_segments(meters, beat_ticks):
+    '''
+    Meter changes as (start_tick, beats_per_bar, beat_unit, bar_ticks),
+    sorted by start; annotation beats are counted in the first meter's unit
+    '''
+    segments = []
+    for meter in sorted(meters, key=lambda m: m.get('beat', 0)):
+        beats_per_bar = meter.get('beats_per_bar', 4)
+        beat_unit = meter.get('beat_unit', 4)
+        start = round(meter.get('beat', 0) * beat_ticks)
+        bar_ticks = beats_per_bar * TICKS_PER_QUARTER * 4 // beat_unit
+        segments.append((start, beats_per_bar, beat_unit, bar_ticks))
+    return segments
+
+def iter_bar_lines(segments, song_start=0):
+    """
+    Yield every barline position of a song, in order.
+    Bars run from each meter's start; a first meter starting after the
+    song start leaves a pickup bar before it.
+    Yields:
+        (tick, meter): meter is the new (beats_per_bar, beat_unit) when
+        the barline starts a meter change, else None
+    """
+    for i, (start, beats_per_bar, beat_unit, bar_ticks) in enumerate(segments):
+        end = segments[i + 1][0] if i + 1 < len(segments) else None
+        if i > 0:
+            yield start, (beats_per_bar, beat_unit)
+        elif start > song_start:
+            yield start, None
+        tick = start + bar_ticks
+        while end is None or tick < end:
+            yield tick, None
+            tick += bar_ticks
 
 # melody spine generation
-def melody_to_kern(melody, meter, num_beats, signature):
+def melody_to_kern(melody, ctx, num_beats):
     """
-    Covert [melody] in [annotations] into kern string list.
+    Covert [melody] in [annotations] into kern string list, with barlines
+    (and meter changes) placed from the exact onset of each token. Notes
+    crossing a barline are split at it and tied, rests are split untied.
+    A barline carries the number of the bar it starts, a pickup is bar 0.
     Args:
         melody: list of dict，including onset, offset, pitch_class, octave;
+        ctx: song context from build_song_context;
+        num_beats: annotations["num_beats"], the melody is padded with rests up to it;
 
     Returns:
-        List of string：e.g. ["4B,,", "c#8", "D2."]
+        List of string：e.g. ["4B,,", "c#8", "=2", "D2."], and the onset of
+        each line in ticks (barlines and interpretations are repeated as is,
+        so other spines can copy them)
     """
     kern_notes = []
     onsets = []
     
-    beat_unit = meter['beat_unit']
-    def add_rest(start, end):
-        rest_duration = end - start
-        rest_kerns = duration_to_kern(rest_duration, beat_unit)
-        if not isinstance(rest_kerns, list):
-            rest_kerns = [rest_kerns]
-        for r in rest_kerns:
-            r = r.replace("[", "")
-            kern_notes.append(f"{r}r")
-            onsets.append(start)
-            start += r_to_duration(r)
-    
+    beat_ticks = ctx['beat_ticks']
+    prefer_flats = ctx['prefer_flats']
     melody = sorted(melody, key=lambda x: x['onset'])
-    prev_offset = 0.0
+
+    song_start = min(0, round(melody[0]['onset'] * beat_ticks)) if melody else 0
+    segments = ctx['meter_segments']
+    first_bar = 1 if segments[0][0] > song_start else 2
+    bar_lines = iter_bar_lines(segments, song_start)
+    # barlines read so far as (tick, meter), and how many are written
+    bars = [next(bar_lines)]
+    bar_ticks = [bars[0][0]]
+    closed = 0
+
+    def read_bars(pos):
+        # read ahead past pos
+        while bar_ticks[-1] <= pos:
+            bars.append(next(bar_lines))
+            bar_ticks.append(bars[-1][0])
+
+    def add_bar_lines(pos):
+        # close every bar that ends at or before pos with one barline
+        nonlocal closed
+        read_bars(pos)
+        if bar_ticks[closed] > pos:
+            return
+        meter = None
+        while bar_ticks[closed] <= pos:
+            meter = bars[closed][1] or meter
+            closed += 1
+        kern_notes.append(f"={closed - 1 + first_bar}")
+        onsets.append(kern_notes[-1])
+        if meter:
+            kern_notes.append(f"*M{meter[0]}/{meter[1]}")
+            onsets.append(kern_notes[-1])
+
+    def add_tokens(start, end, kern_pitch):
+        # pieces between the barlines inside the token
+        read_bars(end)
+        bounds = [start] + bar_ticks[bisect_right(bar_ticks, start):bisect_left(bar_ticks, end)] + [end]
+        tokens, starts = [], []
+        for piece_start, piece_end in zip(bounds, bounds[1:]):
+            piece_tokens, piece_parts, warnings = decompose_duration(piece_end - piece_start)
+            for kind, message, value in warnings:
+                emit_warning(kind, message, value)
+            tokens.extend(piece_tokens)
+            for part in piece_parts:
+                starts.append(piece_start)
+                piece_start += part
+        if kern_pitch == "r":
+            # rests are never tied
+            tokens = [untied(token) for token in tokens]
+        elif len(bounds) > 2:
+            tokens = tie_chain(tokens)
+        for token, pos in zip(tokens, starts):
+            add_bar_lines(pos)
+            kern_notes.append(f"{token}{kern_pitch}")
+            onsets.append(pos)
+        # end of the last piece, short of the token's end by any unmatched remainder
+        return piece_start
+
+    prev_offset = 0
+    end = 0
     for note in melody:
-        onset = note['onset']
-        offset = note['offset']
-        octave = note['octave']
-        pitch_class = note['pitch_class']
-        # calculation
-        duration = offset - onset
+        onset = round(note['onset'] * beat_ticks)
+        offset = round(note['offset'] * beat_ticks)
         
         # If there's a rest before this note
         if onset > prev_offset:
-            add_rest(prev_offset, onset)
-        
-        kern_duration = duration_to_kern(duration, beat_unit)
-        if not isinstance(kern_duration, list):
-            kern_duration = [kern_duration]
-        
-        if "-" in signature:
-            prefer_flats = True
-        else:
-            prefer_flats = False
-
-        kern_pitch = pitch_class_to_kern(pitch_class, octave, prefer_flats)
-        for i, dur in enumerate(kern_duration):
-            if i == 0:
-                kern_notes.append(f"{dur}{kern_pitch}")
-            else:
-                kern_notes.append(f"{dur}{kern_pitch}")
-            onsets.append(onset)  # 🔴 对应 melody_onsets
-            onset += d_to_duration(dur)
-        
+            add_tokens(prev_offset, onset, "r")
+
+        kern_pitch = pitch_class_to_kern(note['pitch_class'], note['octave'], prefer_flats)
+        end = add_tokens(onset, offset, kern_pitch)
         prev_offset = offset
         
     # Final rest if song ends early
-    if prev_offset < num_beats:
-        add_rest(prev_offset, num_beats)
+    if num_beats is not None and prev_offset < round(num_beats * beat_ticks):
+        end = add_tokens(prev_offset, round(num_beats * beat_ticks), "r")
+    # barline after a last bar that is complete
+    add_bar_lines(end)
             
     return kern_notes, onsets
     
-def generate_kern(score_metadata):
+def generate_kern(score_metadata, ctx=None):
     """
     Generate full kern format string for a single song.
     Args:
         score_metadata: annotations["meters"], annotations["keys"], annotations["num_beats"], annotations["melody"]
+        ctx: song context from build_song_context, built here if omitted
     Returns:
         str: .krn content as plain text
     """
+    if ctx is None:
+        ctx = build_song_context(score_metadata)
     # ---- Header ----
     kern_lines = []
     kern_lines.append("**kern")
     kern_lines.append("*clefG2")
     ## key signatures
-    key = score_metadata.get('keys', [{}])[0]
-    tonic_name, signature = tonic_and_signature_identification(key)
-    
-    kern_lines.append(f"*k[{signature}]")
-    kern_lines.append(f"*{tonic_name}:")
+    kern_lines.append(f"*k[{ctx['signature']}]")
+    kern_lines.append(f"*{ctx['tonic']}:")
         
     ## beats
-    meter = score_metadata.get('meters', [{}])[0]
-    beats_per_bar = meter.get('beats_per_bar', 4)
-    beat_unit = meter.get('beat_unit', 4)
-    kern_lines.append(f"*M{beats_per_bar}/{beat_unit}")
+    kern_lines.append(f"*M{ctx['beats_per_bar']}/{ctx['beat_unit']}")
     
     # ---- Body ----
     melody = score_metadata.get('melody', [{}])
     num_beats = score_metadata.get('num_beats')
-    melody_lines, melody_onsets = melody_to_kern(melody, meter, num_beats, signature)
+    melody_lines, melody_onsets = melody_to_kern(melody, ctx, num_beats)
     kern_lines.extend(melody_lines)
     
     # ---- Foot ----
@@ -519,99 +762,78 @@ def generate_kern(score_metadata):
     return kern_lines, melody_onsets
 
 # harmony spine generation
-def harmony_to_kern(score_metadata, melody_onsets):
+def chord_anchors(score_metadata, melody_onsets, ctx=None):
+    """
+    Label and anchor row of every chord, shared by the harmony spines.
+    Args:
+        score_metadata: annotations["harmony"]
+        melody_onsets: onset of each melody row in ticks (or the barline /
+            interpretation itself), from generate_kern
+        ctx: song context from build_song_context, built here if omitted
+    Returns:
+        list of (chord, onset tick, label, row): row is the first melody
+        data row at or after the chord onset, None after the last one
+    """
+    if ctx is None:
+        ctx = build_song_context(score_metadata)
+    prefer_flats = ctx['prefer_flats']
+    beat_ticks = ctx['beat_ticks']
+
+    data_rows = [row for row, t in enumerate(melody_onsets) if not isinstance(t, str)]
+    # find the first melody onset at or after each chord onset
+    onset_index = build_onset_index([melody_onsets[row] for row in data_rows])
+    anchors = []
+    for chord in score_metadata.get('harmony') or []:
+        onset = round(chord['onset'] * beat_ticks)
+        intervals = chord.get('root_position_intervals', [])
+        mask = intervals_to_mask(intervals)
+        label = chord_label(chord.get('root_pitch_class', 0), mask, prefer_flats)
+        if CHORD_IS_FALLBACK[mask]:
+            emit_warning('fallback_chord_quality', f"Unknown chord intervals {intervals}, labelled {label}",
+                         str(intervals), score_metadata.get('id'))
+
+        anchor_idx = align_onset(onset_index, onset, FIRST_AT_OR_AFTER)
+        anchors.append((chord, onset, label, None if anchor_idx is None else data_rows[anchor_idx]))
+    return anchors
+
+def anchored_spine(melody_onsets, anchors, tokens):
+    '''
+    Spine body aligned with the melody: barlines are copied, other
+    interpretations get a null token, each anchored chord its token
+    (later chords on the same row win)
+    '''
+    spine = [(t if t.startswith("=") else "*") if isinstance(t, str) else '.' for t in melody_onsets]
+    for (_, _, _, row), token in zip(anchors, tokens):
+        if row is not None:
+            spine[row] = token
+    return spine
+
+def harmony_to_kern(score_metadata, melody_onsets, ctx=None, anchors=None):
     """
     Generate harmony string for a single song.
     Args:
         score_metadata: annotations["melody"], annotations["harmony"]
+        melody_onsets: onset of each melody row in ticks (or the barline /
+            interpretation itself), from generate_kern
+        ctx: song context from build_song_context, built here if omitted
+        anchors: chord_anchors() of the song, computed here if omitted
     Returns:
         str: .krn content as plain text
     """
     ## if harmony is None, return None as harmony spine
     if score_metadata.get('harmony') is None:
+        emit_warning('missing_harmony', "harmony is None", None, score_metadata.get('id'))
         return None
-    
-    kern_lines = []
 
-    # initialization
-    key = score_metadata.get('keys', [{}])[0]
-    harmony = score_metadata.get('harmony')
-    # melody = score_metadata.get('melody')
-    _, signature = tonic_and_signature_identification(key)
-    
-    total_beats = len(melody_onsets)
-    total_beats_int = int(total_beats)
-    beat_line = ['.'] * total_beats_int
-    
-    for chord in harmony:
-        onset = chord['onset']
-        chord_label = label_chord_from_harmony(chord, signature)
-        
-        # find the closet index in melody_onsets
-        anchor_idx = next((i for i, t in enumerate(melody_onsets) if t >= onset), None)
-        if anchor_idx is not None and anchor_idx < len(beat_line):
-            beat_line[anchor_idx] = chord_label
-
-    # to kern spine
-    for label in beat_line:
-        kern_lines.append(label)
-  
+    if anchors is None:
+        anchors = chord_anchors(score_metadata, melody_onsets, ctx)
+    kern_lines = anchored_spine(melody_onsets, anchors, [label for _, _, label, _ in anchors])
+
     header = ["**mxhm", "*clefG2", "*", "*", "*"]
     kern_lines = header + kern_lines
     kern_lines.append("*-")
     return kern_lines
 
-def insert_barlines(melody_spine, harmony_spine, meter):
-    """
-    Insert barlines into both melody and harmony spines based on meter.
-    """
-    beats_per_bar = meter.get('beats_per_bar', 4)
-    beat_unit = meter.get('beat_unit', 4)
-
-    melody_body = melody_spine[:-1] if melody_spine[-1] == "*-" else melody_spine
-    harmony_body = harmony_spine[:-1] if harmony_spine and harmony_spine[-1] == "*-" else harmony_spine
-
-
-    output_melody = []
-    output_harmony = [] if harmony_spine else None
-    beat_counter = 0.0
-    bar_index = 1
-
-    for idx, m_line in enumerate(melody_body):
-        output_melody.append(m_line)
-        if harmony_body:
-            h_line = harmony_body[idx]
-            output_harmony.append(h_line)
-
-        if m_line.startswith("*") or m_line.startswith("="):
-            continue
-
-        # Extract duration value from the melody line
-        match = re.match(r"^(\d+\.?)(?:_|\[|r|[a-gA-Gr#-]+)?", m_line)
-        if match:
-            dur_str = match.group(1)
-            dur_val_map = {
-                "1": 4, "2.": 3, "2": 2, "4.": 1.5, "4": 1,
-                "8.": 0.75, "8": 0.5, "16.": 0.375, "16": 0.25, "32": 0.125
-            }
-            dur = dur_val_map.get(dur_str, 0)
-            beat_counter += dur * (beat_unit / 4)
-
-            if beat_counter >= beats_per_bar - 1e-6:
-                output_melody.append(f"={bar_index}")
-                if output_harmony is not None:
-                    output_harmony.append(f"={bar_index}")
-                bar_index += 1
-                beat_counter = 0.0
-
-    # Add back footers
-    output_melody.append("*-")
-    if output_harmony is not None:
-        output_harmony.append("*-")
-
-    return output_melody, output_harmony
-
-
 if __name__ == "__main__":
     # test pitch_class_to_kern func
     test_cases = [
@@ -637,7 +859,7 @@ if __name__ == "__main__":
         {"onset": 3.0, "offset": 4.0, "pitch_class": 4, "octave": 5},   # 4ee
         {"onset": 4.0, "offset": 8.0, "pitch_class": 7, "octave": 2},   # 1GG
     ]
-    result = melody_to_kern(melody, meter = {'beat': 0, 'beats_per_bar': 3, 'beat_unit': 4})
+    result = melody_to_kern(melody, build_song_context({'meters': [{'beat': 0, 'beats_per_bar': 3, 'beat_unit': 4}]}), 8)
     print("Kern melody:", result)
     
     # test generate_kern func
@@ -654,10 +876,11 @@ if __name__ == "__main__":
             {"onset": 1.0, "offset": 2.0, "octave": 3, "pitch_class": 2},   # 4D
             {"onset": 2.0, "offset": 3.0, "octave": 3, "pitch_class": 0},   # 4C
             {"onset": 3.0, "offset": 4.0, "octave": 3, "pitch_class": 4},   # 4E
-        ]
+        ],
+        "num_beats": 4
     }
 
-    kern_output = generate_kern(sample_metadata)
+    kern_output, melody_onsets = generate_kern(sample_metadata)
     print("\n".join(kern_output))
     
     # test harmony_to_kern func
@@ -674,5 +897,5 @@ if __name__ == "__main__":
     ],
     "num_beats": 3
     }
-    lines = harmony_to_kern(sample_metadata)
+    lines = harmony_to_kern(sample_metadata, melody_onsets)
     print("\n".join(lines))
\ No newline at end of file
@@ -0,0 +1,237 @@
+import os
+import re
+import time
+import argparse
+from collections import Counter
+from multiprocessing import Pool
+from parse_json import iter_songs
+from sinks import FileSink
+from content_store import read_record
+from pipeline import iter_pool_results
+from utils import (build_song_context, generate_kern, pitch_class_to_kern, chord_label,
+                   intervals_to_mask, kern_value_to_ticks, silenced_warnings, collected_warnings)
+
+# songs sent to a worker per task
+CHUNK_SIZE = 64
+# mismatches described per song, the others are only counted
+MAX_EXAMPLES = 3
+# mismatch kinds explained by source data one spine cannot hold exactly:
+# overlapping notes, and lengths whose remainder the converter drops (with
+# an unmatched_duration warning); the rows after them drift
+DRIFT_KINDS = {'onset', 'chord'}
+
+# kern token: rhythm value, L/J/tie markers, pitch (or r)
+KERN_TOKEN = re.compile(r'([0-9]+\.?)([LJ\[_\]]*)(.*)')
+
+def read_kern(text, start=0):
+    """
+    Re-derive the events of a converted .krn record.
+    Durations are read as in d_to_duration / r_to_duration, except that
+    the middle token of an L...J group (records before CONVERTER_VERSION 5)
+    is a triplet too; a tie or a triplet group makes one note.
+    Args:
+        text: .krn record;
+        start: tick of the first row, before 0 for a song with a pickup.
+    Returns:
+        dict with notes [(tick, pitch)], rests [(tick, ticks)], rows
+        (tick of every data row) and chords [(row, label)]
+    """
+    notes, rests, rows, chords = [], [], [], []
+    pos = start
+    in_tie = in_group = False
+    for line in text.split('\n'):
+        if not line or line[0] in '!*=':
+            continue
+        fields = line.split('\t')
+        match = KERN_TOKEN.fullmatch(fields[0])
+        if match is None:
+            raise ValueError(f"Unreadable kern token: {fields[0]!r}")
+        value, marks, pitch = match.groups()
+        if 'L' in marks:
+            in_group = True
+        ticks = kern_value_to_ticks(value + ('L' if in_group else ''))
+        starts_note = not in_tie and (not in_group or 'L' in marks)
+        if starts_note:
+            if pitch == 'r':
+                rests.append((pos, ticks))
+            else:
+                notes.append((pos, pitch))
+        if len(fields) > 1 and fields[1] != '.':
+            chords.append((len(rows), fields[1]))
+        rows.append(pos)
+        pos += ticks
+        in_tie = '[' in marks or '_' in marks
+        if 'J' in marks:
+            in_group = False
+    return {'notes': notes, 'rests': rests, 'rows': rows, 'chords': chords, 'end': pos}
+
+def expected_events(song):
+    """
+    What the converter should have written for a song.
+    Returns:
+        dict with notes [(tick, pitch)] in onset order, chords
+        [(tick, label)] in annotation order, beat_ticks, the tick the
+        song starts at and whether notes overlap
+    """
+    ctx = build_song_context(song)
+    beat_ticks = ctx['beat_ticks']
+    prefer_flats = ctx['prefer_flats']
+    notes = [(round(note['onset'] * beat_ticks),
+              pitch_class_to_kern(note['pitch_class'], note['octave'], prefer_flats))
+             for note in sorted(song['melody'], key=lambda x: x['onset'])]
+    # as melody_to_kern: a pickup starts the song before 0
+    start = min(0, notes[0][0]) if notes else 0
+    spans = sorted((round(note['onset'] * beat_ticks), round(note['offset'] * beat_ticks))
+                   for note in song['melody'])
+    overlaps = any(onset < offset for (_, offset), (onset, _) in zip(spans, spans[1:]))
+    chords = [(round(chord['onset'] * beat_ticks),
+               chord_label(chord.get('root_pitch_class', 0),
+                           intervals_to_mask(chord.get('root_position_intervals', [])), prefer_flats))
+              for chord in song.get('harmony') or []]
+    return {'notes': notes, 'chords': chords, 'beat_ticks': beat_ticks, 'start': start, 'overlaps': overlaps}
+
+def has_unmatched_durations(song):
+    '''
+    Whether converting the song drops the remainder of a length no kern
+    value adds up to
+    '''
+    with collected_warnings() as collected:
+        generate_kern(song)
+    return any(kind == 'unmatched_duration' for kind, _, _ in collected)
+
+def compare(song, text, max_examples=MAX_EXAMPLES):
+    """
+    Compare a .krn record against the source annotations of its song.
+    Returns:
+        (Counter of mismatch kinds, list of example messages, whether the
+        source has overlapping notes)
+    """
+    # data warnings were reported by the conversion run
+    with silenced_warnings():
+        expected = expected_events(song)
+    found = read_kern(text, expected['start'])
+    beat_ticks = expected['beat_ticks']
+    problems = Counter()
+    examples = []
+
+    def report(kind, message):
+        problems[kind] += 1
+        if len(examples) < max_examples:
+            examples.append(f"{kind}: {message}")
+
+    if len(found['notes']) != len(expected['notes']):
+        report('note_count', f"{len(found['notes'])} notes in kern, {len(expected['notes'])} in source")
+    for i, ((tick, pitch), (src_tick, src_pitch)) in enumerate(zip(found['notes'], expected['notes'])):
+        if tick != src_tick:
+            report('onset', f"note {i} at beat {tick / beat_ticks:g}, source {src_tick / beat_ticks:g}")
+        if pitch != src_pitch:
+            report('pitch', f"note {i} is {pitch}, source {src_pitch}")
+
+    # each chord sits on the first row at or after its onset, later chords win
+    rows = found['rows']
+    anchors = {}
+    row = 0
+    for src_tick, label in sorted(expected['chords'], key=lambda c: c[0]):
+        while row < len(rows) and rows[row] < src_tick:
+            row += 1
+        if row < len(rows):
+            anchors[row] = label
+    found_anchors = dict(found['chords'])
+    for row in sorted(set(anchors) | set(found_anchors)):
+        if anchors.get(row) != found_anchors.get(row):
+            where = f"beat {rows[row] / beat_ticks:g}" if row < len(rows) else f"row {row}"
+            report('chord', f"{found_anchors.get(row)} at {where}, source {anchors.get(row)}")
+    return problems, examples, expected['overlaps']
+
+def verify_song(song, path, max_examples=MAX_EXAMPLES):
+    '''
+    Verification result of one song: status 'ok', 'mismatch', 'lossy'
+    (only drift after overlapping notes or lengths the converter warned
+    it cannot write), 'missing' or 'error'
+    '''
+    result = {'id': song['id'], 'status': 'ok', 'problems': Counter(), 'examples': []}
+    try:
+        text = read_record(path)
+    except FileNotFoundError:
+        result['status'] = 'missing'
+        return result
+    try:
+        problems, examples, overlaps = compare(song, text, max_examples)
+    except Exception as e:
+        result.update(status='error', examples=[f"{type(e).__name__}: {e}"])
+        return result
+    if problems:
+        lossy = set(problems) <= DRIFT_KINDS and (overlaps or has_unmatched_durations(song))
+        result.update(status='lossy' if lossy else 'mismatch', problems=problems, examples=examples)
+    return result
+
+def verify_chunk(items):
+    return [verify_song(song, path) for song, path in items]
+
+def iter_chunks(items, size):
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def iter_results(songs, sink, workers=1):
+    # songs without melody are skipped by the converter, they have no file
+    items = ((song, sink.path(song['id'])) for song in songs if song.get('melody'))
+    if workers <= 1:
+        for chunk in iter_chunks(items, CHUNK_SIZE):
+            yield from verify_chunk(chunk)
+        return
+    with Pool(workers) as pool:
+        for results in iter_pool_results(pool, verify_chunk, iter_chunks(items, CHUNK_SIZE), workers):
+            yield from results
+
+def main(workers=None, compress=False, cache=False, verbose=False):
+    """
+    Verify every TRAIN song's file in outputs/.
+    Returns:
+        number of songs that are not ok or lossy (use as exit status)
+    """
+    t0 = time.perf_counter()
+    source = 'data/Hooktheory.json.gz'
+    if cache:
+        from corpus_cache import open_cache
+        songs = open_cache(source).iter_songs(splits=('TRAIN',))
+    else:
+        songs = iter_songs(source, splits=('TRAIN',))
+    sink = FileSink("outputs", compress)
+
+    statuses = Counter()
+    problems = Counter()
+    # drift of lossy songs, reported apart so it does not hide real mismatches
+    lossy_problems = Counter()
+    for result in iter_results(songs, sink, workers or os.cpu_count()):
+        statuses[result['status']] += 1
+        (lossy_problems if result['status'] == 'lossy' else problems).update(result['problems'])
+        if result['status'] != 'ok' and (verbose or result['status'] not in ('mismatch', 'lossy')):
+            print(f"{result['id']}: {result['status']}")
+            for example in result['examples']:
+                print(f"    {example}")
+
+    elapsed = time.perf_counter() - t0
+    print(f"Verified {sum(statuses.values())} songs in {elapsed:.1f}s: "
+          + ", ".join(f"{count} {status}" for status, count in sorted(statuses.items())))
+    if problems:
+        print("Mismatches: " + ", ".join(f"{count} {kind}" for kind, count in sorted(problems.items())))
+    if lossy_problems:
+        print("Lossy (drift after overlapping notes or lengths no kern value adds up to, not failed): "
+              + ", ".join(f"{count} {kind}" for kind, count in sorted(lossy_problems.items())))
+    return sum(count for status, count in statuses.items() if status not in ('ok', 'lossy'))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Check that outputs/*.krn reproduce the source annotations.")
+    parser.add_argument('--workers', type=int, default=None, help="worker processes (default: CPU count)")
+    parser.add_argument('--compress', action='store_true', help="outputs were written with --compress")
+    parser.add_argument('--cache', action='store_true', help="read the source from the corpus cache")
+    parser.add_argument('--verbose', action='store_true', help="describe every mismatching song")
+    args = parser.parse_args()
+    failed = main(args.workers, args.compress, args.cache, args.verbose)
+    raise SystemExit(1 if failed else 0)
@@ -0,0 +1,255 @@
+import os
+import json
+import time
+import queue
+import argparse
+from collections import deque
+from multiprocessing import Pool
+from parse_json import to_song
+from manifest import hash_song, manifest_path, load_manifest, save_manifest, make_entry
+from sinks import FileSink
+from diagnostics import Diagnostics
+from budgets import QUARANTINE_NAME, quarantine_entry
+from run_all import process_song, write_result
+from serve import warm_up
+
+DEFAULT_DROP_DIR = "data/incoming"
+# seconds between directory scans, and how long a file must stay unchanged
+# before it is converted (editors and copies write in several steps)
+POLL_INTERVAL = 0.05
+DEBOUNCE = 0.1
+# seconds between status lines / status file updates
+STATUS_INTERVAL = 10.0
+STATUS_NAME = "watch-status.json"
+# latencies kept for the status percentiles
+LATENCY_WINDOW = 1000
+
+def scan(drop_dir):
+    '''
+    {path: (mtime_ns, size)} of the .json files in the drop directory
+    '''
+    stamps = {}
+    for entry in os.scandir(drop_dir):
+        if entry.name.endswith('.json') and entry.is_file():
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            stamps[entry.path] = (stat.st_mtime_ns, stat.st_size)
+    return stamps
+
+def load_songs(path):
+    """
+    Songs of a dropped file: one record in the raw dump or iter_songs shape
+    (its id defaults to the file name), or an {id: record} object.
+    """
+    with open(path, 'r', encoding='utf-8') as f:
+        data = json.load(f)
+    if not isinstance(data, dict):
+        raise ValueError("Expected a JSON object")
+    if 'annotations' in data or 'melody' in data:
+        return [to_song(data, os.path.basename(path)[:-len('.json')])]
+    return [to_song(record, song_id) for song_id, record in data.items()]
+
+def convert_file(path):
+    '''
+    Worker task: (path, [(input_hash, result)] per song, error or None)
+    '''
+    try:
+        songs = load_songs(path)
+    except (OSError, ValueError, KeyError, TypeError) as e:
+        return path, [], f"{type(e).__name__}: {e}"
+    return path, [(hash_song(song), process_song(song)) for song in songs], None
+
+class WatchStats:
+    """
+    Counters and recent latencies of a watch session.
+    """
+    def __init__(self):
+        self.start = time.time()
+        self.files = 0
+        self.songs = 0
+        self.errors = 0
+        self.quarantined = 0
+        # ms from the file's last modification to its outputs being written
+        self.latencies = deque(maxlen=LATENCY_WINDOW)
+        # ms from submitting the file to the pool to its outputs being written
+        self.convert_latencies = deque(maxlen=LATENCY_WINDOW)
+
+    def to_dict(self, pending, waiting, diagnostics):
+        def percentiles(values):
+            values = sorted(values)
+            if not values:
+                return None
+            return {'p50': values[len(values) // 2], 'p95': values[min(len(values) - 1, int(0.95 * len(values)))],
+                    'max': values[-1]}
+
+        return {
+            'uptime_seconds': time.time() - self.start,
+            'files': self.files,
+            'songs': self.songs,
+            'errors': self.errors,
+            'quarantined': self.quarantined,
+            'converting': pending,
+            'waiting': waiting,
+            'latency_ms': percentiles(self.latencies),
+            'convert_ms': percentiles(self.convert_latencies),
+            'warnings': dict(diagnostics.counts),
+        }
+
+class Watcher:
+    """
+    Convert the .json files of a drop directory into outputs/ whenever they
+    are created or change.
+    """
+    def __init__(self, drop_dir=DEFAULT_DROP_DIR, workers=2, debounce=DEBOUNCE, new_only=False,
+                 output_dir="outputs", compress=False):
+        self.drop_dir = os.path.join(os.path.dirname(__file__), '..', drop_dir)
+        os.makedirs(self.drop_dir, exist_ok=True)
+        self.workers = workers
+        self.debounce = debounce
+        self.sink = FileSink(output_dir, compress)
+        self.manifest_file = manifest_path(output_dir)
+        self.status_file = manifest_path(output_dir, STATUS_NAME)
+        # appended to, a watch session has no end to rewrite it at
+        self.quarantine_file = manifest_path(output_dir, QUARANTINE_NAME)
+        self.entries = load_manifest(self.manifest_file)
+        self.stats = WatchStats()
+        self.diagnostics = Diagnostics()
+        # path -> stamp last submitted; files present at start count as done with new_only
+        self.done = scan(self.drop_dir) if new_only else {}
+        # path -> (stamp, when it was first seen)
+        self.changed = {}
+        # path -> (stamp, submit time); finished tasks are put on a queue by
+        # the pool, so the loop wakes up as soon as one is done
+        self.pending = {}
+        self.finished = queue.Queue()
+        self.pool = None
+
+    def poll(self):
+        '''
+        One scan: note changes and submit the files that settled
+        '''
+        now = time.monotonic()
+        stamps = scan(self.drop_dir)
+        for path, stamp in stamps.items():
+            if self.done.get(path) != stamp and self.changed.get(path, (None,))[0] != stamp:
+                self.changed[path] = (stamp, now)
+        for path in list(self.changed):
+            if path not in stamps:
+                del self.changed[path]
+        for path in list(self.done):
+            if path not in stamps:
+                del self.done[path]
+
+        # bounded: at most two files per worker in flight, the rest wait
+        settled = [path for path, (_, seen) in self.changed.items()
+                   if now - seen >= self.debounce and path not in self.pending]
+        for path in settled[:max(self.workers * 2 - len(self.pending), 0)]:
+            stamp, _ = self.changed.pop(path)
+            self.done[path] = stamp
+            self.pending[path] = (stamp, time.monotonic())
+            self.pool.apply_async(convert_file, (path,), callback=self.finished.put,
+                                  error_callback=lambda e, path=path: self.finished.put(
+                                      (path, [], f"{type(e).__name__}: {e}")))
+
+    def wait(self, timeout):
+        '''
+        Write the files finished within timeout seconds.
+        Returns:
+            number of files written
+        '''
+        count = 0
+        try:
+            item = self.finished.get(timeout=timeout)
+            while True:
+                self._write(*item)
+                count += 1
+                item = self.finished.get_nowait()
+        except queue.Empty:
+            return count
+
+    def _write(self, path, results, error):
+        stamp, submitted = self.pending.pop(path)
+        name = os.path.basename(path)
+        self.stats.files += 1
+        if error:
+            self.stats.errors += 1
+            print(f"Error: {name}: {error}")
+            return
+        with open(self.manifest_file, 'a', encoding='utf-8') as manifest_log:
+            for input_hash, result in results:
+                song_id, status = result['id'], result['status']
+                self.diagnostics.add_song(song_id, result['warnings'])
+                if status == 'error':
+                    self.stats.errors += 1
+                    print(f"Error: {name}: {song_id}: {result['message'].strip().splitlines()[-1]}")
+                    continue
+                if status == 'quarantined':
+                    self.stats.quarantined += 1
+                    print(f"Quarantined: {name}: {song_id}: {result['message']}")
+                    with open(self.quarantine_file, 'a', encoding='utf-8') as quarantine_log:
+                        quarantine_log.write(json.dumps(quarantine_entry(input_hash, result), sort_keys=True) + "\n")
+                    continue
+                checksum, size = write_result(self.sink, result)
+                entry = make_entry(song_id, input_hash, status, checksum, size)
+                self.entries[song_id] = entry
+                manifest_log.write(json.dumps(entry, sort_keys=True) + "\n")
+                self.stats.songs += 1
+        self.stats.latencies.append((time.time_ns() - stamp[0]) / 1e6)
+        self.stats.convert_latencies.append((time.monotonic() - submitted) * 1000)
+        ids = ", ".join(result['id'] for _, result in results)
+        print(f"{name}: {ids} in {self.stats.convert_latencies[-1]:.1f} ms")
+
+    def report(self):
+        status = self.stats.to_dict(len(self.pending), len(self.changed), self.diagnostics)
+        with open(self.status_file, 'w', encoding='utf-8') as f:
+            json.dump(status, f, indent=2)
+        latency = status['latency_ms']
+        print(f"[status] {status['files']} files, {status['songs']} songs, {status['errors']} errors, "
+              f"{status['quarantined']} quarantined, {status['converting']} converting, {status['waiting']} waiting"
+              + (f", p50 {latency['p50']:.0f} ms from save" if latency else ""))
+
+    def run(self, once=False, poll_interval=POLL_INTERVAL, status_interval=STATUS_INTERVAL):
+        """
+        Watch until interrupted.
+        Args:
+            once: convert what is in the directory now, then stop;
+            poll_interval: seconds between scans;
+            status_interval: seconds between status reports.
+        """
+        print(f"Watching {os.path.normpath(self.drop_dir)} with {self.workers} workers...")
+        self.pool = Pool(self.workers, initializer=warm_up)
+        last_report = time.monotonic()
+        activity = False
+        try:
+            while True:
+                self.poll()
+                if once and not self.changed and not self.pending:
+                    break
+                activity |= self.wait(poll_interval) > 0
+                if activity and time.monotonic() - last_report >= status_interval:
+                    self.report()
+                    last_report, activity = time.monotonic(), False
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.pool.terminate()
+            save_manifest(self.manifest_file, self.entries)
+            self.report()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert per-song JSON files dropped into a directory.")
+    parser.add_argument('--dir', default=DEFAULT_DROP_DIR, help="drop directory relative to the repo root")
+    parser.add_argument('--workers', type=int, default=2, help="worker processes")
+    parser.add_argument('--debounce-ms', type=float, default=DEBOUNCE * 1000,
+                        help="time a file must stay unchanged before it is converted")
+    parser.add_argument('--poll-ms', type=float, default=POLL_INTERVAL * 1000, help="time between scans")
+    parser.add_argument('--status-interval', type=float, default=STATUS_INTERVAL,
+                        help=f"seconds between status lines and {STATUS_NAME} updates")
+    parser.add_argument('--new-only', action='store_true', help="ignore files already present until they change")
+    parser.add_argument('--once', action='store_true', help="convert the files present now and exit")
+    parser.add_argument('--compress', action='store_true', help="gzip the output")
+    args = parser.parse_args()
+    watcher = Watcher(args.dir, args.workers, args.debounce_ms / 1000, args.new_only, compress=args.compress)
+    watcher.run(args.once, args.poll_ms / 1000, args.status_interval)